@@ -5,6 +5,19 @@ type FileChunk = {
     hash: number,
     chunk: ArrayBuffer
 }
+
+// /load_model はロードをサーバのバックグラウンドで始めて jobId を返す。進み具合は /load_model/{jobId} で確認する。
+type LoadJob = {
+    jobId: string,
+    status: "queued" | "loading" | "warmup" | "swapping" | "done" | "failed",
+    progress: number,
+    error: string
+}
+type LoadJobResponse = {
+    status: string,
+    loadJob: LoadJob
+}
+const LOAD_JOB_POLLING_INTERVAL_MS = 500
 export class ServerConfigurator {
     private serverUrl = ""
 
@@ -110,9 +123,10 @@ export class ServerConfigurator {
     }
 
     // !! 注意!! hubertTorchModelは固定値で上書きされるため、設定しても効果ない。
+    // サーバはロードの完了を待たずに応答するので、ロードが終わるまで待ってから新しいモデルの情報を返す。
     loadModel = async (configFilename: string, pyTorchModelFilename: string | null, onnxModelFilename: string | null, clusterTorchModelFilename: string | null, hubertTorchModelFilename: string | null) => {
         const url = this.serverUrl + "/load_model"
-        const info = new Promise<ServerInfo>(async (resolve) => {
+        const info = new Promise<ServerInfo & { jobId?: string }>(async (resolve) => {
             const formData = new FormData();
             formData.append("pyTorchModelFilename", pyTorchModelFilename || "-");
             formData.append("onnxModelFilename", onnxModelFilename || "-");
@@ -124,10 +138,37 @@ export class ServerConfigurator {
                 method: 'POST',
                 body: formData,
             });
-            const res = await (await fetch(request)).json() as ServerInfo
+            const res = await (await fetch(request)).json() as ServerInfo & { jobId?: string }
             resolve(res)
         })
-        return await info
+        const res = await info
+        if (!res.jobId) {
+            return res // ロードが終わってから応答する(jobId を返さない)サーバ
+        }
+        await this.waitLoadJob(res.jobId)
+        return await this.getSettings()
+    }
+
+    waitLoadJob = async (jobId: string) => {
+        const url = this.serverUrl + "/load_model/" + jobId
+        while (true) {
+            await new Promise<void>((resolve) => { setTimeout(resolve, LOAD_JOB_POLLING_INTERVAL_MS) })
+            const request = new Request(url, {
+                method: 'GET',
+            });
+            const res = await (await fetch(request)).json() as LoadJobResponse
+            if (res.status != "OK") {
+                console.warn(`[ServerConfigurator] unknown load job: ${jobId}`)
+                return
+            }
+            if (res.loadJob.status == "done") {
+                return
+            }
+            if (res.loadJob.status == "failed") {
+                console.warn(`[ServerConfigurator] load model failed: ${res.loadJob.error}`)
+                return
+            }
+        }
     }
 
 }
\ No newline at end of file
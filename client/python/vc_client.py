@@ -1,7 +1,6 @@
 import argparse
 import pyaudio
 import wave
-import struct
 import socketio
 import ssl
 from datetime import datetime
@@ -93,10 +92,8 @@ class MyCustomNamespace(socketio.ClientNamespace):
         data = msg[1]
         perf = msg[2]
         print(f"RT:{responseTime}msec", perf)
-        unpackedData = struct.unpack('<%sh' % (len(data) // struct.calcsize('<h')), data)
-        data = np.array(unpackedData)
-        data = data * GAIN
-        data = struct.pack('<%sh' % len(data), *data)
+        data = np.frombuffer(data, dtype='<i2', count=len(data) // 2)
+        data = np.clip(data.astype(np.int32) * GAIN, -32768, 32767).astype('<i2').tobytes()
 
         if self.file_output_stream != None:
             self.file_output_stream.write(data)
@@ -0,0 +1,86 @@
+# 録音済みの wav をサーバと同じモデルで変換する(リアルタイムの経路を通さない)。
+# 例: python MMVCOfflineConverter.py --modelType MMVCv15 -c config.json -m G.pth -o model.onnx --workers 4 take1.wav take2.wav
+import argparse
+import os
+import sys
+import time
+
+from const import setModelType
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", type=str, nargs="+", help="16bit PCM wav files to convert")
+    parser.add_argument("--outputDir", type=str, default="converted", help="directory for the converted files")
+    parser.add_argument("-c", type=str, required=True, help="path for the config.json")
+    parser.add_argument("-m", type=str, help="path for the model file")
+    parser.add_argument("-o", type=str, help="path for the onnx model file")
+    parser.add_argument("--modelType", type=str, default="MMVCv15",
+                        help="model type: MMVCv13, MMVCv15, so-vits-svc-40, so-vits-svc-40v2, so-vits-svc-40v2_tsukuyomi, DDSP-SVC")
+    parser.add_argument("--cluster", type=str, help="path to cluster model")
+    parser.add_argument("--hubert", type=str, help="path to hubert model")
+    parser.add_argument("--workers", type=int, default=2, help="number of threads converting segments in parallel")
+    parser.add_argument("--silenceThresholdDb", type=float, default=-40.0, help="frames quieter than this (relative to the loudest frame) are silence")
+    parser.add_argument("--minSilenceMs", type=int, default=300, help="minimum silence to split at")
+    parser.add_argument("--maxSegmentSec", type=float, default=15.0, help="maximum length of a segment")
+    parser.add_argument("--minSegmentSec", type=float, default=2.0, help="minimum length of a segment")
+    parser.add_argument("--marginMs", type=int, default=500, help="context converted before each segment and discarded")
+    parser.add_argument("--crossFadeOverlapSize", type=int, help="crossfade between segments (samples at the processing sampling rate)")
+    parser.add_argument("--onnxIntraOpThreads", type=int, help="onnxruntime intra-op threads (0: default)")
+    parser.add_argument("--onnxInterOpThreads", type=int, help="onnxruntime inter-op threads (0: default)")
+    parser.add_argument("--onnxExecutionMode", type=str, help="onnxruntime execution mode: sequential, parallel")
+    parser.add_argument("--mappedWeights", type=int, help="convert PyTorch checkpoints to a memory-mapped weight file on first load: 0:off, 1:on")
+    parser.add_argument("--mappedWeightsDir", type=str, help="directory for the converted memory-mapped weight files (default: mapped_weights)")
+    return parser
+
+
+def main():
+    args = setupArgParser().parse_args()
+    if args.m is None and args.o is None:
+        print("model file (-m) or onnx model file (-o) is required")
+        sys.exit(1)
+    setModelType(args.modelType)
+
+    from voice_changer.VoiceChanger import VoiceChanger
+    from voice_changer.OfflineConverter import OfflineConverter, OfflineConvertSettings
+
+    voiceChanger = VoiceChanger({
+        "hubert": args.hubert,
+        "onnxIntraOpThreads": args.onnxIntraOpThreads,
+        "onnxInterOpThreads": args.onnxInterOpThreads,
+        "onnxExecutionMode": args.onnxExecutionMode,
+        "mappedWeights": args.mappedWeights,
+        "mappedWeightsDir": args.mappedWeightsDir,
+    })
+    voiceChanger.settings.warmupIterations = 0  # チャンク単位の推論はしないので warmup は不要
+    if args.crossFadeOverlapSize is not None:
+        voiceChanger.settings.crossFadeOverlapSize = args.crossFadeOverlapSize
+    start = time.perf_counter()
+    voiceChanger.loadModel(args.c, args.m, args.o, args.cluster)
+    print(f"model loaded: {time.perf_counter() - start:.2f}sec")
+
+    settings = OfflineConvertSettings(workers=args.workers, silenceThresholdDb=args.silenceThresholdDb, minSilenceMs=args.minSilenceMs,
+                                      maxSegmentSec=args.maxSegmentSec, minSegmentSec=args.minSegmentSec, marginMs=args.marginMs)
+    converter = OfflineConverter(voiceChanger)
+    audioSeconds = 0.0
+    failed = []
+    start = time.perf_counter()
+    for inputFile in args.inputs:
+        outputFile = os.path.join(args.outputDir, os.path.splitext(os.path.basename(inputFile))[0] + "_converted.wav")
+        try:
+            job = converter.convert_file(inputFile, outputFile, settings)
+            audioSeconds += job.audioSeconds
+            print(f"{inputFile} -> {outputFile}: {job.audioSeconds:.1f}sec, {job.segments} segments, "
+                  f"{job.totalTime:.2f}sec ({job.throughput:.2f} audio-sec/sec)")
+        except Exception as e:
+            print(f"{inputFile}: FAILED {type(e).__name__}: {e}")
+            failed.append(inputFile)
+    elapsed = time.perf_counter() - start
+    print(f"total: {audioSeconds:.1f}sec of audio in {elapsed:.2f}sec ({audioSeconds / elapsed if elapsed > 0 else 0.0:.2f} audio-sec/sec, "
+          f"workers:{args.workers}), failed:{len(failed)}")
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,10 +10,7 @@ import os
 import argparse
 import uvicorn
 import webbrowser
-from mods.ssl import create_self_signed_cert
-from voice_changer.VoiceChangerManager import VoiceChangerManager
-from sio.MMVC_SocketIOApp import MMVC_SocketIOApp
-from restapi.MMVC_Rest import MMVC_Rest
+# voice_changer(torch, onnxruntime など)と fastapi/socketio はサーバプロセス(__name__ == 'MMVCServerSIO')でだけ読み込む
 from const import NATIVE_CLIENT_FILE_MAC, NATIVE_CLIENT_FILE_WIN, SSL_KEY_DIR, setModelType
 import subprocess
 import multiprocessing as mp
@@ -42,6 +39,18 @@ def setupArgParser():
     parser.add_argument("--cluster", type=str, help="path to cluster model")
     parser.add_argument("--hubert", type=str, help="path to hubert model")
     parser.add_argument("--internal", type=strtobool, default=False, help="各種パスをmac appの中身に変換")
+    parser.add_argument("--inferenceWorkers", type=int, default=2, help="number of threads for inference")
+    parser.add_argument("--queueSize", type=int, default=4, help="max queued chunks per session")
+    parser.add_argument("--queuePolicy", type=str, default="drop_oldest", help="policy when the queue is full: drop_oldest, coalesce")
+    parser.add_argument("--onnxIntraOpThreads", type=int, help="onnxruntime intra-op threads (0: default)")
+    parser.add_argument("--onnxInterOpThreads", type=int, help="onnxruntime inter-op threads (0: default)")
+    parser.add_argument("--onnxExecutionMode", type=str, help="onnxruntime execution mode: sequential, parallel")
+    parser.add_argument("--onnxGraphOptimization", type=str, help="onnxruntime graph optimization level: disable, basic, extended, all")
+    parser.add_argument("--onnxCpuMemArena", type=int, help="onnxruntime cpu memory arena: 0:off, 1:on")
+    parser.add_argument("--mappedWeights", type=int, help="convert PyTorch checkpoints to a memory-mapped weight file on first load: 0:off, 1:on")
+    parser.add_argument("--mappedWeightsDir", type=str, help="directory for the converted memory-mapped weight files (default: mapped_weights)")
+    parser.add_argument("--importReport", type=strtobool, default=False, help="print import times of the server and the model modules (-X importtime) and exit")
+    parser.add_argument("--modelCacheBudgetMB", type=int, help="memory budget (MB) for replaced models kept in memory (RAM or VRAM) for fast switching back. default 0: keep only the active model")
 
     return parser
 
@@ -122,7 +131,24 @@ if args.colab == True:
     os.environ["colab"] = "True"
 
 if __name__ == 'MMVCServerSIO':
-    voiceChangerManager = VoiceChangerManager.get_instance({"hubert": HUBERT_MODEL})
+    from voice_changer.VoiceChangerManager import VoiceChangerManager
+    from sio.MMVC_SocketIOApp import MMVC_SocketIOApp
+    from restapi.MMVC_Rest import MMVC_Rest
+
+    voiceChangerManager = VoiceChangerManager.get_instance({
+        "hubert": HUBERT_MODEL,
+        "inferenceWorkers": args.inferenceWorkers,
+        "queueSize": args.queueSize,
+        "queuePolicy": args.queuePolicy,
+        "onnxIntraOpThreads": args.onnxIntraOpThreads,
+        "onnxInterOpThreads": args.onnxInterOpThreads,
+        "onnxExecutionMode": args.onnxExecutionMode,
+        "onnxGraphOptimization": args.onnxGraphOptimization,
+        "onnxCpuMemArena": args.onnxCpuMemArena,
+        "modelCacheBudgetMB": args.modelCacheBudgetMB,
+        "mappedWeights": args.mappedWeights,
+        "mappedWeightsDir": args.mappedWeightsDir,
+    })
     if CONFIG and (MODEL or ONNX_MODEL):
         if MODEL_TYPE == "MMVCv15" or MODEL_TYPE == "MMVCv13":
             voiceChangerManager.loadModel(CONFIG, MODEL, ONNX_MODEL, None)
@@ -141,6 +167,11 @@ if __name__ == '__mp_main__':
 if __name__ == '__main__':
     mp.freeze_support()
 
+    if args.importReport:
+        from misc.import_report import print_import_report
+        print_import_report(MODEL_TYPE)
+        exit(0)
+
     printMessage(f"Voice Changerを起動しています。", level=2)
     TYPE = args.t
     PORT = args.p
@@ -174,6 +205,7 @@ if __name__ == '__main__':
         # HTTPS key/cert作成
         if args.https and args.httpsSelfSigned == 1:
             # HTTPS(おれおれ証明書生成)
+            from mods.ssl import create_self_signed_cert
             os.makedirs(SSL_KEY_DIR, exist_ok=True)
             key_base_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}"
             keyname = f"{key_base_name}.key"
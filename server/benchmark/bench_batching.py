@@ -0,0 +1,67 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import threading
+import time
+import numpy as np
+
+from voice_changer.utils.InferenceBatcher import InferenceBatcher
+
+# 複数セッションが同時にストリーミングしている状況を模擬して、バッチ化の待ち時間(windowMs)ごとの
+# スループット、バッチサイズの分布、リクエストあたりの追加待ち時間を比較する。
+# モデルの代わりに行列積(numpy は GIL を解放する)を使う。
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=4, help="number of concurrent sessions")
+    parser.add_argument("--chunks", type=int, default=50, help="chunks per session")
+    parser.add_argument("--windows", type=str, default="0,2,5,10", help="batch windows (ms)")
+    parser.add_argument("--frames", type=int, default=64, help="frames per chunk")
+    parser.add_argument("--dim", type=int, default=512, help="hidden size of the dummy model")
+    parser.add_argument("--layers", type=int, default=8, help="layers of the dummy model")
+    return parser
+
+
+def main():
+    args = setupArgParser().parse_args()
+    rng = np.random.default_rng(0)
+    weights = [rng.standard_normal((args.dim, args.dim)).astype(np.float32) / np.sqrt(args.dim) for _ in range(args.layers)]
+
+    def model(items):
+        x = np.concatenate(items)  # (B*frames, dim)
+        for w in weights:
+            x = np.tanh(x @ w)
+        return np.split(x, len(items))
+
+    inputs = [rng.standard_normal((args.frames, args.dim)).astype(np.float32) for _ in range(args.sessions)]
+    expected = [model([x])[0] for x in inputs]
+
+    print(f"sessions:{args.sessions}, chunks/session:{args.chunks}")
+    for windowMs in [float(x) for x in args.windows.split(",")]:
+        batcher = InferenceBatcher(windowMs=windowMs, maxBatchSize=args.sessions)
+        errors = []
+
+        def stream(i):
+            for _ in range(args.chunks):
+                out = batcher.run(("dummy", inputs[i].shape), inputs[i], model)
+                errors.append(float(np.max(np.abs(out - expected[i]))))
+
+        threads = [threading.Thread(target=stream, args=(i,)) for i in range(args.sessions)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        info = batcher.get_info()
+        print(f"  window:{windowMs:5.1f}ms  {args.sessions * args.chunks / elapsed:8.1f} chunks/s, "
+              f"added wait mean:{info['meanAddedWaitMs']:.2f}ms max:{info['maxAddedWaitMs']:.2f}ms, "
+              f"batch sizes:{info['batchSizeHistogram']}, max diff:{max(errors):.1e}")
+
+
+if __name__ == '__main__':
+    main()
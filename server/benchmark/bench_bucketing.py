@@ -0,0 +1,92 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import inspect
+import tempfile
+import time
+import numpy as np
+
+from voice_changer.utils.OnnxSessionFactory import OnnxSessionFactory
+from voice_changer.utils.ShapeBucketing import ShapeBuckets, EXAMPLE_CONVERT_BUCKETS
+
+# convertSize のバケット化の有無による推論時間のばらつきの比較。
+# クライアントごとにチャンクサイズやクロスフェードの長さが違う状況を、チャンクごとにランダムな convertSize で再現し、
+# hop 単位の切り上げだけ(従来)とバケットへの切り上げで、形の種類数、形ごとの初回の余分な時間(warmup)の合計、平均、p99、
+# 同じ形の中でのばらつきを表示する。
+# モデルは Conv1d を重ねた小さなモデルを ONNX に書き出して使う(mem pattern など形ごとの最適化は onnxruntime の既定のまま)。
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--buckets", type=str, default=EXAMPLE_CONVERT_BUCKETS)
+    parser.add_argument("--hop", type=int, default=256)
+    parser.add_argument("--chunks", type=str, default="1024,2048,3072,4096,6144,8192,12288,16384", help="input sizes to choose from")
+    parser.add_argument("--crossfades", type=str, default="512,1024,2048,4096", help="crossfade sizes to choose from")
+    parser.add_argument("--num", type=int, default=300)
+    return parser
+
+
+def export_dummy_model(path: str):
+    import torch
+
+    class Dummy(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.layers = torch.nn.ModuleList([torch.nn.Conv1d(192, 192, 5, padding=2) for _ in range(4)])
+
+        def forward(self, x):
+            for layer in self.layers:
+                x = torch.tanh(layer(x)) + x
+            return x
+
+    options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(Dummy().eval(), torch.zeros(1, 192, 64), path, input_names=["x"], output_names=["y"],
+                      dynamic_axes={"x": {2: "frames"}, "y": {2: "frames"}}, **options)
+
+
+def run(session, sizes: list, hop: int):
+    """ 形ごとの時間[ms]のリストを返す。 """
+    times: dict[int, list] = {}
+    for convertSize in sizes:
+        x = np.random.rand(1, 192, convertSize // hop).astype(np.float32)
+        start = time.perf_counter()
+        session.run(None, {"x": x})
+        times.setdefault(convertSize, []).append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def main():
+    args = setupArgParser().parse_args()
+    model = os.path.join(tempfile.mkdtemp(), "dummy.onnx")
+    export_dummy_model(model)
+    factory = OnnxSessionFactory.get_instance()
+    factory.update_setteings("onnxIntraOpThreads", 1)
+
+    rng = np.random.default_rng(0)
+    chunks = [int(x) for x in args.chunks.split(",")]
+    crossfades = [int(x) for x in args.crossfades.split(",")]
+    requested = []
+    for _ in range(args.num):
+        convertSize = max(int(rng.choice(chunks)) + int(rng.choice(crossfades)), 8192)
+        requested.append(-(-convertSize // args.hop) * args.hop)
+
+    buckets = ShapeBuckets(args.buckets)
+    bucketed = [buckets.bucket(x, args.hop) for x in requested]
+
+    print(f"{'':>10} {'shapes':>6} {'samples':>8} {'warmup[ms]':>10} {'mean[ms]':>9} {'p99[ms]':>8} {'in-shape std[ms]':>16}")
+    for name, sizes in [("hop only", requested), ("bucketed", bucketed)]:
+        session = factory.create(model, ["CPUExecutionProvider"])  # 形ごとのキャッシュを持ち越さないように毎回作る
+        times = run(session, sizes, args.hop)
+        # 形ごとの最初の1回(warmup)の合計と、2回目以降の形の中でのばらつき(プールした標準偏差)
+        warmup = sum([t[0] - np.median(t[1:]) for t in times.values() if len(t) > 1])
+        steady = [np.array(t[1:]) - np.mean(t[1:]) for t in times.values() if len(t) > 2]
+        pooledStd = np.sqrt(np.mean(np.concatenate(steady) ** 2)) if len(steady) > 0 else 0
+        allTimes = np.concatenate([np.array(t) for t in times.values()])
+        print(f"{name:>10} {len(times):6d} {np.mean(sizes):8.0f} {warmup:10.2f} {np.mean(allTimes):9.2f} {np.percentile(allTimes, 99):8.2f} {pooledStd:16.3f}")
+    print(f"overflow: {buckets.get_info()['overflows']}")
+
+
+if __name__ == '__main__':
+    main()
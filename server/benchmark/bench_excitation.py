@@ -0,0 +1,162 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from voice_changer.MMVCv15.ExcitationBuilder import ExcitationBuilder
+from voice_changer.VoiceChangerSession import VoiceChangerSession
+
+# MMVCv15 の励起信号(sin, d0..d3)の生成コストを、チャンクごとに TextAudioSpeakerCollate を作る従来方式と比較する。
+# MMVC_Client の features モジュールがあればそれを使い、なければ同じ処理をここで再現したものと比較する。
+# d0..d3 は従来方式と一致すること(無声フレームの扱いも含めて)を確認する。
+# sin はチャンクをまたいで位相を引き継ぐので、連続した f0 の系列を窓をずらしながら生成し、
+# 系列全体で位相を積算した参照(ノイズなし)の同じ絶対サンプル位置と比べる(窓の先頭 = チャンクの境界の直後も含めて)。
+# 一致しない場合は exit code 1 を返す。
+
+SIN_TOLERANCE = 1e-4  # 振幅 0.1 に対する誤差(位相は float32 で引き継ぐ)
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sr", type=int, default=24000)
+    parser.add_argument("--hop", type=int, default=128)
+    parser.add_argument("--convertSize", type=int, default=8192)
+    parser.add_argument("--chunk", type=int, default=1024)
+    parser.add_argument("--num", type=int, default=200)
+    return parser
+
+
+def reference_sine(f0: np.ndarray, sr: int, hop: int, sineAmp: float = 0.1):
+    """ f0 の系列全体で位相を積算した sin(float64, ノイズなし)。TextAudioSpeakerCollate の sinusoid と同じ式。 """
+    f0Samples = np.repeat(f0, hop)
+    return sineAmp * np.sin(np.cumsum(f0Samples * 2 * np.pi / sr)) * (f0Samples > 10.0)
+
+
+def check_sine(args, rng):
+    """ 連続した f0 を窓(convertSize)をチャンクずつずらしながら生成して、参照の sin と比べる。
+    戻り値: (窓全体での最大誤差, 窓の先頭 hop サンプル(チャンクの境界の直後)での最大誤差) """
+    frameNum = args.convertSize // args.hop
+    chunkFrames = args.chunk // args.hop
+    builder = ExcitationBuilder(args.sr, args.hop, noise_amp=0.0)
+    session = VoiceChangerSession("bench-sine")
+    # f0 はゆっくり動かし、無声の区間を挟む
+    totalFrames = frameNum + chunkFrames * args.num
+    f0 = 150 + 50 * np.sin(np.arange(totalFrames) * 0.05) + 5 * rng.random(totalFrames)
+    f0[(np.arange(totalFrames) // 40) % 5 == 4] = 0
+    reference = reference_sine(f0, args.sr, args.hop)
+
+    maxDiff = 0.0
+    boundaryDiff = 0.0
+    for n in range(args.num):
+        startFrame = n * chunkFrames
+        windowStart = startFrame * args.hop
+        sin, _ = builder.build(f0[startFrame:startFrame + frameNum].copy(), 1.0, session, windowStart)
+        diff = np.abs(sin.numpy().reshape(-1) - reference[windowStart:windowStart + frameNum * args.hop])
+        maxDiff = max(maxDiff, float(diff.max()))
+        if n > 0:
+            boundaryDiff = max(boundaryDiff, float(diff[:args.hop].max()))
+    return maxDiff, boundaryDiff
+
+
+def legacy_collate(sr: int, hop: int):
+    try:
+        from voice_changer.MMVCv15.client_modules import TextAudioSpeakerCollate
+        print("use TextAudioSpeakerCollate (features module found)")
+        return lambda spec, sid, f0: TextAudioSpeakerCollate(sample_rate=sr, hop_size=hop, f0_factor=1.0)([(spec, sid, f0)])
+    except ImportError:
+        print("features module is not found. use reimplementation of TextAudioSpeakerCollate.")
+
+    def dilated_factor(batch_f0, fs, dense_factor):
+        batch_f0[batch_f0 == 0] = fs / dense_factor
+        return np.ones_like(batch_f0) * fs / dense_factor / batch_f0
+
+    def sinusoid(f0):
+        f0 = F.interpolate(f0, f0.shape[2] * hop)
+        vuv = f0 > 10.0
+        sine = 0.1 * torch.sin(torch.cumsum(f0 * 2 * np.pi / sr, dim=2)) * vuv
+        return sine + 0.003 * torch.randn_like(sine)
+
+    def collate(spec, sid, f0):
+        dense_factors = [0.5, 1, 4, 8]
+        prod_upsample_scales = np.cumprod([8, 4, 2, 2])
+        spec_padded = torch.zeros(1, spec.size(0), spec.size(1))
+        spec_padded[0] = spec
+        f0_padded = torch.zeros(1, 1, f0.size(0))
+        f0_padded[0, 0] = f0
+        f0 = f0 * 1.0
+        dfs = []
+        for df, us in zip(dense_factors, prod_upsample_scales):
+            dfs += [np.repeat(dilated_factor(torch.unsqueeze(f0, dim=1).to('cpu').detach().numpy(), sr, df), us)]
+        dfs_batch = [torch.FloatTensor(np.array([d.astype(np.float32).reshape(-1, 1)])).transpose(2, 1) for d in dfs]
+        return spec_padded, torch.LongTensor([spec.size(1)]), sid, sinusoid(f0_padded), dfs_batch
+    return collate
+
+
+def main():
+    args = setupArgParser().parse_args()
+    torch.set_num_threads(1)
+    rng = np.random.default_rng(0)
+    frameNum = args.convertSize // args.hop
+    collate = legacy_collate(args.sr, args.hop)
+    builder = ExcitationBuilder(args.sr, args.hop)
+    session = VoiceChangerSession("bench")
+    spec = torch.rand(257, frameNum)
+    sid = torch.LongTensor([0])
+
+    legacyTime = 0.0
+    builderTime = 0.0
+    maxDiff = 0.0
+    for n in range(args.num):
+        f0 = 150 + 50 * rng.random(frameNum)
+        f0[rng.random(frameNum) < 0.2] = 0  # 無声フレーム
+
+        start = time.perf_counter()
+        legacy = collate(spec, sid, torch.from_numpy(f0.astype(np.float32)))
+        legacyTime += time.perf_counter() - start
+
+        start = time.perf_counter()
+        sin, d = builder.build(f0, 1.0, session, n * args.chunk)
+        builderTime += time.perf_counter() - start
+
+        assert sin.shape == legacy[3].shape, (sin.shape, legacy[3].shape)
+        for a, b in zip(d, legacy[4]):
+            assert a.shape == b.shape, (a.shape, b.shape)
+            maxDiff = max(maxDiff, float(torch.max(torch.abs(a - b) / b)))
+
+    print(f"frames:{frameNum}  legacy:{legacyTime / args.num * 1e6:9.1f} us/chunk  builder:{builderTime / args.num * 1e6:9.1f} us/chunk  "
+          f"d0..d3 max relative diff:{maxDiff:.1e}")
+
+    sineDiff, boundaryDiff = check_sine(args, rng)
+    print(f"sin max diff from the continuous reference:{sineDiff:.1e} (after chunk boundaries:{boundaryDiff:.1e}, tolerance:{SIN_TOLERANCE:.0e})")
+    failed = maxDiff > 1e-6 or sineDiff > SIN_TOLERANCE
+
+    # convert_continuos_f0: interp1d と np.interp
+    try:
+        from scipy.interpolate import interp1d
+        f0 = 150 + 50 * rng.random(frameNum * 2)
+        nz = np.where(rng.random(f0.shape[0]) > 0.3)[0]
+        x = np.arange(0, frameNum * 2 + 10)
+        start = time.perf_counter()
+        for _ in range(args.num):
+            a = interp1d(nz, f0[nz], bounds_error=False, fill_value=0.0)(x)
+        t1 = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.num):
+            b = np.interp(x, nz, f0[nz], left=0.0, right=0.0)
+        t2 = time.perf_counter() - start
+        print(f"continuous f0  interp1d:{t1 / args.num * 1e6:9.1f} us  np.interp:{t2 / args.num * 1e6:9.1f} us  max diff:{np.max(np.abs(a - b)):.1e}")
+    except ImportError:
+        print("scipy is not installed. skip interp1d comparison.")
+
+    if failed:
+        print("NG: excitation differs from the reference")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
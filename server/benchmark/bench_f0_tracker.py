@@ -0,0 +1,116 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import time
+import numpy as np
+import pyworld as pw
+
+from voice_changer.utils.RingBuffer import RingBuffer
+from voice_changer.utils.IncrementalF0 import IncrementalF0Tracker, F0_ANALYSIS_MARGIN_MS
+
+# IncrementalF0Tracker と、チャンクごとにバッファ全体を解析し直す従来方式の比較。
+# 有声/無声の一致率と、両方有声のフレームのずれ(cent)を出し、閾値を超えたら終了コード1で終わる。
+# 窓の左端は従来方式のほうが文脈不足で不正確なので、マージン分は比較から除く。
+# harvest は有声の立ち上がり付近の判定が解析区間の取り方で数フレーム揺れるので、有声/無声の不一致は数%出る。
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sr", type=int, default=44100)
+    parser.add_argument("--chunk", type=int, default=4096)
+    parser.add_argument("--window", type=int, default=4096 * 2 + 1024 * 32, help="convertSize")
+    parser.add_argument("--hop", type=int, default=512)
+    parser.add_argument("--seconds", type=float, default=8.0)
+    parser.add_argument("--detectors", type=str, default="dio,harvest")
+    parser.add_argument("--marginMs", type=float, default=0, help="override analysis margin (0: default of each detector)")
+    parser.add_argument("--maxUnvoicedMismatch", type=float, default=0.05, help="allowed ratio of voicing mismatches")
+    parser.add_argument("--maxCentsP95", type=float, default=20.0, help="allowed 95 percentile of cent deviation")
+    return parser
+
+
+def synth_voice(sr: int, seconds: float, rng: np.random.Generator):
+    # 有声区間(ビブラート付きの倍音)と無音/ノイズ区間を交互に並べる
+    n = int(sr * seconds)
+    t = np.arange(n) / sr
+    f0 = 180 + 60 * np.sin(2 * np.pi * 0.3 * t) + 8 * np.sin(2 * np.pi * 5.5 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    voiced = sum([np.sin(k * phase) / k for k in range(1, 12)])
+    gate = (np.sin(2 * np.pi * 0.4 * t) > -0.3).astype(np.float64)
+    gate = np.convolve(gate, np.ones(441) / 441, mode="same")
+    audio = 0.3 * voiced * gate + 0.003 * rng.standard_normal(n)
+    return (audio * 32767).astype(np.int16)
+
+
+def analyzer(detector: str, sr: int, hop: int):
+    framePeriod = 1000 * hop / sr if detector == "dio" else 5.5
+
+    def analyze(wav: np.ndarray):
+        wav = wav.astype(np.double)
+        if detector == "dio":
+            f0, t = pw.dio(wav, fs=sr, f0_ceil=800, frame_period=framePeriod)
+            f0 = pw.stonemask(wav, f0, t, sr)
+        else:
+            f0, t = pw.harvest(wav, fs=sr, frame_period=framePeriod, f0_floor=71.0, f0_ceil=1000.0)
+        return np.round(f0, 1)
+    return analyze, framePeriod
+
+
+def main():
+    args = setupArgParser().parse_args()
+    rng = np.random.default_rng(0)
+    audio = synth_voice(args.sr, args.seconds, rng)
+    chunks = [audio[i:i + args.chunk] for i in range(0, audio.shape[0] - args.chunk + 1, args.chunk)]
+
+    failed = False
+    for detector in args.detectors.split(","):
+        analyze, framePeriod = analyzer(detector, args.sr, args.hop)
+        marginMs = args.marginMs if args.marginMs > 0 else F0_ANALYSIS_MARGIN_MS[detector]
+        ring = RingBuffer(args.window)
+        tracker = IncrementalF0Tracker((detector,), analyze, args.sr, framePeriod, marginMs)
+        skip = int(marginMs / framePeriod) + 1
+
+        fullTime = 0.0
+        incTime = 0.0
+        mismatch = 0
+        compared = 0
+        cents = []
+        for chunk in chunks:
+            ring.append(chunk, 1.0 / 32768)
+            window = ring.latest(args.window)
+
+            start = time.perf_counter()
+            full = analyze(window)
+            fullTime += time.perf_counter() - start
+
+            start = time.perf_counter()
+            inc = tracker.update(ring, args.window)
+            incTime += time.perf_counter() - start
+
+            assert full.shape == inc.shape, (full.shape, inc.shape)
+            if ring.length < args.window:
+                continue
+            a = full[skip:]
+            b = inc[skip:]
+            mismatch += int(np.sum((a > 0) != (b > 0)))
+            compared += a.shape[0]
+            both = (a > 0) & (b > 0)
+            cents.append(np.abs(1200 * np.log2(b[both] / a[both])))
+
+        cents = np.concatenate(cents)
+        mismatchRatio = mismatch / compared
+        p95 = float(np.percentile(cents, 95)) if cents.shape[0] > 0 else 0.0
+        info = tracker.get_info()
+        print(f"{detector:8s} full:{fullTime / len(chunks) * 1000:8.2f} ms/chunk  incremental:{incTime / len(chunks) * 1000:8.2f} ms/chunk  "
+              f"analyzed:{info['analyzedSamples'] / info['requestedSamples'] * 100:5.1f}% of samples")
+        print(f"         voicing mismatch:{mismatchRatio * 100:.2f}%  cents p50:{np.percentile(cents, 50):.2f} p95:{p95:.2f} max:{cents.max():.1f}")
+        if mismatchRatio > args.maxUnvoicedMismatch or p95 > args.maxCentsP95:
+            print(f"         NG: exceeds bounds (mismatch <= {args.maxUnvoicedMismatch}, p95 <= {args.maxCentsP95})")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
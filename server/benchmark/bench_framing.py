@@ -0,0 +1,64 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import struct
+import time
+import numpy as np
+
+from voice_changer.utils.AudioFrame import decode_pcm, encode_pcm, pack_frame, unpack_frame, AudioFrameHeader
+
+# パケット1つあたりのデコード/エンコードのコスト。
+# 従来の struct.unpack -> np.array / struct.pack(*audio) と np.frombuffer / tobytes を比較する。
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="1024,4096,8192,16384", help="samples per packet")
+    parser.add_argument("--repeat", type=int, default=200, help="iterations per measurement")
+    return parser
+
+
+def legacy_decode(data: bytes):
+    return np.array(struct.unpack('<%sh' % (len(data) // struct.calcsize('<h')), data)).astype(np.int16)
+
+
+def legacy_encode(audio: np.ndarray):
+    return struct.pack('<%sh' % len(audio), *audio)
+
+
+def measure(fn, arg, repeat: int):
+    fn(arg)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(arg)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    args = setupArgParser().parse_args()
+    rng = np.random.default_rng(0)
+    header = AudioFrameHeader(sampleRate=48000, seq=1)
+
+    print(f"{'samples':>8s} {'struct dec':>12s} {'frombuffer':>12s} {'struct enc':>12s} {'tobytes':>12s} {'frame dec':>12s} {'frame enc':>12s}  (us/packet)")
+    for size in [int(x) for x in args.sizes.split(",")]:
+        audio = rng.integers(-32768, 32767, size).astype(np.int16)
+        data = audio.tobytes()
+        frame = pack_frame(audio, header)
+        assert np.array_equal(legacy_decode(data), decode_pcm(data))
+        assert legacy_encode(audio) == encode_pcm(audio)
+
+        results = [
+            measure(legacy_decode, data, args.repeat),
+            measure(decode_pcm, data, args.repeat),
+            measure(legacy_encode, audio, args.repeat),
+            measure(encode_pcm, audio, args.repeat),
+            measure(unpack_frame, frame, args.repeat),
+            measure(lambda a: pack_frame(a, header), audio, args.repeat),
+        ]
+        print(f"{size:8d} " + " ".join([f"{r:12.2f}" for r in results]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import inspect
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from voice_changer.utils.OnnxSessionFactory import OnnxSessionFactory
+from voice_changer.utils.OnnxIOBinding import OnnxIOBindingRunner, OnnxIOBindingStats
+
+# 通常の session.run(出力の確保 + max_wav_value を掛けた配列の確保)と OnnxIOBindingRunner の比較。
+# MMVCのONNXと同じ入出力(specs, lengths, sid_src, sid_tgt -> audio)の小さなモデルを書き出して使う。
+# 1チャンクあたりの時間と、Python側で確保されたメモリ(tracemalloc のピーク)を表示し、出力が一致することを確認する。
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=str, default="32,64,256", help="spec frames to test")
+    parser.add_argument("--hop", type=int, default=256)
+    parser.add_argument("--num", type=int, default=200)
+    return parser
+
+
+def export_dummy_model(path: str, hop: int):
+    import torch
+
+    class Dummy(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.pre = torch.nn.Conv1d(257, 64, 1)
+            self.emb = torch.nn.Embedding(110, 64)
+            self.up = torch.nn.ConvTranspose1d(64, 1, hop, stride=hop)
+
+        def forward(self, specs, lengths, sid_src, sid_tgt):
+            x = self.pre(specs) + self.emb(sid_tgt).unsqueeze(2) - self.emb(sid_src).unsqueeze(2)
+            x = x * (lengths > 0).float().view(-1, 1, 1)
+            return torch.tanh(self.up(x))
+
+    options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(Dummy().eval(), (torch.zeros(1, 257, 32), torch.LongTensor([32]), torch.LongTensor([0]), torch.LongTensor([1])), path,
+                      input_names=["specs", "lengths", "sid_src", "sid_tgt"], output_names=["audio"],
+                      dynamic_axes={"specs": {2: "frames"}, "audio": {2: "samples"}}, **options)
+
+
+def measure(fn, num: int):
+    fn()
+    times = []
+    for _ in range(num):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return np.mean(times) * 1e6, peak
+
+
+def main():
+    args = setupArgParser().parse_args()
+    model = os.path.join(tempfile.mkdtemp(), "dummy.onnx")
+    export_dummy_model(model, args.hop)
+    factory = OnnxSessionFactory.get_instance()
+    factory.update_setteings("onnxIntraOpThreads", 1)
+    session = factory.create(model, ["CPUExecutionProvider"])
+    maxWavValue = 32768.0
+
+    failed = False
+    for frames in [int(x) for x in args.frames.split(",")]:
+        feed = {
+            "specs": np.random.rand(1, 257, frames).astype(np.float32),
+            "lengths": np.array([frames], dtype=np.int64),
+            "sid_src": np.array([0], dtype=np.int64),
+            "sid_tgt": np.array([1], dtype=np.int64),
+        }
+        stats = OnnxIOBindingStats()
+        runner = OnnxIOBindingRunner(session, "audio", stats)
+
+        plainTime, plainBytes = measure(lambda: session.run(["audio"], feed)[0][:, 0] * maxWavValue, args.num)
+        boundTime, boundBytes = measure(lambda: runner.run(feed, maxWavValue)[0, 0], args.num)
+
+        expected = session.run(["audio"], feed)[0][0, 0] * maxWavValue
+        diff = float(np.max(np.abs(runner.run(feed, maxWavValue)[0, 0] - expected)))
+        info = stats.get_info()
+        print(f"frames:{frames:4d}  run:{plainTime:8.1f} us {plainBytes / 1024:7.1f} KiB  iobinding:{boundTime:8.1f} us {boundBytes / 1024:7.1f} KiB  "
+              f"allocations:{info['bufferAllocations']}/{info['boundRuns']}  max diff:{diff:.1e}")
+        if diff > 1e-3:
+            print("  NG: outputs differ")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
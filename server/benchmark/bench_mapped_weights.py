@@ -0,0 +1,87 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import gc
+import tempfile
+import time
+import numpy as np
+import torch
+
+from voice_changer.MMVCv13.TrainerFunctions import load_checkpoint
+from voice_changer.utils.MappedWeights import MappedWeights
+from voice_changer.utils.ProcessMemory import get_rss
+
+# 重みの読み込み時間の比較。学習用のチェックポイント(torch.load + キーごとのコピー + load_state_dict)と、
+# MappedWeights で変換した .mmw の memmap での割り当て。
+# モデルは Conv1d を重ねたもの(--sizeMB 程度)で、チェックポイントは MMVC の学習スクリプトと同じ形式(model, iteration, learning_rate, optimizer)で保存する。
+# ファイルはページキャッシュに乗った状態での比較になる。出力が一致することを確認する。
+# RSS はモデルを生成した(初期値の重みを確保した)時点からの増分で、memmap では初期値の重みが解放され、
+# 代わりにファイルのページが触られた分だけ(推論後は全体が)載る。このページはファイルに裏付けられていて、プロセス間で共有される。
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizeMB", type=int, default=160)
+    parser.add_argument("--layers", type=int, default=160, help="number of Conv1d layers (tensors: layers * 2)")
+    parser.add_argument("--num", type=int, default=5)
+    return parser
+
+
+def build_model(sizeMB: int, layers: int):
+    # Conv1d(c, c, 3) の重みは c*c*3*4 バイト
+    channels = int(np.sqrt(sizeMB * 1024 * 1024 / layers / 12))
+    return torch.nn.Sequential(*[torch.nn.Conv1d(channels, channels, 3, padding=1) for _ in range(layers)]).eval(), channels
+
+
+def measure(load, sizeMB: int, layers: int, num: int, x: torch.Tensor):
+    times = []
+    for _ in range(num):
+        model, _ = build_model(sizeMB, layers)
+        gc.collect()
+        start = time.perf_counter()
+        load(model)
+        times.append(time.perf_counter() - start)
+        del model
+    model, _ = build_model(sizeMB, layers)
+    gc.collect()
+    rss = get_rss()
+    load(model)
+    loadedRss = get_rss() - rss
+    with torch.no_grad():
+        y = model(x)
+    return np.median(times) * 1000, loadedRss / 1024 / 1024, (get_rss() - rss) / 1024 / 1024, y
+
+
+def main():
+    args = setupArgParser().parse_args()
+    torch.manual_seed(0)
+    source, channels = build_model(args.sizeMB, args.layers)
+    checkpoint = os.path.join(tempfile.mkdtemp(), "G_latest.pth")
+    torch.save({"model": source.state_dict(), "iteration": 1, "learning_rate": 2e-4, "optimizer": None}, checkpoint)
+    del source
+    x = torch.randn(1, channels, 32)
+    print(f"checkpoint: {os.path.getsize(checkpoint) / 1024 / 1024:.1f}MB, {args.layers * 2} tensors")
+
+    mappedWeights = MappedWeights.get_instance()
+    mappedWeights.configure({"mappedWeightsDir": os.path.dirname(checkpoint)})
+    model, _ = build_model(args.sizeMB, args.layers)
+    start = time.perf_counter()
+    mappedWeights.load(checkpoint, model, load_checkpoint)  # 初回: 通常の読み込み + 変換
+    print(f"first load + conversion: {(time.perf_counter() - start) * 1000:.1f}ms ({os.path.getsize(mappedWeights.mapped_path(checkpoint)) / 1024 / 1024:.1f}MB)")
+    del model
+
+    results = {}
+    results["checkpoint"] = measure(lambda m: load_checkpoint(checkpoint, m, None), args.sizeMB, args.layers, args.num, x)
+    results["mapped"] = measure(lambda m: mappedWeights.load(checkpoint, m, load_checkpoint), args.sizeMB, args.layers, args.num, x)
+    for name, (loadMs, loadedRss, inferredRss, _) in results.items():
+        print(f"{name:>10}: load {loadMs:8.1f}ms  rss {loadedRss:+7.1f}MB after load, {inferredRss:+7.1f}MB after inference")
+
+    diff = float(torch.max(torch.abs(results["checkpoint"][3] - results["mapped"][3])))
+    print(f"max diff: {diff:.1e}, mapped loads: {mappedWeights.get_info()['mappedWeightsStats']['mappedLoads']}")
+    sys.exit(1 if diff > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import time
+from dataclasses import dataclass
+import numpy as np
+
+from voice_changer.VoiceChanger import VoiceChanger
+from voice_changer.ModelLoader import ModelLoader, LOAD_STATUS_DONE, LOAD_STATUS_FAILED
+
+# バックグラウンドのモデルのロード(ModelLoader)と差し替えの確認と計測。
+# 学習済みのモデルは使わず、推論に --inferenceMs かかり、モデルごとに決まった値を出力する代わりのモデルで VoiceChanger を動かす。
+# 1. 1つ目のモデルをロードして、ロードの各段階(load, warmup, swap)の時間を表示する。
+# 2. warmup で推論が失敗するモデルをロードして、job が failed になり、前のモデルがそのまま変換を続けることを確認する(/health の値も)。
+# 3. 別のモデルのロード中もチャンクを変換し続け、ロード中のチャンクの処理時間と、ロード後に新しいモデルに切り替わったことを確認する。
+# 確認に失敗した場合は exit code 1 を返す。
+
+
+@dataclass
+class StandInSettings:
+    dstId: int = 1
+    onnxModelFile: str = ""
+    extraConvertSize: int = 0
+
+
+class StandInModel():
+    """ 推論に inferenceMs かかり、level の値を出力するモデル。fail を True にすると推論で例外を送出する。 """
+
+    def __init__(self, inferenceMs: float):
+        self.settings = StandInSettings()
+        self.inferenceMs = inferenceMs
+        self.level = 0
+        self.fail = False
+
+    def loadModel(self, config: str, pyTorchModelFile: str, onnxModelFile: str, clusterTorchModelFile: str = None):
+        # モデルのファイル名の代わりに "<level>" または "fail" を受け取る
+        self.fail = pyTorchModelFile == "fail"
+        self.level = 0 if self.fail else int(pyTorchModelFile)
+        return {}
+
+    def get_processing_sampling_rate(self):
+        return 24000
+
+    def generate_input(self, newData: np.ndarray, inputSize: int, crossfadeSize: int, session):
+        return np.zeros(inputSize + crossfadeSize, dtype=np.float32)
+
+    def inference(self, data, session):
+        if self.fail:
+            raise RuntimeError("stand-in model failed")
+        time.sleep(self.inferenceMs / 1000)
+        return np.full(data.shape[0], self.level, dtype=np.float32)
+
+    def update_setteings(self, key: str, val: any):
+        return False
+
+    def get_info(self):
+        return {"level": self.level}
+
+    def destroy(self):
+        pass
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunkSize", type=int, default=4096)
+    parser.add_argument("--inferenceMs", type=float, default=5.0, help="simulated inference time per chunk")
+    parser.add_argument("--warmupIterations", type=int, default=2)
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for a load job")
+    return parser
+
+
+def wait_job(loader: ModelLoader, jobId: str, timeout: float, onWait=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = loader.get_job(jobId)
+        if job["status"] in [LOAD_STATUS_DONE, LOAD_STATUS_FAILED]:
+            return job
+        if onWait is not None:
+            onWait()
+        else:
+            time.sleep(0.01)
+    raise RuntimeError(f"load job {jobId} did not finish")
+
+
+def convert_level(vc: VoiceChanger, chunk: np.ndarray):
+    """ チャンクを変換して、出力の値(どのモデルで変換されたか)を返す。 """
+    out = vc.on_request(chunk)[0]
+    return int(np.median(out)) if out.shape[0] > 0 else None
+
+
+def main():
+    args = setupArgParser().parse_args()
+    VoiceChanger._create_model = lambda self: StandInModel(args.inferenceMs)
+    vc = VoiceChanger({"modelCacheBudgetMB": 0})
+    vc.settings.warmupIterations = args.warmupIterations
+    loader = ModelLoader(lambda job, *loadArgs: vc.loadModel(*loadArgs, job))
+    chunk = (np.random.default_rng(0).standard_normal(args.chunkSize) * 3000).astype(np.int16)
+    failures = []
+
+    def check(ok: bool, msg: str):
+        print(f"  {'OK' if ok else 'NG'}: {msg}")
+        if not ok:
+            failures.append(msg)
+
+    print("load:")
+    job = wait_job(loader, loader.submit("config", "1000", None, None).jobId, args.timeout)
+    print(f"  load:{job['loadTime']:.3f}sec warmup:{job['warmupTime']:.3f}sec swap:{job['swapTime']:.3f}sec total:{job['totalTime']:.3f}sec")
+    check(job["status"] == LOAD_STATUS_DONE, f"job {job['status']}")
+    check(vc.get_health()["ready"], "ready after the load")
+    for _ in range(3):
+        level = convert_level(vc, chunk)
+    check(level == 1000, f"converted by the loaded model ({level})")
+
+    print("warmup failure:")
+    generation = vc.get_health()["modelGeneration"]
+    job = wait_job(loader, loader.submit("config", "fail", None, None).jobId, args.timeout)
+    health = vc.get_health()
+    check(job["status"] == LOAD_STATUS_FAILED, f"job {job['status']} ({job['error']})")
+    check(health["modelGeneration"] == generation, f"model not swapped (generation {generation} -> {health['modelGeneration']})")
+    check(health["ready"] and health["loadError"] != "", f"still ready, error reported ({health['loadError']})")
+    level = convert_level(vc, chunk)
+    check(level == 1000, f"previous model keeps serving ({level})")
+
+    print("convert during a load:")
+    times, levels = [], []
+
+    def convert():
+        start = time.perf_counter()
+        levels.append(convert_level(vc, chunk))
+        times.append(time.perf_counter() - start)
+    job = wait_job(loader, loader.submit("config", "2000", None, None).jobId, args.timeout, convert)
+    print(f"  chunks during the load: {len(times)}, p50 {np.percentile(times, 50) * 1000:.2f}ms, max {max(times) * 1000:.2f}ms"
+          if len(times) > 0 else "  chunks during the load: 0")
+    check(job["status"] == LOAD_STATUS_DONE, f"job {job['status']}")
+    check(all([x in [1000, 2000, 0] for x in levels]), "chunks during the load converted by one of the models")
+    for _ in range(3):
+        level = convert_level(vc, chunk)
+    health = vc.get_health()
+    check(level == 2000, f"converted by the new model ({level})")
+    check(health["ready"] and health["loadError"] == "", "ready and the load error cleared")
+
+    if len(failures) > 0:
+        print(f"NG: {len(failures)} checks failed")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import inspect
+import tempfile
+import time
+import numpy as np
+import onnxruntime
+
+from voice_changer.utils.OnnxSessionFactory import OnnxSessionFactory
+
+# OnnxSessionFactory の設定(スレッド数, 実行モード, 最適化レベル)ごとの CPU 推論時間の比較。
+# --model でモデルを指定しない場合は、Conv1dを重ねた小さなモデルを torch から ONNX に書き出して使う。
+# 入力の形は --shapes (名前=次元xを区切り) で指定する。指定しない次元(動的な次元)は --frames を使う。
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default=None, help="onnx model file")
+    parser.add_argument("--frames", type=int, default=64, help="size of dynamic dimensions")
+    parser.add_argument("--threads", type=str, default="0,1,2,4,8", help="intra-op threads to test")
+    parser.add_argument("--modes", type=str, default="sequential,parallel")
+    parser.add_argument("--optimizations", type=str, default="basic,all")
+    parser.add_argument("--num", type=int, default=50)
+    return parser
+
+
+def export_dummy_model(path: str):
+    import torch
+
+    class Dummy(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            layers = [torch.nn.Conv1d(192, 192, 5, padding=2) for _ in range(8)]
+            self.layers = torch.nn.ModuleList(layers)
+
+        def forward(self, x):
+            for layer in self.layers:
+                x = torch.tanh(layer(x)) + x
+            return x
+
+    # torch 2.5以降は dynamo の exporter が既定なので、従来の exporter を明示する
+    options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(Dummy().eval(), torch.zeros(1, 192, 64), path, input_names=["x"], output_names=["y"],
+                      dynamic_axes={"x": {2: "frames"}, "y": {2: "frames"}}, **options)
+
+
+def make_inputs(session: onnxruntime.InferenceSession, frames: int):
+    types = {"tensor(float)": np.float32, "tensor(int64)": np.int64, "tensor(int32)": np.int32}
+    inputs = {}
+    for i in session.get_inputs():
+        shape = [d if isinstance(d, int) else frames for d in i.shape]
+        dtype = types.get(i.type, np.float32)
+        inputs[i.name] = np.zeros(shape, dtype=dtype) if dtype != np.float32 else np.random.rand(*shape).astype(dtype)
+    return inputs
+
+
+def main():
+    args = setupArgParser().parse_args()
+    model = args.model
+    if model is None:
+        model = os.path.join(tempfile.mkdtemp(), "dummy.onnx")
+        export_dummy_model(model)
+
+    factory = OnnxSessionFactory.get_instance()
+    print(f"{'threads':>7} {'mode':>10} {'optimization':>12} {'mean[ms]':>9} {'p95[ms]':>8}")
+    for optimization in args.optimizations.split(","):
+        for mode in args.modes.split(","):
+            for threads in [int(x) for x in args.threads.split(",")]:
+                factory.update_setteings("onnxIntraOpThreads", threads)
+                factory.update_setteings("onnxInterOpThreads", threads)
+                factory.update_setteings("onnxExecutionMode", mode)
+                factory.update_setteings("onnxGraphOptimization", optimization)
+                session = factory.create(model, ["CPUExecutionProvider"])
+                inputs = make_inputs(session, args.frames)
+                for _ in range(3):
+                    session.run(None, inputs)
+                times = []
+                for _ in range(args.num):
+                    start = time.perf_counter()
+                    session.run(None, inputs)
+                    times.append(time.perf_counter() - start)
+                times = np.array(times) * 1000
+                print(f"{threads:7d} {mode:>10} {optimization:>12} {np.mean(times):9.2f} {np.percentile(times, 95):8.2f}")
+
+
+if __name__ == '__main__':
+    main()
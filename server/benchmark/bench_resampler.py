@@ -0,0 +1,96 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import time
+import numpy as np
+
+from voice_changer.utils.StreamResampler import StreamResampler, RESAMPLE_QUALITIES
+
+# 現状の「チャンクごとに resampy.resample / librosa.resample を呼ぶ」方式と StreamResampler の比較。
+# 速度(us/chunk)に加えて、ファイル全体を一度にリサンプルした結果との差(チャンク境界の歪み)と、
+# 入力の正弦波を出力のサンプリングレートで直接計算した理想の出力に対する SNR(フィルタの品質)を出す。
+# resampy / librosa はインストールされていなければ飛ばす(StreamResampler だけなら numpy だけで実行できる)。
+
+TONES = [(220, 0.3), (1000, 0.2), (3500, 0.1)]  # (Hz, 振幅)。16kHz でもナイキスト周波数より十分低い
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunk", type=int, default=4096, help="chunk size (samples of source rate)")
+    parser.add_argument("--chunks", type=int, default=50, help="number of chunks")
+    parser.add_argument("--pairs", type=str, default="48000:44100,24000:44100,44100:48000,44100:16000", help="src:dst,...")
+    return parser
+
+
+def per_call_methods():
+    methods = {}
+    try:
+        import resampy
+        for q in ["kaiser_fast", "kaiser_best"]:
+            methods[f"resampy/{q}"] = (lambda q: lambda x, src, dst: resampy.resample(x, src, dst, filter=q))(q)
+    except ImportError:
+        print("resampy is not installed. skip.")
+    try:
+        import librosa
+        methods["librosa/default"] = lambda x, src, dst: librosa.resample(x, orig_sr=src, target_sr=dst)
+    except ImportError:
+        print("librosa is not installed. skip.")
+    return methods
+
+
+def tones(times: np.ndarray):
+    return sum([amp * np.sin(2 * np.pi * freq * times) for freq, amp in TONES])
+
+
+def snr_db(out: np.ndarray, dst: int, delaySec: float):
+    """ 理想の出力(delaySec 遅れた正弦波)に対する SNR。先頭と末尾の過渡部分は除く。 """
+    ideal = tones(np.arange(out.shape[0]) / dst - delaySec)
+    margin = out.shape[0] // 10
+    noise = np.mean((out[margin:-margin] - ideal[margin:-margin]) ** 2)
+    return float(10 * np.log10(np.mean(ideal[margin:-margin] ** 2) / max(noise, 1e-300)))
+
+
+def boundary_error(chunked: np.ndarray, whole: np.ndarray, delay: int):
+    # 先頭と末尾の過渡部分を除いて比較する
+    n = min(chunked.shape[0] - delay, whole.shape[0])
+    margin = n // 20
+    a = chunked[delay + margin:delay + n - margin]
+    b = whole[margin:n - margin]
+    return float(np.max(np.abs(a - b)))
+
+
+def main():
+    args = setupArgParser().parse_args()
+    methods = per_call_methods()
+
+    for pair in args.pairs.split(","):
+        src, dst = [int(x) for x in pair.split(":")]
+        t = np.arange(args.chunk * args.chunks) / src
+        signal = tones(t)
+        chunks = np.split(signal, args.chunks)
+        print(f"{src} -> {dst}, chunk:{args.chunk}")
+
+        for name, fn in methods.items():
+            start = time.perf_counter()
+            outs = [fn(c, src, dst) for c in chunks]
+            elapsed = time.perf_counter() - start
+            err = boundary_error(np.concatenate(outs), fn(signal, src, dst), 0)
+            print(f"  {name:22s} {elapsed / args.chunks * 1e6:10.1f} us/chunk, max diff from one-shot:{err:.2e}, "
+                  f"snr:{snr_db(np.concatenate(outs), dst, 0.0):6.1f}dB")
+
+        for q in RESAMPLE_QUALITIES.keys():
+            start = time.perf_counter()
+            resampler = StreamResampler(src, dst, q)
+            outs = [resampler.resample(c) for c in chunks]
+            elapsed = time.perf_counter() - start
+            whole = StreamResampler(src, dst, q).resample(signal)
+            err = boundary_error(np.concatenate(outs), whole, 0)
+            snr = snr_db(np.concatenate(outs), dst, resampler.filter.delay / src)
+            print(f"  {'stream/' + q:22s} {elapsed / args.chunks * 1e6:10.1f} us/chunk, max diff from one-shot:{err:.2e}, "
+                  f"snr:{snr:6.1f}dB, latency:{resampler.filter.delay / src * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+
+from voice_changer.utils.RingBuffer import RingBuffer
+
+# generate_input で使っていた concat + slice 方式と RingBuffer 方式の比較。
+# tracemalloc で1チャンクあたりに確保された numpy バッファ(ヘッダ等の小さいオブジェクトを除く)を数える。
+ALLOCATION_THRESHOLD = 1024  # bytes. これより大きな一時確保を「バッファ確保」とみなす
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunk", type=int, default=4096, help="chunk size (samples)")
+    parser.add_argument("--crossfade", type=int, default=4096, help="crossFadeOverlapSize")
+    parser.add_argument("--extra", type=int, default=1024 * 32, help="extraConvertSize")
+    parser.add_argument("--hop", type=int, default=512, help="hop length")
+    parser.add_argument("--chunks", type=int, default=2000, help="number of chunks")
+    return parser
+
+
+def legacy_step(state, newData, convertSize):
+    newData = newData.astype(np.float32) / 32768.0
+    if state["audio_buffer"] is not None:
+        state["audio_buffer"] = np.concatenate([state["audio_buffer"], newData], 0)
+    else:
+        state["audio_buffer"] = newData
+    state["audio_buffer"] = state["audio_buffer"][-1 * convertSize:]
+    return state["audio_buffer"]
+
+
+def ring_step(state, newData, convertSize):
+    if state["audio_buffer"] is None:
+        state["audio_buffer"] = RingBuffer(convertSize)
+    state["audio_buffer"].ensure_capacity(convertSize)
+    state["audio_buffer"].append(newData, 1.0 / 32768.0)
+    return state["audio_buffer"].latest(convertSize)
+
+
+def run(step, chunks, convertSize, measureAllocation):
+    state = {"audio_buffer": None}
+    allocations = 0
+    allocatedBytes = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        if measureAllocation:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+        step(state, chunk, convertSize)
+        if measureAllocation:
+            _, peak = tracemalloc.get_traced_memory()
+            if peak - before > ALLOCATION_THRESHOLD:
+                allocations += 1
+                allocatedBytes += peak - before
+    elapsed = time.perf_counter() - start
+    return elapsed, allocations, allocatedBytes
+
+
+def main():
+    args = setupArgParser().parse_args()
+    convertSize = args.chunk + args.crossfade + args.extra
+    if convertSize % args.hop != 0:
+        convertSize = convertSize + (args.hop - (convertSize % args.hop))
+
+    rng = np.random.default_rng(0)
+    chunks = [rng.integers(-32768, 32767, args.chunk).astype(np.int16) for _ in range(args.chunks)]
+    warmup = 4  # 最初の数チャンクはバッファが満ちるまでの確保を含むので除外する
+
+    print(f"chunk:{args.chunk} convertSize:{convertSize} chunks:{args.chunks}")
+    for name, step in [("concat", legacy_step), ("ring", ring_step)]:
+        elapsed, _, _ = run(step, chunks, convertSize, False)
+
+        tracemalloc.start()
+        state = {"audio_buffer": None}
+        for chunk in chunks[:warmup]:
+            step(state, chunk, convertSize)
+        _, allocations, allocatedBytes = run(lambda s, c, cs: step(state, c, cs), chunks[warmup:], convertSize, True)
+        tracemalloc.stop()
+
+        measured = len(chunks) - warmup
+        print(f"  {name:7s} {elapsed / len(chunks) * 1e6:8.2f} us/chunk, "
+              f"allocations/chunk:{allocations / measured:.2f}, bytes/chunk:{allocatedBytes / measured:.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import time
+import numpy as np
+import torch
+
+from voice_changer.utils.RingBuffer import RingBuffer
+from voice_changer.utils.StreamingSpectrogram import StreamingSpectrogram
+from voice_changer.MMVCv13.TrainerFunctions import spectrogram_torch
+
+# StreamingSpectrogram と、チャンクごとにバッファ全体を spectrogram_torch にかける従来方式の比較。
+# 全チャンクで結果が一致する(差が --tolerance 以下)ことを確認し、一致しなければ終了コード1で終わる。
+# チャンク長が hop の倍数でない場合(内側のフレームを使い回せない場合)も含めて確認する。
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filter_length", type=int, default=512)
+    parser.add_argument("--hop_length", type=int, default=128)
+    parser.add_argument("--win_length", type=int, default=512)
+    parser.add_argument("--window", type=int, default=8192, help="convertSize")
+    parser.add_argument("--chunks", type=str, default="1024,4096,1000", help="chunk sizes to test")
+    parser.add_argument("--num", type=int, default=100, help="chunks per test")
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    return parser
+
+
+def main():
+    args = setupArgParser().parse_args()
+    torch.set_num_threads(1)
+    rng = np.random.default_rng(0)
+
+    failed = False
+    for chunkSize in [int(x) for x in args.chunks.split(",")]:
+        ring = RingBuffer(args.window)
+        spectrogram = StreamingSpectrogram(args.filter_length, args.hop_length, args.win_length)
+        fullTime = 0.0
+        streamTime = 0.0
+        maxDiff = 0.0
+        for _ in range(args.num):
+            ring.append((0.3 * rng.standard_normal(chunkSize)).clip(-1, 1))
+
+            start = time.perf_counter()
+            full = spectrogram_torch(torch.FloatTensor(ring.latest(args.window)).unsqueeze(0), args.filter_length, 24000,
+                                     args.hop_length, args.win_length, center=False).squeeze(0)
+            fullTime += time.perf_counter() - start
+
+            start = time.perf_counter()
+            stream = spectrogram.update(ring, args.window)
+            streamTime += time.perf_counter() - start
+
+            assert full.shape == stream.shape, (full.shape, stream.shape)
+            maxDiff = max(maxDiff, float(torch.max(torch.abs(full - stream))))
+
+        info = spectrogram.get_info()
+        print(f"chunk:{chunkSize:6d} full:{fullTime / args.num * 1e6:9.1f} us/chunk  streaming:{streamTime / args.num * 1e6:9.1f} us/chunk  "
+              f"computed frames:{info['computedFrames'] / info['requestedFrames'] * 100:5.1f}%  max diff:{maxDiff:.2e}")
+        if maxDiff > args.tolerance:
+            print(f"  NG: max diff exceeds {args.tolerance}")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
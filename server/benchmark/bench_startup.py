@@ -0,0 +1,85 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import subprocess
+import numpy as np
+
+from misc.import_report import STARTUP_MODULES, HEAVY_MODULES, SERVER_DIR, profile_imports
+
+# サーバプロセスの起動時間(モデルのロード前まで)の計測。
+# 新しいインタプリタで MMVCServerSIO のサーバプロセスと同じモジュールを読み込み、VoiceChangerManager を作るまでの時間を --num 回測って中央値を表示する。
+# 中央値が --budgetMs を超えた場合と、起動時に重いモジュール(torch, onnxruntime など)が読み込まれた場合は exit code 1 を返す。
+# 参考として、起動時に読み込まなくなった重いモジュールの読み込み時間(モデルのロード時にかかる分)も表示する。
+
+STARTUP_CODE = """
+import sys
+import time
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    try:
+        __import__(name)
+    except ImportError as e:
+        print(f"SKIP {name}: {e}")
+from voice_changer.VoiceChangerManager import VoiceChangerManager
+VoiceChangerManager.get_instance({})
+print(f"ELAPSED {(time.perf_counter() - start) * 1000}")
+print(f"LOADED {','.join([x for x in HEAVY if x in sys.modules])}")
+"""
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num", type=int, default=5)
+    parser.add_argument("--budgetMs", type=float, default=1000, help="fail if the median startup time exceeds this")
+    return parser
+
+
+def run_startup():
+    code = f"HEAVY = {HEAVY_MODULES!r}\n" + STARTUP_CODE
+    proc = subprocess.run([sys.executable, "-c", code] + STARTUP_MODULES, cwd=SERVER_DIR, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(proc.stderr)
+        raise RuntimeError("startup failed")
+    elapsed, loaded, skipped = 0.0, [], []
+    for line in proc.stdout.splitlines():
+        if line.startswith("ELAPSED "):
+            elapsed = float(line[len("ELAPSED "):])
+        elif line.startswith("LOADED "):
+            loaded = [x for x in line[len("LOADED "):].split(",") if x != ""]
+        elif line.startswith("SKIP "):
+            skipped.append(line)
+    return elapsed, loaded, skipped
+
+
+def main():
+    args = setupArgParser().parse_args()
+    results = [run_startup() for _ in range(args.num)]
+    times = [r[0] for r in results]
+    loaded = sorted(set(sum([r[1] for r in results], [])))
+    for skipped in results[0][2]:
+        print(f"  {skipped} (not installed; measured without it)")
+    median = float(np.median(times))
+    print(f"startup: median {median:.1f}ms, min {min(times):.1f}ms, max {max(times):.1f}ms (budget {args.budgetMs:.0f}ms)")
+    print(f"heavy modules at startup: {loaded if len(loaded) > 0 else 'none'}")
+
+    # 参考: モデルのロード時まで遅らせたモジュールの読み込み時間
+    entries, failures = profile_imports([[x] for x in HEAVY_MODULES])
+    for name, phase in zip(HEAVY_MODULES, entries):
+        top = [cumulative for _, cumulative, depth, module in phase if depth == 0 and module == name]
+        if any([x.startswith(f"FAILED {name}:") for x in failures]):
+            print(f"  deferred {name:>12}: (not available)")
+        elif len(top) == 0:
+            print(f"  deferred {name:>12}: (already imported)")
+        else:
+            print(f"  deferred {name:>12}: {top[0] / 1000:8.1f}ms")
+
+    failed = median > args.budgetMs or len(loaded) > 0
+    if failed:
+        print("NG: startup exceeded the budget or imported heavy modules")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
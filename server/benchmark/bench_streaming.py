@@ -0,0 +1,383 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import gc
+import itertools
+import json
+import platform
+import tempfile
+import tracemalloc
+import traceback
+import wave
+from collections import defaultdict
+import numpy as np
+import torch
+
+import const
+from voice_changer.VoiceChanger import VoiceChanger
+from voice_changer.utils.ContentEncoderRegistry import ContentEncoderRegistry
+from voice_changer.utils.LatencyMetrics import LatencyMetrics, STAGE_TOTAL
+from voice_changer.utils.ProcessMemory import get_rss, get_peak_rss
+
+# VoiceChanger.on_request をストリーミングと同じようにチャンクごとに呼び、
+# チャンクサイズ, crossFadeOverlapSize, extraConvertSize, 入力のサンプリングレートの組み合わせごとに
+# 段階ごとの処理時間(LatencyMetrics の stage)の分位点, 実時間比(RTF), Python側の確保メモリ(tracemalloc), RSS を JSON で出力する。
+#
+# モデルは学習済みの重みを使わず、各モデルの種類の小さな設定ファイルとランダムな初期値の重みで作る(CPUのみ)。
+# チェックポイントには重みを入れず、各モデルの load_checkpoint が足りない重みを初期値のままにするのを利用する(DDSP-SVC は重みも保存する)。
+# コンテンツエンコーダ(hubert/units)は同じ形の出力を返す小さな畳み込みを ContentEncoderRegistry に先に登録して、モデルにそれを借りさせる。
+# DDSP-SVC の enhancer(学習済みの nsf-hifigan)は読み込めないので、enhancer を通さずに計測する。
+# 外部のリポジトリ(MMVC_Client, so-vits-svc-40 など)がなく読み込めないモデルは skipped に理由を出して飛ばす。
+#
+# --compare BASE.json で前回の結果と比べ、段階ごとの分位点, RTF, チャンクごとの確保メモリが --threshold を超えて悪化した組み合わせを表示して終了コード1を返す。
+# --compare BASE.json NEW.json の場合は実行せずに2つの結果を比べる。
+# peakRssMB はプロセス全体の最大値なので、モデルの種類ごとにきれいに測る場合は --models で1種類ずつ実行する。
+
+MODEL_TYPES = ["MMVCv13", "MMVCv15", "so-vits-svc-40", "so-vits-svc-40v2", "DDSP-SVC"]
+TINY_ENCODER_PATH = "tiny-random-encoder"
+PERCENTILES = [50, 90, 99]
+GRID_KEYS = ["model", "chunkSize", "crossFadeOverlapSize", "extraConvertSize", "inputSampleRate"]
+
+MMVC_DATA = {"sampling_rate": 24000, "filter_length": 512, "hop_length": 128, "win_length": 512, "max_wav_value": 32768.0, "n_speakers": 8}
+SOVITS_CONFIG = {
+    "data": {"sampling_rate": 44100, "filter_length": 2048, "hop_length": 512, "win_length": 2048, "max_wav_value": 32768.0},
+    "train": {"segment_size": 10240},
+    "model": {"inter_channels": 16, "hidden_channels": 16, "filter_channels": 32, "n_heads": 2, "n_layers": 1, "kernel_size": 3,
+              "p_dropout": 0.1, "resblock": "1", "resblock_kernel_sizes": [3], "resblock_dilation_sizes": [[1, 3, 5]],
+              "upsample_rates": [8, 8, 2, 2, 2], "upsample_initial_channel": 64, "upsample_kernel_sizes": [16, 16, 4, 4, 4],
+              "n_layers_q": 1, "use_spectral_norm": False, "gin_channels": 16, "ssl_dim": 256, "n_speakers": 2},
+    "spk": {"tiny": 0},
+}
+TINY_CONFIGS = {
+    "MMVCv13": {
+        "data": MMVC_DATA,
+        "train": {"segment_size": 8192},
+        "model": {"inter_channels": 16, "hidden_channels": 16, "filter_channels": 32, "n_heads": 2, "n_layers": 1, "kernel_size": 3,
+                  "p_dropout": 0.1, "resblock": "1", "resblock_kernel_sizes": [3], "resblock_dilation_sizes": [[1, 3, 5]],
+                  "upsample_rates": [8, 4, 2, 2], "upsample_initial_channel": 32, "upsample_kernel_sizes": [16, 8, 4, 4],
+                  "n_flow": 1, "n_layers_q": 1, "use_spectral_norm": False, "gin_channels": 8},
+    },
+    "MMVCv15": {
+        "data": MMVC_DATA,
+        "train": {"segment_size": 8192},
+        "model": {"inter_channels": 16, "hidden_channels": 16, "upsample_rates": [8, 4, 2, 2], "upsample_initial_channel": 32,
+                  "upsample_kernel_sizes": [16, 8, 4, 4], "n_flow": 1, "gin_channels": 8},
+        "requires_grad": {"pe": False, "flow": False, "text_enc": False, "dec": False},
+    },
+    "so-vits-svc-40": SOVITS_CONFIG,
+    "so-vits-svc-40v2": SOVITS_CONFIG,
+    "DDSP-SVC": {
+        # DDSP-SVC は yaml で読むが、JSON は yaml としても読める
+        "data": {"sampling_rate": 44100, "block_size": 512, "encoder": "hubertsoft", "encoder_sample_rate": 16000,
+                 "encoder_hop_size": 320, "encoder_out_channels": 256, "duration": 2},
+        "model": {"type": "Sins", "n_harmonics": 16, "n_mag_allpass": 16, "n_mag_harmonic": 16, "n_mag_noise": 16, "n_spk": 1},
+        "enhancer": {"type": "none"},
+    },
+}
+
+
+class TinyHubert(torch.nn.Module):
+    """ so-vits-svc の get_hubert_content から呼ばれる hubert の代わり。16kHz の 400 サンプル窓, 320 サンプルごとに1フレーム。 """
+
+    def __init__(self, channels: int = 64, outChannels: int = 256):
+        super().__init__()
+        self.conv = torch.nn.Conv1d(1, channels, 400, stride=320)
+        self.final_proj = torch.nn.Linear(channels, outChannels)
+
+    def extract_features(self, source, padding_mask=None, output_layer=None):
+        return (self.conv(source.unsqueeze(1)).transpose(1, 2), None)
+
+
+class TinyUnitsEncoder(torch.nn.Module):
+    """ DDSP-SVC の Units_Encoder の代わり。encode は (1, サンプル数 // hop + 1, 256) を返す。 """
+
+    def __init__(self, outChannels: int = 256):
+        super().__init__()
+        self.outChannels = outChannels
+        self.proj = torch.nn.Linear(1, outChannels)
+
+    def encode(self, audio, sampleRate, hopSize):
+        with torch.no_grad():
+            frames = torch.nn.functional.pad(audio, (0, hopSize))[:, :(audio.shape[-1] // hopSize + 1) * hopSize]
+            return self.proj(frames.reshape(1, -1, hopSize).mean(-1, keepdim=True))
+
+
+class PassThroughEnhancer():
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def enhance(self, audio, sampleRate, f0, blockSize, adaptive_key=0):
+        return audio, sampleRate
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, default=",".join(MODEL_TYPES))
+    parser.add_argument("--wav", type=str, default="", help="16bit PCM wav. default: synthetic voice-like signal")
+    parser.add_argument("--seconds", type=float, default=8.0, help="length of the input (the wav is looped or cut)")
+    parser.add_argument("--chunkSizes", type=str, default="4096,8192")
+    parser.add_argument("--crossFadeOverlapSizes", type=str, default="1024,4096")
+    parser.add_argument("--extraConvertSizes", type=str, default="0,8192", help="only for models that have extraConvertSize")
+    parser.add_argument("--inputSampleRates", type=str, default="24000,48000")
+    parser.add_argument("--skipChunks", type=int, default=3, help="chunks excluded from the statistics at the start of each run")
+    parser.add_argument("--allocChunks", type=int, default=10, help="chunks converted under tracemalloc after the timed run")
+    parser.add_argument("--output", type=str, default="", help="write the result JSON to this file (default: stdout)")
+    parser.add_argument("--compare", type=str, nargs="+", default=[], help="BASE.json [NEW.json]")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative increase reported as a regression")
+    parser.add_argument("--minDiffMs", type=float, default=0.5, help="ignore latency differences smaller than this")
+    return parser
+
+
+def parse_ints(val: str):
+    return [int(x) for x in val.split(",") if x.strip() != ""]
+
+
+def load_wav(path: str):
+    with wave.open(path, "rb") as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f"only 16bit PCM is supported: {path}")
+        data = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16).reshape(-1, f.getnchannels())
+        return data.mean(axis=1), f.getframerate()
+
+
+def synthesize_voice(seconds: float, sampleRate: int):
+    """ 声の代わりの信号。f0 がゆっくり動く倍音と雑音で、0.25秒の無音を挟む(SilenceGate も通るように)。 """
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sampleRate)) / sampleRate
+    f0 = 160 + 60 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sampleRate
+    voice = sum([np.sin(phase * k) / k for k in range(1, 8)])
+    voice = voice * (0.6 + 0.4 * np.sin(2 * np.pi * 3 * t)) + 0.05 * rng.standard_normal(t.shape[0])
+    voice[(t % 2.0) > 1.75] = 0
+    return voice / np.max(np.abs(voice)) * 12000, sampleRate
+
+
+def prepare_input(args, sampleRate: int):
+    if args.wav != "":
+        source, sourceRate = load_wav(args.wav)
+    else:
+        source, sourceRate = synthesize_voice(args.seconds, sampleRate)
+    # 入力の準備なので線形補間で十分
+    num = int(args.seconds * sampleRate)
+    positions = np.arange(num) * sourceRate / sampleRate % source.shape[0]
+    return np.interp(positions, np.arange(source.shape[0]), source).astype(np.int16)
+
+
+def write_tiny_model(modelType: str, workDir: str):
+    """ 小さな設定ファイルと重みを空にしたチェックポイントを書き出して (config, checkpoint) を返す。 """
+    modelDir = os.path.join(workDir, modelType)
+    os.makedirs(modelDir, exist_ok=True)
+    config = TINY_CONFIGS[modelType]
+    checkpoint = os.path.join(modelDir, "G_tiny.pth")
+    if modelType == "DDSP-SVC":
+        configFile = os.path.join(modelDir, "config.yaml")  # ddsp.vocoder.load_model はモデルと同じフォルダの config.yaml を読む
+        import ddsp.vocoder as vo
+        data, model = config["data"], config["model"]
+        net = vo.Sins(sampling_rate=data["sampling_rate"], block_size=data["block_size"], n_harmonics=model["n_harmonics"],
+                      n_mag_allpass=model["n_mag_allpass"], n_mag_noise=model["n_mag_noise"],
+                      n_unit=data["encoder_out_channels"], n_spk=model["n_spk"])
+        torch.save({"model": net.state_dict()}, checkpoint)
+    else:
+        configFile = os.path.join(modelDir, "config.json")
+        emptyParts = {"pe": {}, "flow": {}, "text_enc": {}, "dec": {}, "emb_g": {}} if modelType == "MMVCv15" else {}
+        torch.save({"model": {}, "iteration": 0, "learning_rate": 0.0, "optimizer": None, **emptyParts}, checkpoint)
+    with open(configFile, "w") as f:
+        json.dump(config, f)
+    return configFile, checkpoint
+
+
+def borrow_tiny_encoder(modelType: str):
+    """ モデルが借りるのと同じキーで小さなエンコーダを登録しておく。戻り値は後で release するもの。 """
+    registry = ContentEncoderRegistry.get_instance()
+    if modelType.startswith("so-vits-svc"):
+        return registry.borrow("hubert", TINY_ENCODER_PATH, "cpu", lambda: TinyHubert().eval())
+    if modelType == "DDSP-SVC":
+        data = TINY_CONFIGS[modelType]["data"]
+        return registry.borrow("units", TINY_ENCODER_PATH, "cpu", lambda: TinyUnitsEncoder().eval(),
+                               data["encoder"], data["encoder_sample_rate"], data["encoder_hop_size"])
+    return None
+
+
+def summarize(values: list, scale: float = 1000.0, unit: str = "Ms"):
+    values = np.array(values) * scale
+    if values.shape[0] == 0:
+        return {"count": 0}
+    info = {"count": int(values.shape[0]), f"mean{unit}": float(values.mean()), f"max{unit}": float(values.max())}
+    for p in PERCENTILES:
+        info[f"p{p}{unit}"] = float(np.percentile(values, p))
+    return info
+
+
+def run_case(vc: VoiceChanger, case: dict, audio: np.ndarray, args, caseId: int):
+    metrics = LatencyMetrics.get_instance()
+    sessionId = f"bench-{caseId}"
+    samples = defaultdict(list)
+
+    def listener(stage: str, secs: float, sid: str):
+        if sid == sessionId:
+            samples[stage].append(secs)
+
+    chunkSize = case["chunkSize"]
+    chunks = [audio[i:i + chunkSize] for i in range(0, audio.shape[0] - chunkSize + 1, chunkSize)]
+    metrics.add_listener(listener)
+    try:
+        for i, chunk in enumerate(chunks):
+            if i == args.skipChunks:
+                samples.clear()
+            vc.on_request(chunk, sessionId)
+    finally:
+        metrics.remove_listener(listener)
+
+    # 確保メモリは計測が遅くなるので、時間を測るのとは別に少しだけ流す
+    chunkPeaks = []
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    for chunk in chunks[:args.allocChunks]:
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        vc.on_request(chunk, sessionId)
+        chunkPeaks.append(tracemalloc.get_traced_memory()[1] - current)
+    growth = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    vc.release_session(sessionId)
+
+    chunkSecs = chunkSize / case["inputSampleRate"]
+    return {
+        **case,
+        "chunks": len(samples[STAGE_TOTAL]),
+        "stages": {stage: summarize(values) for stage, values in samples.items()},
+        "rtf": summarize([x / chunkSecs for x in samples[STAGE_TOTAL]], 1.0, ""),
+        "alloc": {"chunkPeakKB": summarize(chunkPeaks, 1 / 1024, "KB"), "growthKB": growth / 1024},
+        "rssMB": get_rss() / 1024 / 1024,
+        "peakRssMB": get_peak_rss() / 1024 / 1024,
+    }
+
+
+def run_model(modelType: str, args, workDir: str, caseIds: itertools.count):
+    const.setModelType(modelType)
+    configFile, checkpoint = write_tiny_model(modelType, workDir)
+    encoder = borrow_tiny_encoder(modelType)
+    if modelType == "DDSP-SVC":
+        import voice_changer.DDSP_SVC.DDSP_SVC as ddspModule
+        ddspModule.Enhancer = PassThroughEnhancer
+    vc = VoiceChanger({"hubert": TINY_ENCODER_PATH, "modelCacheBudgetMB": 0})
+    torch.manual_seed(0)
+    try:
+        vc.loadModel(configFile, checkpoint, None)
+        extraConvertSizes = parse_ints(args.extraConvertSizes) if hasattr(vc.voiceChanger.settings, "extraConvertSize") else [None]
+        results = []
+        for inputSampleRate in parse_ints(args.inputSampleRates):
+            vc.update_setteings("inputSampleRate", inputSampleRate)
+            audio = prepare_input(args, inputSampleRate)
+            for chunkSize, crossFadeOverlapSize, extraConvertSize in itertools.product(
+                    parse_ints(args.chunkSizes), parse_ints(args.crossFadeOverlapSizes), extraConvertSizes):
+                vc.update_setteings("crossFadeOverlapSize", crossFadeOverlapSize)
+                if extraConvertSize is not None:
+                    vc.update_setteings("extraConvertSize", extraConvertSize)
+                case = {"model": modelType, "chunkSize": chunkSize, "crossFadeOverlapSize": crossFadeOverlapSize,
+                        "extraConvertSize": extraConvertSize, "inputSampleRate": inputSampleRate}
+                result = run_case(vc, case, audio, args, next(caseIds))
+                print(f"{format_case(result)}: total p50 {result['stages'][STAGE_TOTAL]['p50Ms']:.1f}ms "
+                      f"p99 {result['stages'][STAGE_TOTAL]['p99Ms']:.1f}ms, rtf p99 {result['rtf']['p99']:.2f}", file=sys.stderr)
+                results.append(result)
+        return results
+    finally:
+        if vc.active is not None:
+            vc._destroy_model(vc.active.model)
+        ContentEncoderRegistry.get_instance().release(encoder)
+        del vc
+        gc.collect()
+
+
+def format_case(result: dict):
+    return " ".join([f"{key}={result.get(key)}" for key in GRID_KEYS])
+
+
+def get_env():
+    env = {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+           "numpy": np.__version__, "torch": torch.__version__, "torchThreads": torch.get_num_threads()}
+    try:
+        import onnxruntime
+        env["onnxruntime"] = onnxruntime.__version__
+    except ImportError:
+        pass
+    return env
+
+
+def compare(base: dict, new: dict, threshold: float, minDiffMs: float):
+    """ 同じ組み合わせの結果を比べて、悪化した項目を返す。 """
+    baseResults = {format_case(r): r for r in base["results"]}
+    regressions = []
+    for result in new["results"]:
+        key = format_case(result)
+        if key not in baseResults:
+            continue
+        baseResult = baseResults[key]
+        pairs = []
+        for stage, info in result["stages"].items():
+            if stage in baseResult["stages"]:
+                pairs += [(f"{stage}.{p}", baseResult["stages"][stage].get(p, 0), info.get(p, 0), minDiffMs) for p in ["p50Ms", "p99Ms"]]
+        pairs.append(("rtf.p99", baseResult["rtf"].get("p99", 0), result["rtf"].get("p99", 0), 0.0))
+        pairs.append(("alloc.chunkPeakKB.p50", baseResult["alloc"]["chunkPeakKB"].get("p50KB", 0), result["alloc"]["chunkPeakKB"].get("p50KB", 0), 1.0))
+        for name, before, after, minDiff in pairs:
+            if after > before * (1 + threshold) and after - before > minDiff:
+                regressions.append({"case": key, "metric": name, "base": before, "new": after, "ratio": after / before if before > 0 else None})
+    missing = [key for key in baseResults if key not in {format_case(r) for r in new["results"]}]
+    return regressions, missing
+
+
+def print_comparison(regressions: list, missing: list):
+    for r in regressions:
+        ratio = f"x{r['ratio']:.2f}" if r["ratio"] is not None else "new"
+        print(f"REGRESSION {r['case']} {r['metric']}: {r['base']:.3f} -> {r['new']:.3f} ({ratio})", file=sys.stderr)
+    for key in missing:
+        print(f"missing in the new run: {key}", file=sys.stderr)
+    print(f"{len(regressions)} regressions", file=sys.stderr)
+
+
+def main():
+    args = setupArgParser().parse_args()
+    if len(args.compare) > 2:
+        print("--compare takes BASE.json [NEW.json]", file=sys.stderr)
+        sys.exit(2)
+    if len(args.compare) == 2:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            regressions, missing = compare(json.load(f), json.load(g), args.threshold, args.minDiffMs)
+        print_comparison(regressions, missing)
+        sys.exit(1 if len(regressions) > 0 else 0)
+
+    workDir = tempfile.mkdtemp()
+    caseIds = itertools.count()
+    report = {"env": get_env(), "args": vars(args), "results": [], "skipped": {}}
+    for modelType in [x for x in args.models.split(",") if x != ""]:
+        if modelType not in TINY_CONFIGS:
+            report["skipped"][modelType] = "unknown model type"
+            continue
+        try:
+            report["results"] += run_model(modelType, args, workDir, caseIds)
+        except Exception as e:
+            # 外部のリポジトリや依存パッケージがない(ImportError など)モデルは飛ばす
+            report["skipped"][modelType] = f"{type(e).__name__}: {e}"
+            print(f"skip {modelType}: {type(e).__name__}: {e}", file=sys.stderr)
+            if not isinstance(e, ImportError):
+                print(traceback.format_exc(), file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output != "":
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if len(args.compare) == 1:
+        with open(args.compare[0]) as f:
+            regressions, missing = compare(json.load(f), report, args.threshold, args.minDiffMs)
+        print_comparison(regressions, missing)
+        sys.exit(1 if len(regressions) > 0 else 0)
+    sys.exit(1 if len(report["results"]) == 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
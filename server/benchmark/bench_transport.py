@@ -0,0 +1,226 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import asyncio
+import json
+import socket
+import subprocess
+import time
+import numpy as np
+
+from voice_changer.utils.AudioFrame import AudioFrameHeader, pack_frame, unpack_frame, encode_pcm
+
+# Socket.IO (/test namespace の request_message) と WebSocket (/ws の AudioFrame) で同じチャンクを送り、
+# 往復の遅延(送信から応答の受信まで)の分位点と、チャンク1つあたりのサーバとクライアントの CPU 時間を比べる。
+#
+# 既定では、このスクリプトを --serve で子プロセスとして起動し、変換の代わりに入力をそのまま返すサーバを立てる(--inferenceMs で推論時間を模擬)。
+# 転送の経路だけのコストを測るためで、サーバの CPU 時間は子プロセスの分だけを数える。
+# --url を指定すると起動済みのサーバ(モデルをロード済み)に接続する。この場合サーバの CPU 時間は測らない。
+# チャンクは実時間のペースで送り、応答待ちのチャンクが --windows の数に達したら応答を待つ(1 は応答ごとに次を送る従来の使い方)。
+# クライアントには websockets と python-socketio のクライアント(aiohttp)が必要。読み込めない経路は飛ばす。
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PERCENTILES = [50, 90, 99]
+
+
+def setupArgParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transports", type=str, default="sio,ws", help="sio, ws")
+    parser.add_argument("--windows", type=str, default="1,4", help="max chunks in flight")
+    parser.add_argument("--chunkSize", type=int, default=4096, help="samples per chunk")
+    parser.add_argument("--sampleRate", type=int, default=48000, help="sampling rate of the chunks (pacing)")
+    parser.add_argument("--seconds", type=float, default=10.0, help="audio length sent per measurement")
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for the remaining responses")
+    parser.add_argument("--url", type=str, help="running server (e.g. http://localhost:18888). default: start an echo server")
+    parser.add_argument("--port", type=int, default=18890, help="port of the echo server")
+    parser.add_argument("--inferenceMs", type=float, default=0.0, help="simulated inference time of the echo server")
+    parser.add_argument("--queueSize", type=int, default=4, help="queue size of the echo server")
+    parser.add_argument("--output", type=str, help="write the results as JSON")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    return parser
+
+
+def serve(args):
+    """ 入力をそのまま返す VoiceChangerManager でサーバ(MMVC_Rest + Socket.IO)を起動する。 """
+    import uvicorn
+    from const import setModelType
+    setModelType("MMVCv15")
+    from voice_changer.VoiceChangerManager import VoiceChangerManager
+    from restapi.MMVC_Rest import MMVC_Rest
+    from sio.MMVC_SocketIOApp import MMVC_SocketIOApp
+
+    def echo(self, receivedData: np.ndarray, sessionId: str):
+        if args.inferenceMs > 0:
+            time.sleep(args.inferenceMs / 1000)
+        return np.array(receivedData, dtype=np.int16), [0, 0, 0]
+    VoiceChangerManager.changeVoice = echo
+
+    manager = VoiceChangerManager.get_instance({"queueSize": args.queueSize})
+    app = MMVC_SocketIOApp.get_instance(MMVC_Rest.get_instance(manager), manager)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def start_server(args):
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port),
+                             "--inferenceMs", str(args.inferenceMs), "--queueSize", str(args.queueSize)], cwd=SERVER_DIR)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"echo server exited with {proc.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", args.port), timeout=1):
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("echo server did not start")
+
+
+def get_cpu_time(pid: int):
+    """ プロセスの CPU 時間(user + system, sec)。取得できない環境では None。 """
+    try:
+        import psutil
+        times = psutil.Process(pid).cpu_times()
+        return times.user + times.system
+    except ImportError:
+        pass
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+async def drive(send, responses: asyncio.Queue, chunks: list, window: int, interval: float, timeout: float):
+    """ chunks を interval ごとに送り、応答待ちが window に達したら待つ。seq ごとの往復時間と届かなかった数を返す。 """
+    sentAt = {}
+    latencies = []
+    slots = asyncio.Semaphore(window)
+
+    async def receive():
+        while len(latencies) < len(chunks):
+            seq = await responses.get()
+            if seq in sentAt:
+                latencies.append(time.perf_counter() - sentAt.pop(seq))
+                slots.release()
+
+    receiver = asyncio.create_task(receive())
+    start = time.perf_counter()
+    for seq, chunk in enumerate(chunks):
+        await slots.acquire()
+        delay = start + seq * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sentAt[seq] = time.perf_counter()
+        await send(seq, chunk)
+    try:
+        await asyncio.wait_for(receiver, timeout)
+    except asyncio.TimeoutError:
+        pass
+    return latencies, len(chunks) - len(latencies)
+
+
+async def run_websocket(url: str, chunks: list, window: int, args):
+    import websockets
+    wsUrl = url.replace("http://", "ws://").replace("https://", "wss://") + "/ws"
+    responses = asyncio.Queue()
+    async with websockets.connect(wsUrl, max_size=None) as ws:
+        hello = json.loads(await ws.recv())
+        if window > hello["window"]:
+            print(f"  window {window} exceeds the server queue ({hello['window']}). chunks may be dropped")
+
+        async def read():
+            async for message in ws:
+                header, _ = unpack_frame(message)
+                responses.put_nowait(header.seq)
+        reader = asyncio.create_task(read())
+
+        async def send(seq: int, chunk: np.ndarray):
+            await ws.send(pack_frame(chunk, AudioFrameHeader(sampleRate=args.sampleRate, seq=seq)))
+        result = await drive(send, responses, chunks, window, args.chunkSize / args.sampleRate, args.timeout)
+        reader.cancel()
+        return result
+
+
+async def run_socketio(url: str, chunks: list, window: int, args):
+    import socketio
+    responses = asyncio.Queue()
+    sio = socketio.AsyncClient()
+
+    async def on_response(msg):
+        responses.put_nowait(int(msg[0]))
+    sio.on("response", on_response, namespace="/test")
+    await sio.connect(url, namespaces=["/test"], transports=["websocket"])
+    try:
+        async def send(seq: int, chunk: np.ndarray):
+            await sio.emit("request_message", [seq, encode_pcm(chunk)], namespace="/test")
+        return await drive(send, responses, chunks, window, args.chunkSize / args.sampleRate, args.timeout)
+    finally:
+        await sio.disconnect()
+
+
+TRANSPORTS = {
+    "sio": run_socketio,
+    "ws": run_websocket,
+}
+
+
+def main():
+    args = setupArgParser().parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    rng = np.random.default_rng(0)
+    num = max(int(args.seconds * args.sampleRate / args.chunkSize), 1)
+    chunks = [(rng.standard_normal(args.chunkSize) * 3000).astype(np.int16) for _ in range(num)]
+
+    proc = None if args.url else start_server(args)
+    url = args.url if args.url else f"http://127.0.0.1:{args.port}"
+    results = []
+    try:
+        print(f"{'transport':>9s} {'window':>6s} {'chunks':>6s} {'lost':>5s} " + " ".join([f"{f'p{p}(ms)':>9s}" for p in PERCENTILES]) +
+              f" {'server cpu':>11s} {'client cpu':>11s}  (cpu: ms/chunk)")
+        for transport in args.transports.split(","):
+            for window in [int(x) for x in args.windows.split(",")]:
+                serverCpu = get_cpu_time(proc.pid) if proc is not None else None
+                clientCpu = time.process_time()
+                try:
+                    latencies, lost = asyncio.run(TRANSPORTS[transport](url, chunks, window, args))
+                except ImportError as e:
+                    print(f"{transport:>9s} skipped: {e}")
+                    break
+                clientCpu = time.process_time() - clientCpu
+                if serverCpu is not None:
+                    serverCpu = get_cpu_time(proc.pid) - serverCpu
+
+                result = {
+                    "transport": transport,
+                    "window": window,
+                    "chunks": num,
+                    "lost": lost,
+                    "latencyMs": {f"p{p}": float(np.percentile(latencies, p) * 1000) if len(latencies) > 0 else None for p in PERCENTILES},
+                    "serverCpuMsPerChunk": serverCpu / num * 1000 if serverCpu is not None else None,
+                    "clientCpuMsPerChunk": clientCpu / num * 1000,
+                }
+                results.append(result)
+                latency = " ".join([f"{v:9.2f}" if v is not None else f"{'-':>9s}" for v in result["latencyMs"].values()])
+                server = f"{result['serverCpuMsPerChunk']:11.3f}" if serverCpu is not None else f"{'-':>11s}"
+                print(f"{transport:>9s} {window:6d} {num:6d} {lost:5d} {latency} {server} {result['clientCpuMsPerChunk']:11.3f}")
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"chunkSize": args.chunkSize, "sampleRate": args.sampleRate, "inferenceMs": args.inferenceMs, "results": results}, f, indent=2)
+    if len(results) == 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
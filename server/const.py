@@ -17,6 +17,7 @@ NATIVE_CLIENT_FILE_MAC = os.path.join(sys._MEIPASS, "voice-changer-native-client
 
 TMP_DIR = os.path.join(tmpdir.name, "tmp_dir") if hasattr(sys, "_MEIPASS") else "tmp_dir"
 os.makedirs(TMP_DIR, exist_ok=True)
+MAPPED_WEIGHTS_DIR = os.path.join(tmpdir.name, "mapped_weights") if hasattr(sys, "_MEIPASS") else "mapped_weights"
 
 
 modelType = "MMVCv15"
@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+
+# サーバプロセスが起動時(モデルのロード前)に読み込むモジュール
+STARTUP_MODULES = ["voice_changer.VoiceChangerManager", "restapi.MMVC_Rest", "sio.MMVC_SocketIOApp"]
+# 起動時には読み込まず、モデルをロードする時に読み込むモジュール
+HEAVY_MODULES = ["torch", "onnxruntime", "resampy", "pyworld", "librosa", "fairseq"]
+MODEL_MODULES = {
+    "MMVCv15": "voice_changer.MMVCv15.MMVCv15",
+    "MMVCv13": "voice_changer.MMVCv13.MMVCv13",
+    "so-vits-svc-40": "voice_changer.SoVitsSvc40.SoVitsSvc40",
+    "so-vits-svc-40v2": "voice_changer.SoVitsSvc40v2.SoVitsSvc40v2",
+    "so-vits-svc-40v2_c": "voice_changer.SoVitsSvc40v2.SoVitsSvc40v2",
+    "DDSP-SVC": "voice_changer.DDSP_SVC.DDSP_SVC",
+}
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# importlib.import_module だと指定したモジュール自身の行が -X importtime に出ないので __import__ を使う
+PROFILE_CODE = """
+import sys
+for name in sys.argv[1:]:
+    if name == "--":
+        print("-- phase --", file=sys.stderr, flush=True)
+        continue
+    try:
+        __import__(name)
+    except Exception as e:
+        print(f"FAILED {name}: {type(e).__name__}: {e}", flush=True)
+"""
+
+
+def profile_imports(phases: list):
+    """ 新しいインタプリタで python -X importtime を使ってフェーズごとにモジュールを読み込み、
+    フェーズごとに [(self[us], cumulative[us], depth, name)] と読み込みに失敗したモジュールを返す。
+    """
+    args = []
+    for modules in phases:
+        args += modules + ["--"]
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", PROFILE_CODE] + args[:-1],
+                          cwd=SERVER_DIR, capture_output=True, text=True)
+    entries = [[]]
+    for line in proc.stderr.splitlines():
+        if line == "-- phase --":
+            entries.append([])
+            continue
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        selfTime, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries[-1].append((int(selfTime), int(cumulative), depth, name.strip()))
+    failures = [line for line in proc.stdout.splitlines() if line.startswith("FAILED")]
+    return entries, failures
+
+
+def print_import_report(modelType: str, top: int = 15):
+    """ 起動時とモデルのロード時に読み込まれるモジュールの時間(-X importtime)を表示する。 """
+    if hasattr(sys, "_MEIPASS"):
+        print("import report is not available in the packaged app")
+        return
+    phases = [STARTUP_MODULES, [MODEL_MODULES.get(modelType, MODEL_MODULES["MMVCv13"])]]
+    entries, failures = profile_imports(phases)
+    for title, phase in zip(["server startup", f"model load ({modelType})"], entries):
+        total = sum([cumulative for _, cumulative, depth, _ in phase if depth == 0])
+        print(f"== {title}: {total / 1000:.1f}ms, {len(phase)} modules")
+        for selfTime, cumulative, depth, name in sorted(phase, key=lambda x: -x[1])[:top]:
+            print(f"  {cumulative / 1000:9.1f}ms (self {selfTime / 1000:7.1f}ms)  {'  ' * depth}{name}")
+        heavy = [name for _, _, _, name in phase if name in HEAVY_MODULES]
+        print(f"  heavy modules: {heavy if len(heavy) > 0 else 'none'}")
+    for failure in failures:
+        print(f"  {failure}")
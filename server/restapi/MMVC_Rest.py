@@ -6,7 +6,10 @@ from typing import Callable
 from voice_changer.VoiceChangerManager import VoiceChangerManager
 
 from restapi.MMVC_Rest_Hello import MMVC_Rest_Hello
+from restapi.MMVC_Rest_Health import MMVC_Rest_Health
+from restapi.MMVC_Rest_Metrics import MMVC_Rest_Metrics
 from restapi.MMVC_Rest_VoiceChanger import MMVC_Rest_VoiceChanger
+from restapi.MMVC_Rest_WebSocket import MMVC_Rest_WebSocket
 from restapi.MMVC_Rest_Fileuploader import MMVC_Rest_Fileuploader
 from restapi.MMVC_Rest_Trainer import MMVC_Rest_Trainer
 from const import getFrontendPath, TMP_DIR
@@ -56,8 +59,14 @@ class MMVC_Rest:
 
             restHello = MMVC_Rest_Hello()
             app_fastapi.include_router(restHello.router)
+            restHealth = MMVC_Rest_Health(voiceChangerManager)
+            app_fastapi.include_router(restHealth.router)
+            restMetrics = MMVC_Rest_Metrics(voiceChangerManager)
+            app_fastapi.include_router(restMetrics.router)
             restVoiceChanger = MMVC_Rest_VoiceChanger(voiceChangerManager)
             app_fastapi.include_router(restVoiceChanger.router)
+            restWebSocket = MMVC_Rest_WebSocket(voiceChangerManager)
+            app_fastapi.include_router(restWebSocket.router)
             fileUploader = MMVC_Rest_Fileuploader(voiceChangerManager)
             app_fastapi.include_router(fileUploader.router)
             trainer = MMVC_Rest_Trainer()
@@ -8,8 +8,9 @@ from fastapi import HTTPException, FastAPI, UploadFile, File, Form
 
 from restapi.mods.FileUploader import upload_file, concat_file_chunks
 from voice_changer.VoiceChangerManager import VoiceChangerManager
+from voice_changer.OfflineConverter import OfflineConvertSettings
 
-from const import MODEL_DIR, UPLOAD_DIR
+from const import MODEL_DIR, UPLOAD_DIR, TMP_DIR
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(MODEL_DIR, exist_ok=True)
 
@@ -23,8 +24,11 @@ class MMVC_Rest_Fileuploader:
         self.router.add_api_route("/concat_uploaded_file", self.post_concat_uploaded_file, methods=["POST"])
         self.router.add_api_route("/update_setteings", self.post_update_setteings, methods=["POST"])
         self.router.add_api_route("/load_model", self.post_load_model, methods=["POST"])
+        self.router.add_api_route("/load_model/{jobId}", self.get_load_model, methods=["GET"])
         self.router.add_api_route("/load_model_for_train", self.post_load_model_for_train, methods=["POST"])
         self.router.add_api_route("/extract_voices", self.post_extract_voices, methods=["POST"])
+        self.router.add_api_route("/convert_file", self.post_convert_file, methods=["POST"])
+        self.router.add_api_route("/convert_file/{jobId}", self.get_convert_file, methods=["GET"])
 
         self.onnx_provider = ""
 
@@ -64,12 +68,18 @@ class MMVC_Rest_Fileuploader:
         clusterTorchModelFilePath = os.path.join(UPLOAD_DIR, clusterTorchModelFilename) if clusterTorchModelFilename != "-" else None
         hubertTorchModelFilePath = os.path.join(UPLOAD_DIR, hubertTorchModelFilename) if hubertTorchModelFilename != "-" else None
 
-        info = self.voiceChangerManager.loadModel(configFilePath, pyTorchModelFilePath, onnxModelFilePath,
-                                                  clusterTorchModelFilePath)
+        # ロードと warmup はバックグラウンドで行い、終わるまでは今のモデルで変換を続ける。進み具合は /load_model/{jobId} で確認する
+        info = self.voiceChangerManager.loadModelAsync(configFilePath, pyTorchModelFilePath, onnxModelFilePath,
+                                                       clusterTorchModelFilePath)
         json_compatible_item_data = jsonable_encoder(info)
         return JSONResponse(content=json_compatible_item_data)
         # return {"load": f"{configFilePath}, {pyTorchModelFilePath}, {onnxModelFilePath}"}
 
+    def get_load_model(self, jobId: str):
+        info = self.voiceChangerManager.get_load_job(jobId)
+        json_compatible_item_data = jsonable_encoder(info)
+        return JSONResponse(content=json_compatible_item_data, status_code=200 if info["status"] == "OK" else 404)
+
     def post_load_model_for_train(
         self,
         modelGFilename: str = Form(...),
@@ -92,3 +102,30 @@ class MMVC_Rest_Fileuploader:
             UPLOAD_DIR, zipFilename, zipFileChunkNum, UPLOAD_DIR)
         shutil.unpack_archive(zipFilePath, "MMVC_Trainer/dataset/textful/")
         return {"Zip file unpacked": f"{zipFilePath}"}
+
+    def post_convert_file(
+        self,
+        filename: str = Form(...),
+        workers: int = Form(2),
+        silenceThresholdDb: float = Form(-40.0),
+        minSilenceMs: int = Form(300),
+        maxSegmentSec: float = Form(15.0),
+        minSegmentSec: float = Form(2.0),
+        marginMs: int = Form(500),
+    ):
+        # filename は upload_file(と concat_uploaded_file)でアップロードした wav。変換結果は outputUrl(/tmp/...)から取得する
+        inputFilePath = os.path.join(UPLOAD_DIR, os.path.basename(filename))
+        if os.path.isfile(inputFilePath) == False:
+            raise HTTPException(status_code=404, detail=f"file not found: {filename}")
+        outputFilename = f"converted_{os.path.splitext(os.path.basename(filename))[0]}.wav"
+        settings = OfflineConvertSettings(workers=workers, silenceThresholdDb=silenceThresholdDb, minSilenceMs=minSilenceMs,
+                                          maxSegmentSec=maxSegmentSec, minSegmentSec=minSegmentSec, marginMs=marginMs)
+        info = self.voiceChangerManager.convertFileAsync(inputFilePath, os.path.join(TMP_DIR, outputFilename), settings)
+        info["outputUrl"] = f"/tmp/{outputFilename}"
+        json_compatible_item_data = jsonable_encoder(info)
+        return JSONResponse(content=json_compatible_item_data)
+
+    def get_convert_file(self, jobId: str):
+        info = self.voiceChangerManager.get_convert_job(jobId)
+        json_compatible_item_data = jsonable_encoder(info)
+        return JSONResponse(content=json_compatible_item_data, status_code=200 if info["status"] == "OK" else 404)
@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from voice_changer.VoiceChangerManager import VoiceChangerManager
+
+
+class MMVC_Rest_Health:
+    """ クライアントやロードバランサ向けの準備状態。モデルのロードと warmup が終わるまでは 503 を返す。 """
+
+    def __init__(self, voiceChangerManager: VoiceChangerManager):
+        self.voiceChangerManager = voiceChangerManager
+        self.router = APIRouter()
+        self.router.add_api_route("/health", self.get_health, methods=["GET"])
+
+    def get_health(self):
+        health = self.voiceChangerManager.get_health()
+        json_compatible_item_data = jsonable_encoder(health)
+        return JSONResponse(content=json_compatible_item_data, status_code=200 if health["ready"] else 503)
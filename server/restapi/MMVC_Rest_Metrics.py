@@ -0,0 +1,18 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from voice_changer.VoiceChangerManager import VoiceChangerManager
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MMVC_Rest_Metrics:
+    """ Prometheus 向けの段階ごとの処理時間のヒストグラム, RTF, 推論キューの深さ。 """
+
+    def __init__(self, voiceChangerManager: VoiceChangerManager):
+        self.voiceChangerManager = voiceChangerManager
+        self.router = APIRouter()
+        self.router.add_api_route("/metrics", self.get_metrics, methods=["GET"])
+
+    def get_metrics(self):
+        return PlainTextResponse(content=self.voiceChangerManager.get_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
@@ -1,20 +1,23 @@
 import base64
-import struct
-import numpy as np
+import time
 import traceback
 
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
 from voice_changer.VoiceChangerManager import VoiceChangerManager
+from voice_changer.VoiceChangerSession import DEFAULT_SESSION_ID
+from voice_changer.utils.AudioFrame import decode_pcm, encode_pcm, unpack_frame, pack_frame
+from voice_changer.utils.LatencyMetrics import LatencyMetrics, STAGE_ENCODE
 from pydantic import BaseModel
-import threading
 
 
 class VoiceModel(BaseModel):
     timestamp: int
     buffer: str
+    sessionId: str = DEFAULT_SESSION_ID
 
 
 class MMVC_Rest_VoiceChanger:
@@ -22,8 +25,7 @@ class MMVC_Rest_VoiceChanger:
         self.voiceChangerManager = voiceChangerManager
         self.router = APIRouter()
         self.router.add_api_route("/test", self.test, methods=["POST"])
-
-        self.tlock = threading.Lock()
+        self.router.add_api_route("/convert/{sessionId}", self.convert, methods=["POST"])
 
     def test(self, voice: VoiceModel):
         try:
@@ -35,16 +37,16 @@ class MMVC_Rest_VoiceChanger:
                 samplerate, data = read("dummy.wav")
                 unpackedData = data
             else:
-                unpackedData = np.array(struct.unpack(
-                    '<%sh' % (len(wav) // struct.calcsize('<h')), wav))
+                unpackedData = decode_pcm(wav)
                 # write("logs/received_data.wav", 24000,
                 #       unpackedData.astype(np.int16))
 
-            self.tlock.acquire()
-            changedVoice = self.voiceChangerManager.changeVoice(unpackedData)
-            self.tlock.release()
+            # 排他はセッションごと(VoiceChanger.on_request)。別セッションのリクエストは並列に変換する
+            changedVoice = self.voiceChangerManager.changeVoice(unpackedData, voice.sessionId)
 
-            changedVoiceBase64 = base64.b64encode(changedVoice[0]).decode('utf-8')
+            start = time.perf_counter()
+            changedVoiceBase64 = base64.b64encode(encode_pcm(changedVoice[0])).decode('utf-8')
+            LatencyMetrics.get_instance().observe(STAGE_ENCODE, time.perf_counter() - start, voice.sessionId)
             data = {
                 "timestamp": timestamp,
                 "changedVoiceBase64": changedVoiceBase64
@@ -56,5 +58,23 @@ class MMVC_Rest_VoiceChanger:
         except Exception as e:
             print("REQUEST PROCESSING!!!! EXCEPTION!!!", e)
             print(traceback.format_exc())
-            self.tlock.release()
             return str(e)
+
+    async def convert(self, sessionId: str, request: Request):
+        """ application/octet-stream で AudioFrame(ヘッダ付き、またはヘッダなしの int16 PCM)を受け取り、同じ形式で返す。
+        base64 と JSON を通さない /test の代わり。処理時間(pre, main, post)は X-MMVC-Perf ヘッダで返す。
+        """
+        body = await request.body()
+        header, unpackedData = unpack_frame(body)
+        if unpackedData.shape[0] == 0:
+            raise HTTPException(status_code=400, detail="empty audio")
+
+        # 推論はイベントループを止めないようにスレッドプールで実行する
+        changedVoice = await run_in_threadpool(self.voiceChangerManager.changeVoice, unpackedData, sessionId)
+        perf = changedVoice[1] if len(changedVoice) == 2 else [0, 0, 0]
+
+        start = time.perf_counter()
+        data = pack_frame(changedVoice[0], header) if header is not None else encode_pcm(changedVoice[0])
+        LatencyMetrics.get_instance().observe(STAGE_ENCODE, time.perf_counter() - start, sessionId)
+        return Response(content=data, media_type="application/octet-stream",
+                        headers={"X-MMVC-Perf": ",".join([str(x) for x in perf])})
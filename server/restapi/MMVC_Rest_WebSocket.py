@@ -0,0 +1,57 @@
+import time
+import uuid
+
+from fastapi import APIRouter, WebSocket
+
+from voice_changer.VoiceChangerManager import VoiceChangerManager
+from voice_changer.utils.AudioFrame import AudioFrameHeader, unpack_frame, pack_frame, encode_pcm
+from voice_changer.utils.LatencyMetrics import LatencyMetrics, STAGE_ENCODE
+
+
+class MMVC_Rest_WebSocket:
+    """ Socket.IO(/test)を通さずに音声チャンクをバイナリのままやり取りする WebSocket (/ws)。
+    接続直後にサーバからテキストで {"sessionId", "window"} を送る。
+    クライアントは AudioFrame(ヘッダ付き、またはヘッダなしの int16 PCM)を1メッセージに1つ、応答を待たずに続けて送ってよい。
+    window はセッションのキューの長さ(queueSize)。サーバが持つのは変換待ちのキューの queueSize 個と変換中の1個なので、
+    キューが一杯になって捨てられる(まとめられる)のは応答待ちが queueSize + 1 個を超えてから。
+    応答待ちのチャンクを window 以下に抑えていれば、変換中のチャンクの応答が届く前に次を送っても1個分の余裕があり、捨てられることはない。
+    応答はヘッダ付きで送られたチャンクには同じ seq のヘッダを付けて、ヘッダなしのチャンクには PCM だけを、送られた順に返す。
+    キューが一杯で捨てた(まとめた)チャンクの応答は返らないので、ヘッダの seq で対応を取ること。
+    """
+
+    def __init__(self, voiceChangerManager: VoiceChangerManager):
+        self.voiceChangerManager = voiceChangerManager
+        self.router = APIRouter()
+        self.router.add_api_websocket_route("/ws", self.websocket)
+
+    async def websocket(self, websocket: WebSocket, sessionId: str = None):
+        sessionId = sessionId if sessionId is not None else f"ws-{uuid.uuid4().hex}"
+        await websocket.accept()
+        await websocket.send_json({"sessionId": sessionId, "window": self.voiceChangerManager.dispatcher.queueSize})
+        print(f"[WebSocket] connect session: {sessionId}")
+
+        metrics = LatencyMetrics.get_instance()
+
+        async def sendResponse(seq: int, header: AudioFrameHeader, res: tuple):
+            # header はキューに入れたリクエストのもの(ヘッダなしで送られたチャンクは None)
+            start = time.perf_counter()
+            data = pack_frame(res[0], header) if header is not None else encode_pcm(res[0])
+            metrics.observe(STAGE_ENCODE, time.perf_counter() - start, sessionId)
+            await websocket.send_bytes(data)
+
+        received = 0
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                data = message.get("bytes")
+                if data is None:
+                    continue  # テキストのメッセージは使わない
+                header, unpackedData = unpack_frame(data)
+                seq = header.seq if header is not None else received
+                received += 1
+                await self.voiceChangerManager.dispatcher.submit(sessionId, seq, unpackedData, sendResponse, header)
+        finally:
+            print(f"[WebSocket] disconnect session: {sessionId} (received:{received})")
+            self.voiceChangerManager.release_session(sessionId)
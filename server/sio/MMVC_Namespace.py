@@ -1,8 +1,10 @@
-import struct
 from datetime import datetime
-import numpy as np
+from functools import partial
+import time
 import socketio
 from voice_changer.VoiceChangerManager import VoiceChangerManager
+from voice_changer.utils.AudioFrame import AudioFrameHeader, unpack_frame, pack_frame, encode_pcm
+from voice_changer.utils.LatencyMetrics import LatencyMetrics, STAGE_ENCODE
 
 
 class MMVC_Namespace(socketio.AsyncNamespace):
@@ -28,15 +30,19 @@ class MMVC_Namespace(socketio.AsyncNamespace):
             print(data)
             await self.emit('response', [timestamp, 0], to=sid)
         else:
-            unpackedData = np.array(struct.unpack('<%sh' % (len(data) // struct.calcsize('<h')), data)).astype(np.int16)
+            header, unpackedData = unpack_frame(data)
+            # 推論はイベントループを止めないように別スレッドで実行し、結果が出たら返す。
+            # 応答のヘッダ(seq など)はキューに入れたリクエストのものを使う
+            await self.voiceChangerManager.dispatcher.submit(sid, timestamp, unpackedData, partial(self._emit_response, sid), header)
 
-            # audio1, perf = self.voiceChangerManager.changeVoice(unpackedData)
-            res = self.voiceChangerManager.changeVoice(unpackedData)
-            audio1 = res[0]
-            perf = res[1] if len(res) == 2 else [0, 0, 0]
-            bin = struct.pack('<%sh' % len(audio1), *audio1)
-            await self.emit('response', [timestamp, bin, perf], to=sid)
+    async def _emit_response(self, sid: str, timestamp: int, header: AudioFrameHeader, res: tuple):
+        audio1 = res[0]
+        perf = res[1] if len(res) == 2 else [0, 0, 0]
+        start = time.perf_counter()
+        bin = pack_frame(audio1, header) if header is not None else encode_pcm(audio1)
+        LatencyMetrics.get_instance().observe(STAGE_ENCODE, time.perf_counter() - start, sid)
+        await self.emit('response', [timestamp, bin, perf], to=sid)
 
     def on_disconnect(self, sid):
         # print('[{}] disconnect'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-        pass
+        self.voiceChangerManager.release_session(sid)
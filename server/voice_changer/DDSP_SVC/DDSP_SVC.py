@@ -11,17 +11,25 @@ else:
     sys.path.append("DDSP-SVC")
 
 import io
+import time
 from dataclasses import dataclass, asdict, field
 from functools import reduce
 import numpy as np
 import torch
-import onnxruntime
 import pyworld as pw
 import ddsp.vocoder as vo
 from ddsp.core import upsample
 from enhancer import Enhancer
 from slicer import Slicer
 import librosa
+from voice_changer.VoiceChangerSession import VoiceChangerSession
+from voice_changer.utils.RingBuffer import RingBuffer
+from voice_changer.utils.SilenceGate import SilenceGateStats
+from voice_changer.utils.ContentUnitCache import ContentUnitCacheStats
+from voice_changer.utils.OnnxSessionFactory import OnnxSessionFactory
+from voice_changer.utils.ShapeBucketing import ShapeBuckets
+from voice_changer.utils.ContentEncoderRegistry import ContentEncoderRegistry
+from voice_changer.utils.LatencyMetrics import LatencyMetrics, STAGE_F0, STAGE_UNITS
 providers = ['OpenVINOExecutionProvider', "CUDAExecutionProvider", "DmlExecutionProvider", "CPUExecutionProvider"]
 
 import resampy
@@ -39,6 +47,8 @@ class DDSP_SVCSettings():
     noiceScale: float = 0.3
     predictF0: int = 0  # 0:False, 1:True
     silentThreshold: float = 0.00001
+    silentHangoverMs: int = 200  # 音量が閾値を下回ってからも変換を続ける時間
+    unitMarginMs: int = 200  # content unitを差分でエンコードするときに前後に余分にエンコードする時間
     extraConvertSize: int = 1024 * 32
     clusterInferRatio: float = 0.1
 
@@ -52,7 +62,7 @@ class DDSP_SVCSettings():
     )
 
     # ↓mutableな物だけ列挙
-    intData = ["gpu", "dstId", "tran", "predictF0", "extraConvertSize"]
+    intData = ["gpu", "dstId", "tran", "predictF0", "extraConvertSize", "silentHangoverMs", "unitMarginMs"]
     floatData = ["noiceScale", "silentThreshold", "clusterInferRatio"]
     strData = ["framework", "f0Detector"]
 
@@ -62,10 +72,16 @@ class DDSP_SVC:
         self.settings = DDSP_SVCSettings()
         self.net_g = None
         self.onnx_session = None
+        self.encoder = None
+        self.encoderRegistry = ContentEncoderRegistry.get_instance()
+        self.onnxSessionFactory = OnnxSessionFactory.get_instance()
+        self.shapeBuckets = ShapeBuckets.get_instance()
+        self.metrics = LatencyMetrics.get_instance()
+        self.silenceStats = SilenceGateStats()
+        self.contentCacheStats = ContentUnitCacheStats()
 
         self.raw_path = io.BytesIO()
         self.gpu_num = torch.cuda.device_count()
-        self.prevVol = 0
         self.params = params
         print("DDSP-SVC initialization:", params)
 
@@ -78,14 +94,20 @@ class DDSP_SVC:
         self.args = args
         self.hop_size = int(self.args.data.block_size * SAMPLING_RATE / self.args.data.sampling_rate)
 
-        # hubert
+        # hubert(同じ設定のエンコーダはプロセスで共有する)
         vec_path = self.params["hubert"]
-        self.encoder = vo.Units_Encoder(
-            args.data.encoder,
-            vec_path,
-            args.data.encoder_sample_rate,
-            args.data.encoder_hop_size,
-            device="cpu")
+
+        def loadEncoder():
+            return vo.Units_Encoder(
+                args.data.encoder,
+                vec_path,
+                args.data.encoder_sample_rate,
+                args.data.encoder_hop_size,
+                device="cpu")
+        encoder = self.encoderRegistry.borrow("units", vec_path, "cpu", loadEncoder,
+                                              args.data.encoder, args.data.encoder_sample_rate, args.data.encoder_hop_size)
+        self.encoderRegistry.release(self.encoder)
+        self.encoder = encoder
         # f0dec
         self.f0_detector = vo.F0_Extractor(
             # "crepe",
@@ -97,6 +119,9 @@ class DDSP_SVC:
 
         self.volume_extractor = vo.Volume_Extractor(self.hop_size)
         self.enhancer = Enhancer(self.args.enhancer.type, "./model_DDSP-SVC/enhancer/model", "cpu")
+
+        # DDSP-SVC の ONNX モデルにはまだ対応していない(_onnx_inference の入力が generate_input の出力と合っていない)ので、セッションは作らない。
+        # framework を ONNX にしても "No onnx session." で無音を返す。
         return self.get_info()
 
     def update_setteings(self, key: str, val: any):
@@ -108,6 +133,12 @@ class DDSP_SVC:
                 self.onnx_session.set_providers(providers=[val], provider_options=provider_options)
             else:
                 self.onnx_session.set_providers(providers=[val])
+        elif key in self.onnxSessionFactory.settings.intData or key in self.onnxSessionFactory.settings.strData:
+            # SessionOptions はセッション生成時にしか反映されないので作り直す
+            if self.onnxSessionFactory.update_setteings(key, val) == False:
+                return False
+            if self.onnx_session != None and self.onnxSessionFactory.is_session_option(key):
+                self.onnx_session = self.onnxSessionFactory.recreate(self.onnx_session, self.settings.onnxModelFile)
         elif key in self.settings.intData:
             setattr(self.settings, key, int(val))
             if key == "gpu" and val >= 0 and val < self.gpu_num and self.onnx_session != None:
@@ -129,6 +160,7 @@ class DDSP_SVC:
         data = asdict(self.settings)
 
         data["onnxExecutionProviders"] = self.onnx_session.get_providers() if self.onnx_session != None else []
+        data.update(self.onnxSessionFactory.get_info(self.onnx_session))
         files = ["configFile", "pyTorchModelFile", "onnxModelFile"]
         for f in files:
             if data[f] != None and os.path.exists(data[f]):
@@ -136,32 +168,57 @@ class DDSP_SVC:
             else:
                 data[f] = ""
 
+        data["silenceGate"] = self.silenceStats.get_info()
+        data["contentCache"] = self.contentCacheStats.get_info()
         return data
 
     def get_processing_sampling_rate(self):
         return SAMPLING_RATE
 
-    def generate_input(self, newData: any, inputSize: int, crossfadeSize: int):
-        newData = newData.astype(np.float32) / 32768.0
-
-        if hasattr(self, "audio_buffer"):
-            self.audio_buffer = np.concatenate([self.audio_buffer, newData], 0)  # 過去のデータに連結
-        else:
-            self.audio_buffer = newData
-
+    def generate_input(self, newData: any, inputSize: int, crossfadeSize: int, session: VoiceChangerSession):
         convertSize = inputSize + crossfadeSize + self.settings.extraConvertSize
         if convertSize % self.hop_size != 0:  # モデルの出力のホップサイズで切り捨てが発生するので補う。
             convertSize = convertSize + (self.hop_size - (convertSize % self.hop_size))
+        convertSize = self.shapeBuckets.bucket(convertSize, self.hop_size)  # 推論の入力の形の種類をバケットの数に抑える
+        session.convertSize = convertSize
 
-        self.audio_buffer = self.audio_buffer[-1 * convertSize:]  # 変換対象の部分だけ抽出
+        if session.audio_buffer is None:
+            session.audio_buffer = RingBuffer(convertSize)
+            session.audio_buffer.append(np.zeros(convertSize))  # 起動直後から窓の長さ(形)が一定になるよう、無音を受け取ったことにしておく
+        session.audio_buffer.ensure_capacity(convertSize)
+        session.audio_buffer.append(newData, 1.0 / 32768.0)  # 過去のデータに連結
+        audio_buffer = session.audio_buffer.latest(convertSize)  # 変換対象の部分だけ抽出
 
-        # f0
-        f0 = self.f0_detector.extract(self.audio_buffer * 32768.0, uv_interp=True)
+        crop = audio_buffer[-1 * (inputSize + crossfadeSize):-1 * (crossfadeSize)]
+
+        rms = np.sqrt(np.square(crop).mean(axis=0))
+        vol = max(rms, session.prevVol * 0.0)
+        session.prevVol = vol
+
+        # 無音ならf0, volume, unitの計算も推論もしない。
+        hangoverSamples = self.settings.silentHangoverMs * SAMPLING_RATE // 1000
+        if session.silenceGate.is_silent(vol, self.settings.silentThreshold, hangoverSamples, inputSize):
+            self.silenceStats.add_skipped()
+            return (None, None, None, None, convertSize, vol)
+
+        start = time.perf_counter()
+
+        # f0 (前回からの差分だけを解析し、無声区間の補間は窓全体で行う)
+        detector = self.f0_detector.f0_extractor
+        tracker = session.get_f0_tracker(detector, (detector, self.hop_size), lambda wav: self.f0_detector.extract(wav * 32768.0, uv_interp=False),
+                                          SAMPLING_RATE, 1000 * self.hop_size / SAMPLING_RATE)
+        with self.metrics.stage(STAGE_F0):
+            f0 = tracker.update(session.audio_buffer, convertSize)
+        f0 = np.pad(f0, (0, max(0, convertSize // self.hop_size + 1 - f0.shape[0])))[:convertSize // self.hop_size + 1]
+        uv = f0 == 0
+        if len(f0[~uv]) > 0:
+            f0[uv] = np.interp(np.where(uv)[0], np.where(~uv)[0], f0[~uv])
+        f0[f0 < self.f0_detector.f0_min] = self.f0_detector.f0_min
         f0 = torch.from_numpy(f0).float().unsqueeze(-1).unsqueeze(0)
         f0 = f0 * 2 ** (float(self.settings.tran) / 12)
 
         # volume, mask
-        volume = self.volume_extractor.extract(self.audio_buffer)
+        volume = self.volume_extractor.extract(audio_buffer)
         mask = (volume > 10 ** (float(-60) / 20)).astype('float')
         mask = np.pad(mask, (4, 4), constant_values=(mask[0], mask[-1]))
         mask = np.array([np.max(mask[n: n + 9]) for n in range(len(mask) - 8)])
@@ -169,15 +226,20 @@ class DDSP_SVC:
         mask = upsample(mask, self.args.data.block_size).squeeze(-1)
         volume = torch.from_numpy(volume).float().unsqueeze(-1).unsqueeze(0)
 
-        # embed
-        audio = torch.from_numpy(self.audio_buffer).float().unsqueeze(0)
-        seg_units = self.encoder.encode(audio, SAMPLING_RATE, self.hop_size)
+        # embed (前回からの差分だけをエンコードする)
+        def encode(wav):
+            audio = torch.from_numpy(wav).float().unsqueeze(0)
+            return self.encoder.encode(audio, SAMPLING_RATE, self.hop_size)[0].cpu().numpy()
 
-        crop = self.audio_buffer[-1 * (inputSize + crossfadeSize):-1 * (crossfadeSize)]
+        def frameCount(size):
+            return size // self.hop_size + 1
+        cache = session.get_content_cache("units", (id(self.encoder), self.hop_size, self.settings.unitMarginMs),
+                                          encode, self.hop_size, SAMPLING_RATE, self.settings.unitMarginMs, frameCount, self.contentCacheStats)
+        with self.metrics.stage(STAGE_UNITS):
+            seg_units = torch.from_numpy(cache.update(session.audio_buffer, convertSize)).unsqueeze(0)
 
-        rms = np.sqrt(np.square(crop).mean(axis=0))
-        vol = max(rms, self.prevVol * 0.0)
-        self.prevVol = vol
+        self.silenceStats.add_processed()
+        self.silenceStats.add_process_time(time.perf_counter() - start)
 
         return (seg_units, f0, volume, mask, convertSize, vol)
 
@@ -188,10 +250,10 @@ class DDSP_SVC:
 
         seg_units = data[0]
         # f0 = data[1]
-        # convertSize = data[2]
-        # vol = data[3]
+        convertSize = data[4]
+        vol = data[5]
 
-        if vol < self.settings.silentThreshold:
+        if data[0] is None:  # generate_input で無音と判定済み
             return np.zeros(convertSize).astype(np.int16)
 
         c, f0, uv = [x.numpy() for x in data]
@@ -228,9 +290,9 @@ class DDSP_SVC:
         mask = data[3]
 
         convertSize = data[4]
-        vol = data[4]
+        vol = data[5]
 
-        if vol < self.settings.silentThreshold:
+        if data[0] is None:  # generate_input で無音と判定済み
             return np.zeros(convertSize).astype(np.int16)
 
         with torch.no_grad():
@@ -247,16 +309,23 @@ class DDSP_SVC:
             result = seg_output.squeeze().cpu().numpy() * 32768.0
         return np.array(result).astype(np.int16)
 
-    def inference(self, data):
+    def inference(self, data, session: VoiceChangerSession = None):
+        start = time.perf_counter()
         if self.settings.framework == "ONNX":
             audio = self._onnx_inference(data)
         else:
             audio = self._pyTorch_inference(data)
+        if data[0] is not None:
+            self.silenceStats.add_process_time(time.perf_counter() - start)
+            if session is not None:
+                self.shapeBuckets.add_latency(session.convertSize, time.perf_counter() - start)
         return audio
 
     def destroy(self):
         del self.net_g
         del self.onnx_session
+        self.encoderRegistry.release(self.encoder)
+        self.encoder = None
 
 
 def cross_fade(a: np.ndarray, b: np.ndarray, idx: int):
@@ -0,0 +1,124 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+import numpy as np
+
+from voice_changer.utils.LatencyMetrics import LatencyMetrics, STAGE_QUEUE_WAIT
+
+QUEUE_POLICY_DROP_OLDEST = "drop_oldest"  # キューが一杯なら一番古いチャンクを捨てる
+QUEUE_POLICY_COALESCE = "coalesce"        # キューが一杯ならたまっているチャンクを連結して1回で変換する
+QUEUE_POLICIES = [QUEUE_POLICY_DROP_OLDEST, QUEUE_POLICY_COALESCE]
+
+
+@dataclass
+class InferenceRequest():
+    timestamp: int
+    data: np.ndarray
+    enqueuedAt: float  # time.perf_counter()
+    onResult: Callable[[int, any, tuple], Awaitable[None]]  # リクエストごとの状態を持つ関数でもよいように、リクエストごとに持つ
+    header: any = None  # 応答を作るためのリクエストの情報(AudioFrameHeader など)。onResult にそのまま渡す
+
+
+class SessionQueue():
+    def __init__(self, queueSize: int):
+        self.queue: asyncio.Queue[InferenceRequest] = asyncio.Queue(maxsize=queueSize)
+        self.task: asyncio.Task = None
+        self.released = False
+        self.dropped = 0
+        self.coalesced = 0
+        self.processed = 0
+
+
+class InferenceDispatcher():
+    """ 推論をイベントループの外(専用のスレッドプール)で実行する。
+    セッションごとに上限付きのキューと消費タスクを持ち、結果が出たら onResult(timestamp, header, result) で返す。
+    セッション内の順序は保たれ、別セッションの推論は並列に走る。
+    release の後に終わった推論の結果は返さない。その推論がセッションを作り直していたら releaseSession で解放する。
+    """
+
+    def __init__(self, changeVoice: Callable[[np.ndarray, str], tuple], maxWorkers: int = 2,
+                 queueSize: int = 4, policy: str = QUEUE_POLICY_DROP_OLDEST, releaseSession: Callable[[str], None] = None):
+        if policy not in QUEUE_POLICIES:
+            print(f"[InferenceDispatcher] unknown queue policy: {policy}. use {QUEUE_POLICY_DROP_OLDEST}")
+            policy = QUEUE_POLICY_DROP_OLDEST
+        self.changeVoice = changeVoice
+        self.releaseSession = releaseSession
+        self.maxWorkers = maxWorkers
+        self.queueSize = queueSize
+        self.policy = policy
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="inference")
+        self.queues: dict[str, SessionQueue] = {}
+        self.metrics = LatencyMetrics.get_instance()
+
+    async def submit(self, sessionId: str, timestamp: int, data: np.ndarray, onResult: Callable[[int, any, tuple], Awaitable[None]],
+                     header: any = None):
+        sessionQueue = self.queues.get(sessionId)
+        if sessionQueue is None:
+            sessionQueue = SessionQueue(self.queueSize)
+            sessionQueue.task = asyncio.create_task(self._consume(sessionId, sessionQueue))
+            self.queues[sessionId] = sessionQueue
+
+        request = InferenceRequest(timestamp, data, time.perf_counter(), onResult, header)
+        if sessionQueue.queue.full():
+            if self.policy == QUEUE_POLICY_COALESCE:
+                pending = []
+                while sessionQueue.queue.empty() == False:
+                    pending.append(sessionQueue.queue.get_nowait())
+                sessionQueue.coalesced += len(pending)
+                # まとめたチャンクの結果は先頭のチャンクへの応答として返す
+                request = InferenceRequest(pending[0].timestamp, np.concatenate([p.data for p in pending] + [data]), pending[0].enqueuedAt,
+                                           pending[0].onResult, pending[0].header)
+            else:
+                sessionQueue.queue.get_nowait()
+                sessionQueue.dropped += 1
+        sessionQueue.queue.put_nowait(request)
+
+    async def _consume(self, sessionId: str, sessionQueue: SessionQueue):
+        loop = asyncio.get_running_loop()
+        while True:
+            request = await sessionQueue.queue.get()
+            self.metrics.observe(STAGE_QUEUE_WAIT, time.perf_counter() - request.enqueuedAt, sessionId)
+            try:
+                result = await loop.run_in_executor(self.executor, self._change_voice, sessionId, sessionQueue, request)
+                if result is None:
+                    continue
+                sessionQueue.processed += 1
+                await request.onResult(request.timestamp, request.header, result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[InferenceDispatcher] EXCEPTION session:{sessionId}", e)
+
+    def _change_voice(self, sessionId: str, sessionQueue: SessionQueue, request: InferenceRequest):
+        # executor のスレッドで実行する。task を cancel しても実行中(実行待ち)の推論は止まらないので、released を見て結果を捨てる
+        if sessionQueue.released:
+            return None
+        result = self.changeVoice(request.data, sessionId)
+        if sessionQueue.released:
+            # 推論の途中で release された。推論がセッションを作り直しているかもしれないので解放し直す
+            if self.releaseSession is not None:
+                self.releaseSession(sessionId)
+            return None
+        return result
+
+    def release(self, sessionId: str):
+        sessionQueue = self.queues.pop(sessionId, None)
+        if sessionQueue is not None:
+            sessionQueue.released = True
+            if sessionQueue.task is not None:
+                sessionQueue.task.cancel()
+
+    def get_info(self):
+        return {
+            "maxWorkers": self.maxWorkers,
+            "queueSize": self.queueSize,
+            "policy": self.policy,
+            "sessions": {sessionId: {
+                "depth": q.queue.qsize(),
+                "processed": q.processed,
+                "dropped": q.dropped,
+                "coalesced": q.coalesced,
+            } for sessionId, q in self.queues.items()},
+        }
@@ -1,5 +1,6 @@
 import sys
 import os
+import time
 if sys.platform.startswith('darwin'):
     baseDir = [x for x in sys.path if x.endswith("Contents/MacOS")]
     if len(baseDir) != 1:
@@ -13,13 +14,21 @@ else:
 from dataclasses import dataclass, asdict
 import numpy as np
 import torch
-import onnxruntime
 import pyworld as pw
 
 from symbols import symbols
 from models import SynthesizerTrn
-from voice_changer.MMVCv13.TrainerFunctions import TextAudioSpeakerCollate, spectrogram_torch, load_checkpoint, get_hparams_from_file
-
+from voice_changer.MMVCv13.TrainerFunctions import TextAudioSpeakerCollate, load_checkpoint, get_hparams_from_file
+
+from voice_changer.VoiceChangerSession import VoiceChangerSession
+from voice_changer.utils.RingBuffer import RingBuffer
+from voice_changer.utils.StreamingSpectrogram import StreamingSpectrogram
+from voice_changer.utils.InferenceBatcher import InferenceBatcher, onnx_batch_supported
+from voice_changer.utils.OnnxSessionFactory import OnnxSessionFactory
+from voice_changer.utils.MappedWeights import MappedWeights
+from voice_changer.utils.ShapeBucketing import ShapeBuckets
+from voice_changer.utils.OnnxIOBinding import OnnxIOBindingStats
+from voice_changer.utils.LatencyMetrics import LatencyMetrics, STAGE_SPECTROGRAM
 providers = ['OpenVINOExecutionProvider', "CUDAExecutionProvider", "DmlExecutionProvider", "CPUExecutionProvider"]
 
 
@@ -45,6 +54,12 @@ class MMVCv13:
         self.settings = MMVCv13Settings()
         self.net_g = None
         self.onnx_session = None
+        self.onnxSessionFactory = OnnxSessionFactory.get_instance()
+        self.shapeBuckets = ShapeBuckets.get_instance()
+        self.metrics = LatencyMetrics.get_instance()
+        self.ioBindingStats = OnnxIOBindingStats()
+        self.onnxBatchable = False
+        self.batcher = InferenceBatcher.get_instance()
 
         self.gpu_num = torch.cuda.device_count()
         self.text_norm = torch.LongTensor([0, 6, 0])
@@ -67,16 +82,12 @@ class MMVCv13:
                 n_speakers=self.hps.data.n_speakers,
                 **self.hps.model)
             self.net_g.eval()
-            load_checkpoint(pyTorch_model_file, self.net_g, None)
+            MappedWeights.get_instance().load(pyTorch_model_file, self.net_g, load_checkpoint)
 
         # ONNXモデル生成
         if onnx_model_file != None:
-            ort_options = onnxruntime.SessionOptions()
-            ort_options.intra_op_num_threads = 8
-            self.onnx_session = onnxruntime.InferenceSession(
-                onnx_model_file,
-                providers=providers
-            )
+            self.onnx_session = self.onnxSessionFactory.create(onnx_model_file, providers)
+            self.onnxBatchable = onnx_batch_supported(self.onnx_session)
         return self.get_info()
 
     def update_setteings(self, key: str, val: any):
@@ -88,6 +99,12 @@ class MMVCv13:
                 self.onnx_session.set_providers(providers=[val], provider_options=provider_options)
             else:
                 self.onnx_session.set_providers(providers=[val])
+        elif key in self.onnxSessionFactory.settings.intData or key in self.onnxSessionFactory.settings.strData:
+            # SessionOptions はセッション生成時にしか反映されないので作り直す
+            if self.onnxSessionFactory.update_setteings(key, val) == False:
+                return False
+            if self.onnx_session != None and self.onnxSessionFactory.is_session_option(key):
+                self.onnx_session = self.onnxSessionFactory.recreate(self.onnx_session, self.settings.onnxModelFile)
         elif key in self.settings.intData:
             setattr(self.settings, key, int(val))
             if key == "gpu" and val >= 0 and val < self.gpu_num and self.onnx_session != None:
@@ -109,6 +126,8 @@ class MMVCv13:
         data = asdict(self.settings)
 
         data["onnxExecutionProviders"] = self.onnx_session.get_providers() if self.onnx_session != None else []
+        data.update(self.onnxSessionFactory.get_info(self.onnx_session))
+        data["ioBinding"] = self.ioBindingStats.get_info()
         files = ["configFile", "pyTorchModelFile", "onnxModelFile"]
         for f in files:
             if data[f] != None and os.path.exists(data[f]):
@@ -121,32 +140,34 @@ class MMVCv13:
     def get_processing_sampling_rate(self):
         return self.hps.data.sampling_rate
 
-    def _get_spec(self, audio: any):
-        spec = spectrogram_torch(audio, self.hps.data.filter_length,
-                                 self.hps.data.sampling_rate, self.hps.data.hop_length, self.hps.data.win_length,
-                                 center=False)
-        spec = torch.squeeze(spec, 0)
+    def _get_spec(self, session: VoiceChangerSession, convertSize: int):
+        # 前回と重なるフレームは使い回し、新しいフレームだけを計算する(StreamingSpectrogram)
+        n_fft, hop_size, win_size = self.hps.data.filter_length, self.hps.data.hop_length, self.hps.data.win_length
+        if session.spectrogram is None or session.spectrogram.matches(n_fft, hop_size, win_size) == False:
+            session.spectrogram = StreamingSpectrogram(n_fft, hop_size, win_size)
+        spec = session.spectrogram.update(session.audio_buffer, convertSize)
         return spec
 
-    def generate_input(self, newData: any, inputSize: int, crossfadeSize: int):
-        newData = newData.astype(np.float32) / self.hps.data.max_wav_value
-
-        if hasattr(self, "audio_buffer"):
-            self.audio_buffer = np.concatenate([self.audio_buffer, newData], 0)  # 過去のデータに連結
-        else:
-            self.audio_buffer = newData
-
+    def generate_input(self, newData: any, inputSize: int, crossfadeSize: int, session: VoiceChangerSession):
         convertSize = inputSize + crossfadeSize
         if convertSize < 8192:
             convertSize = 8192
         if convertSize % self.hps.data.hop_length != 0:  # モデルの出力のホップサイズで切り捨てが発生するので補う。
             convertSize = convertSize + (self.hps.data.hop_length - (convertSize % self.hps.data.hop_length))
+        convertSize = self.shapeBuckets.bucket(convertSize, self.hps.data.hop_length)  # 推論の入力の形の種類をバケットの数に抑える
+        session.convertSize = convertSize
 
-        self.audio_buffer = self.audio_buffer[-1 * convertSize:]  # 変換対象の部分だけ抽出
+        if session.audio_buffer is None:
+            session.audio_buffer = RingBuffer(convertSize)
+            session.audio_buffer.append(np.zeros(convertSize))  # 起動直後から窓の長さ(形)が一定になるよう、無音を受け取ったことにしておく
+        session.audio_buffer.ensure_capacity(convertSize)
+        session.audio_buffer.append(newData, 1.0 / self.hps.data.max_wav_value)  # 過去のデータに連結
+        audio_buffer = session.audio_buffer.latest(convertSize)  # 変換対象の部分だけ抽出
 
-        audio = torch.FloatTensor(self.audio_buffer)
+        audio = torch.FloatTensor(audio_buffer)
         audio_norm = audio.unsqueeze(0)  # unsqueeze
-        spec = self._get_spec(audio_norm)
+        with self.metrics.stage(STAGE_SPECTROGRAM):
+            spec = self._get_spec(session, convertSize)
         sid = torch.LongTensor([int(self.settings.srcId)])
 
         data = (self.text_norm, spec, audio_norm, sid)
@@ -154,23 +175,42 @@ class MMVCv13:
 
         return data
 
-    def _onnx_inference(self, data):
+    def _onnx_inference(self, data, session: VoiceChangerSession = None):
         if hasattr(self, "onnx_session") == False or self.onnx_session == None:
             print("[Voice Changer] No ONNX session.")
             return np.zeros(1).astype(np.int16)
 
         x, x_lengths, spec, spec_lengths, y, y_lengths, sid_src = [x for x in data]
-        sid_tgt1 = torch.LongTensor([self.settings.dstId])
-        # if spec.size()[2] >= 8:
-        audio1 = self.onnx_session.run(
-            ["audio"],
-            {
-                "specs": spec.numpy(),
-                "lengths": spec_lengths.numpy(),
-                "sid_src": sid_src.numpy(),
-                "sid_tgt": sid_tgt1.numpy()
-            })[0][0, 0] * self.hps.data.max_wav_value
-        return audio1
+        inputs = (spec, spec_lengths, sid_src)
+        if self._use_io_binding(session):
+            runner = session.get_onnx_runner(self.onnx_session, "audio", self.ioBindingStats)
+            return runner.run(self._onnx_feed([inputs]), self.hps.data.max_wav_value)[0, 0]
+        if self.onnxBatchable == False:
+            return self._onnx_batch([inputs])[0]
+        key = (id(self), "ONNX", tuple(spec.shape))
+        return self.batcher.run(key, inputs, self._onnx_batch)
+
+    def _use_io_binding(self, session: VoiceChangerSession):
+        # IOBinding のバッファはセッションごとなので、別セッションとまとめて実行する時は通常の run を使う
+        return session is not None and self.onnxSessionFactory.settings.onnxIOBinding == 1 and \
+            (self.onnxBatchable == False or self.batcher.windowMs <= 0 or self.batcher.maxBatchSize <= 1)
+
+    def _onnx_feed(self, items):
+        spec, spec_lengths, sid_src = [torch.cat(x) for x in zip(*items)]
+        sid_tgt1 = torch.LongTensor([self.settings.dstId] * len(items))
+        return {
+            "specs": spec.numpy(),
+            "lengths": spec_lengths.numpy(),
+            "sid_src": sid_src.numpy(),
+            "sid_tgt": sid_tgt1.numpy()
+        }
+
+    def _onnx_batch(self, items):
+        feed = self._onnx_feed(items)
+        start = time.perf_counter()
+        audio1 = self.onnx_session.run(["audio"], feed)[0][:, 0] * self.hps.data.max_wav_value
+        self.ioBindingStats.add_plain(time.perf_counter() - start)
+        return list(audio1)
 
     def _pyTorch_inference(self, data):
         if hasattr(self, "net_g") == False or self.net_g == None:
@@ -182,21 +222,29 @@ class MMVCv13:
         else:
             dev = torch.device("cuda", index=self.settings.gpu)
 
+        x, x_lengths, spec, spec_lengths, y, y_lengths, sid_src = [x for x in data]
+        key = (id(self), "pyTorch", str(dev), tuple(spec.shape))
+        return self.batcher.run(key, (spec, spec_lengths, sid_src), lambda items: self._pyTorch_batch(items, dev))
+
+    def _pyTorch_batch(self, items, dev):
         with torch.no_grad():
-            x, x_lengths, spec, spec_lengths, y, y_lengths, sid_src = [x.to(dev) for x in data]
-            sid_target = torch.LongTensor([self.settings.dstId]).to(dev)
+            spec, spec_lengths, sid_src = [torch.cat(x).to(dev) for x in zip(*items)]
+            sid_target = torch.LongTensor([self.settings.dstId] * len(items)).to(dev)
 
             audio1 = (self.net_g.to(dev).voice_conversion(spec, spec_lengths, sid_src=sid_src,
-                      sid_tgt=sid_target)[0, 0].data * self.hps.data.max_wav_value)
+                      sid_tgt=sid_target)[:, 0].data * self.hps.data.max_wav_value)
             result = audio1.float().cpu().numpy()
 
-        return result
+        return list(result)
 
-    def inference(self, data):
+    def inference(self, data, session: VoiceChangerSession = None):
+        start = time.perf_counter()
         if self.settings.framework == "ONNX":
-            audio = self._onnx_inference(data)
+            audio = self._onnx_inference(data, session)
         else:
             audio = self._pyTorch_inference(data)
+        if session is not None:
+            self.shapeBuckets.add_latency(session.convertSize, time.perf_counter() - start)
         return audio
 
     def destroy(self):
@@ -0,0 +1,86 @@
+import threading
+import numpy as np
+import torch
+
+
+class ExcitationBuilder():
+    """ 推論専用の励起信号(sin, d0..d3)の生成。TextAudioSpeakerCollate + SignalGenerator の置き換え。
+    モデルのロード時に1回だけ作り、アップサンプル倍率などは事前に計算しておく。
+    出力はスレッドごとの再利用バッファに書き込むので、戻り値のテンソルは同じスレッドで次に build を呼ぶまでに使い終わること。
+    sinの位相はセッションごとに絶対サンプル位置で引き継ぎ、チャンクの境界で不連続にならないようにする。
+    """
+
+    def __init__(self, sample_rate: int, hop_size: int, dense_factors=[0.5, 1, 4, 8], upsample_scales=[8, 4, 2, 2],
+                 sine_amp: float = 0.1, noise_amp: float = 0.003):
+        self.sample_rate = sample_rate
+        self.hop_size = hop_size
+        self.dense_factors = dense_factors
+        self.prod_upsample_scales = [int(x) for x in np.cumprod(upsample_scales)]
+        self.sine_amp = sine_amp
+        self.noise_amp = noise_amp
+        self.ramp = np.arange(1, hop_size + 1, dtype=np.float32)  # cumsumと同じく、フレームの先頭のサンプルから1サンプル分進める
+        self.local = threading.local()
+
+    def _buffers(self, frameNum: int):
+        buffers = getattr(self.local, "buffers", None)
+        if buffers is None or buffers["frameNum"] != frameNum:
+            buffers = {
+                "frameNum": frameNum,
+                "sin": np.zeros(frameNum * self.hop_size, dtype=np.float32),
+                "noise": torch.zeros(frameNum * self.hop_size),
+                "d": [np.zeros(frameNum * us, dtype=np.float32) for us in self.prod_upsample_scales],
+            }
+            self.local.buffers = buffers
+        return buffers
+
+    def build(self, f0: np.ndarray, f0_factor: float, session, windowStart: int):
+        """ f0: フレームごとのf0 (T,), windowStart: f0の先頭フレームの絶対サンプル位置
+        戻り値: sin (1, 1, T * hop), [d0..d3] (1, 1, T * upsample)
+        """
+        frameNum = f0.shape[0]
+        buffers = self._buffers(frameNum)
+        f0 = f0.astype(np.float64) * f0_factor
+
+        # sin: フレーム内ではf0が一定なので、位相はフレームの先頭の位相(float64で積算して2πで丸める) + 1サンプルあたりの増分 * k。
+        # f0が10Hz以下のフレームは無声としてノイズだけ。
+        step = f0 * (2 * np.pi / self.sample_rate)
+        starts = np.empty(frameNum, dtype=np.float64)
+        starts[0] = 0
+        np.cumsum(step[:-1] * self.hop_size, out=starts[1:])
+        starts += self._initial_phase(session, windowStart)
+        np.remainder(starts, 2 * np.pi, out=starts)
+
+        sin = buffers["sin"]
+        phase = sin.reshape(frameNum, self.hop_size)
+        np.multiply(step.astype(np.float32)[:, None], self.ramp, out=phase)
+        phase += starts.astype(np.float32)[:, None]
+        self._store_phase(session, windowStart, sin)
+        np.sin(sin, out=sin)
+        phase *= (self.sine_amp * (f0 > 10.0)).astype(np.float32)[:, None]
+        noise = buffers["noise"]
+        noise.normal_(0, self.noise_amp)
+        sin += noise.numpy()
+
+        # d: pitch-dependent dilated factor。無声(0)のフレームは fs / dense_factors[0] とみなす(従来の dilated_factor と同じ結果)。
+        f0[f0 == 0] = self.sample_rate / self.dense_factors[0]
+        ds = []
+        for df, us, d in zip(self.dense_factors, self.prod_upsample_scales, buffers["d"]):
+            d.reshape(frameNum, us)[:] = (self.sample_rate / df / f0)[:, None]
+            ds.append(torch.from_numpy(d).view(1, 1, -1))
+
+        return torch.from_numpy(sin).view(1, 1, -1), ds
+
+    def _initial_phase(self, session, windowStart: int):
+        # 前のチャンクで計算した位相のうち、今回の窓の先頭の直前のサンプルの値から続ける
+        if session.sinePhase is None:
+            return 0.0
+        index = windowStart - session.sinePhaseStart - 1
+        if index < 0 or index >= session.sinePhase.shape[0]:
+            return 0.0
+        return session.sinePhase[index]
+
+    def _store_phase(self, session, windowStart: int, phase: np.ndarray):
+        if session.sinePhase is None or session.sinePhase.shape != phase.shape:
+            session.sinePhase = np.empty_like(phase)
+        np.copyto(session.sinePhase, phase)
+        session.sinePhaseStart = windowStart
@@ -1,5 +1,6 @@
 import sys
 import os
+import time
 if sys.platform.startswith('darwin'):
     baseDir = [x for x in sys.path if x.endswith("Contents/MacOS")]
     if len(baseDir) != 1:
@@ -13,12 +14,21 @@ else:
 from dataclasses import dataclass, asdict
 import numpy as np
 import torch
-import onnxruntime
 import pyworld as pw
 
 from models import SynthesizerTrn
-from voice_changer.MMVCv15.client_modules import convert_continuos_f0, spectrogram_torch, TextAudioSpeakerCollate, get_hparams_from_file, load_checkpoint
-
+from voice_changer.MMVCv15.client_modules import convert_continuos_f0, get_hparams_from_file, load_checkpoint
+from voice_changer.MMVCv15.ExcitationBuilder import ExcitationBuilder
+
+from voice_changer.VoiceChangerSession import VoiceChangerSession
+from voice_changer.utils.RingBuffer import RingBuffer
+from voice_changer.utils.StreamingSpectrogram import StreamingSpectrogram
+from voice_changer.utils.InferenceBatcher import InferenceBatcher, onnx_batch_supported
+from voice_changer.utils.OnnxSessionFactory import OnnxSessionFactory
+from voice_changer.utils.MappedWeights import MappedWeights
+from voice_changer.utils.ShapeBucketing import ShapeBuckets
+from voice_changer.utils.OnnxIOBinding import OnnxIOBindingStats
+from voice_changer.utils.LatencyMetrics import LatencyMetrics, STAGE_F0, STAGE_SPECTROGRAM
 providers = ['OpenVINOExecutionProvider', "CUDAExecutionProvider", "DmlExecutionProvider", "CPUExecutionProvider"]
 
 
@@ -47,12 +57,19 @@ class MMVCv15:
         self.settings = MMVCv15Settings()
         self.net_g = None
         self.onnx_session = None
+        self.onnxSessionFactory = OnnxSessionFactory.get_instance()
+        self.shapeBuckets = ShapeBuckets.get_instance()
+        self.metrics = LatencyMetrics.get_instance()
+        self.ioBindingStats = OnnxIOBindingStats()
+        self.onnxBatchable = False
+        self.batcher = InferenceBatcher.get_instance()
 
         self.gpu_num = torch.cuda.device_count()
 
     def loadModel(self, config: str, pyTorch_model_file: str = None, onnx_model_file: str = None):
         self.settings.configFile = config
         self.hps = get_hparams_from_file(config)
+        self.excitationBuilder = ExcitationBuilder(self.hps.data.sampling_rate, self.hps.data.hop_length)
 
         if pyTorch_model_file != None:
             self.settings.pyTorchModelFile = pyTorch_model_file
@@ -80,17 +97,13 @@ class MMVCv15:
                 requires_grad_dec=self.hps.requires_grad.dec
             )
             self.net_g.eval()
-            load_checkpoint(pyTorch_model_file, self.net_g, None)
+            MappedWeights.get_instance().load(pyTorch_model_file, self.net_g, load_checkpoint)
             # utils.load_checkpoint(pyTorch_model_file, self.net_g, None)
 
         # ONNXモデル生成
         if onnx_model_file != None:
-            ort_options = onnxruntime.SessionOptions()
-            ort_options.intra_op_num_threads = 8
-            self.onnx_session = onnxruntime.InferenceSession(
-                onnx_model_file,
-                providers=providers
-            )
+            self.onnx_session = self.onnxSessionFactory.create(onnx_model_file, providers)
+            self.onnxBatchable = onnx_batch_supported(self.onnx_session)
         return self.get_info()
 
     def update_setteings(self, key: str, val: any):
@@ -102,6 +115,12 @@ class MMVCv15:
                 self.onnx_session.set_providers(providers=[val], provider_options=provider_options)
             else:
                 self.onnx_session.set_providers(providers=[val])
+        elif key in self.onnxSessionFactory.settings.intData or key in self.onnxSessionFactory.settings.strData:
+            # SessionOptions はセッション生成時にしか反映されないので作り直す
+            if self.onnxSessionFactory.update_setteings(key, val) == False:
+                return False
+            if self.onnx_session != None and self.onnxSessionFactory.is_session_option(key):
+                self.onnx_session = self.onnxSessionFactory.recreate(self.onnx_session, self.settings.onnxModelFile)
         elif key in self.settings.intData:
             setattr(self.settings, key, int(val))
             if key == "gpu" and val >= 0 and val < self.gpu_num and self.onnx_session != None:
@@ -123,6 +142,8 @@ class MMVCv15:
         data = asdict(self.settings)
 
         data["onnxExecutionProviders"] = self.onnx_session.get_providers() if self.onnx_session != None else []
+        data.update(self.onnxSessionFactory.get_info(self.onnx_session))
+        data["ioBinding"] = self.ioBindingStats.get_info()
         files = ["configFile", "pyTorchModelFile", "onnxModelFile"]
         for f in files:
             if data[f] != None and os.path.exists(data[f]):
@@ -135,76 +156,100 @@ class MMVCv15:
     def get_processing_sampling_rate(self):
         return self.hps.data.sampling_rate
 
-    def _get_f0(self, detector: str, newData: any):
-
+    def _get_f0_frames(self, detector: str, newData: any):
         audio_norm_np = newData.astype(np.float64)
         if detector == "dio":
             _f0, _time = pw.dio(audio_norm_np, self.hps.data.sampling_rate, frame_period=5.5)
             f0 = pw.stonemask(audio_norm_np, _f0, _time, self.hps.data.sampling_rate)
         else:
             f0, t = pw.harvest(audio_norm_np, self.hps.data.sampling_rate, frame_period=5.5, f0_floor=71.0, f0_ceil=1000.0)
-        f0 = convert_continuos_f0(f0, int(audio_norm_np.shape[0] / self.hps.data.hop_length))
-        f0 = torch.from_numpy(f0.astype(np.float32))
         return f0
 
-    def _get_spec(self, newData: any):
-        audio = torch.FloatTensor(newData)
-        audio_norm = audio.unsqueeze(0)  # unsqueeze
-        spec = spectrogram_torch(audio_norm, self.hps.data.filter_length,
-                                 self.hps.data.sampling_rate, self.hps.data.hop_length, self.hps.data.win_length,
-                                 center=False)
-        spec = torch.squeeze(spec, 0)
-        return spec
-
-    def generate_input(self, newData: any, inputSize: int, crossfadeSize: int):
-        newData = newData.astype(np.float32) / self.hps.data.max_wav_value
+    def _get_f0(self, detector: str, session: VoiceChangerSession, convertSize: int):
+        # バッファ全体ではなく、前回からの差分だけをf0解析する(IncrementalF0Tracker)
+        sampling_rate = self.hps.data.sampling_rate
+        tracker = session.get_f0_tracker(detector, (sampling_rate,), lambda wav: self._get_f0_frames(detector, wav), sampling_rate, 5.5)
+        f0 = tracker.update(session.audio_buffer, convertSize)
+        f0 = convert_continuos_f0(f0, int(convertSize / self.hps.data.hop_length))
+        return f0
 
-        if hasattr(self, "audio_buffer"):
-            self.audio_buffer = np.concatenate([self.audio_buffer, newData], 0)  # 過去のデータに連結
-        else:
-            self.audio_buffer = newData
+    def _get_spec(self, session: VoiceChangerSession, convertSize: int):
+        # 前回と重なるフレームは使い回し、新しいフレームだけを計算する(StreamingSpectrogram)
+        n_fft, hop_size, win_size = self.hps.data.filter_length, self.hps.data.hop_length, self.hps.data.win_length
+        if session.spectrogram is None or session.spectrogram.matches(n_fft, hop_size, win_size) == False:
+            session.spectrogram = StreamingSpectrogram(n_fft, hop_size, win_size)
+        spec = session.spectrogram.update(session.audio_buffer, convertSize)
+        return spec
 
+    def generate_input(self, newData: any, inputSize: int, crossfadeSize: int, session: VoiceChangerSession):
         convertSize = inputSize + crossfadeSize
         if convertSize < 8192:
             convertSize = 8192
         if convertSize % self.hps.data.hop_length != 0:  # モデルの出力のホップサイズで切り捨てが発生するので補う。
             convertSize = convertSize + (self.hps.data.hop_length - (convertSize % self.hps.data.hop_length))
-
-        self.audio_buffer = self.audio_buffer[-1 * convertSize:]  # 変換対象の部分だけ抽出
-
-        f0 = self._get_f0(self.settings.f0Detector, self.audio_buffer)  # f0 生成
-        spec = self._get_spec(self.audio_buffer)
+        convertSize = self.shapeBuckets.bucket(convertSize, self.hps.data.hop_length)  # 推論の入力の形の種類をバケットの数に抑える
+        session.convertSize = convertSize
+
+        if session.audio_buffer is None:
+            session.audio_buffer = RingBuffer(convertSize)
+            session.audio_buffer.append(np.zeros(convertSize))  # 起動直後から窓の長さ(形)が一定になるよう、無音を受け取ったことにしておく
+        session.audio_buffer.ensure_capacity(convertSize)
+        session.audio_buffer.append(newData, 1.0 / self.hps.data.max_wav_value)  # 過去のデータに連結
+        windowStart = session.audio_buffer.total - min(convertSize, session.audio_buffer.length)  # 変換対象の部分の絶対位置
+
+        with self.metrics.stage(STAGE_F0):
+            f0 = self._get_f0(self.settings.f0Detector, session, convertSize)  # f0 生成
+        with self.metrics.stage(STAGE_SPECTROGRAM):
+            spec = self._get_spec(session, convertSize)
         sid = torch.LongTensor([int(self.settings.srcId)])
 
-        data = TextAudioSpeakerCollate(
-            sample_rate=self.hps.data.sampling_rate,
-            hop_size=self.hps.data.hop_length,
-            f0_factor=self.settings.f0Factor
-        )([(spec, sid, f0)])
+        # 励起信号(sin, d0..d3)。モデルと一緒に作ったビルダーで生成する(チャンクごとにCollateを作らない)
+        sin, d = self.excitationBuilder.build(f0, self.settings.f0Factor, session, windowStart)
+        data = (spec.unsqueeze(0), torch.LongTensor([spec.size(1)]), sid, sin, d)
 
         return data
 
-    def _onnx_inference(self, data):
+    def _onnx_inference(self, data, session: VoiceChangerSession = None):
         if hasattr(self, "onnx_session") == False or self.onnx_session == None:
             print("[Voice Changer] No ONNX session.")
             return np.zeros(1).astype(np.int16)
 
         spec, spec_lengths, sid_src, sin, d = data
-        sid_tgt1 = torch.LongTensor([self.settings.dstId])
-        audio1 = self.onnx_session.run(
-            ["audio"],
-            {
-                "specs": spec.numpy(),
-                "lengths": spec_lengths.numpy(),
-                "sin": sin.numpy(),
-                "d0": d[0][:1].numpy(),
-                "d1": d[1][:1].numpy(),
-                "d2": d[2][:1].numpy(),
-                "d3": d[3][:1].numpy(),
-                "sid_src": sid_src.numpy(),
-                "sid_tgt": sid_tgt1.numpy()
-            })[0][0, 0] * self.hps.data.max_wav_value
-        return audio1
+        inputs = (spec, spec_lengths, sid_src, sin, tuple([x[:1] for x in d]))
+        if self._use_io_binding(session):
+            runner = session.get_onnx_runner(self.onnx_session, "audio", self.ioBindingStats)
+            return runner.run(self._onnx_feed([inputs]), self.hps.data.max_wav_value)[0, 0]
+        if self.onnxBatchable == False:
+            return self._onnx_batch([inputs])[0]
+        key = (id(self), "ONNX", tuple(spec.shape), tuple(sin.shape), tuple([tuple(x.shape) for x in inputs[4]]))
+        return self.batcher.run(key, inputs, self._onnx_batch)
+
+    def _use_io_binding(self, session: VoiceChangerSession):
+        # IOBinding のバッファはセッションごとなので、別セッションとまとめて実行する時は通常の run を使う
+        return session is not None and self.onnxSessionFactory.settings.onnxIOBinding == 1 and \
+            (self.onnxBatchable == False or self.batcher.windowMs <= 0 or self.batcher.maxBatchSize <= 1)
+
+    def _onnx_feed(self, items):
+        spec, spec_lengths, sid_src, sin, d = _collate(items)
+        sid_tgt1 = torch.LongTensor([self.settings.dstId] * len(items))
+        return {
+            "specs": spec.numpy(),
+            "lengths": spec_lengths.numpy(),
+            "sin": sin.numpy(),
+            "d0": d[0].numpy(),
+            "d1": d[1].numpy(),
+            "d2": d[2].numpy(),
+            "d3": d[3].numpy(),
+            "sid_src": sid_src.numpy(),
+            "sid_tgt": sid_tgt1.numpy()
+        }
+
+    def _onnx_batch(self, items):
+        feed = self._onnx_feed(items)
+        start = time.perf_counter()
+        audio1 = self.onnx_session.run(["audio"], feed)[0][:, 0] * self.hps.data.max_wav_value
+        self.ioBindingStats.add_plain(time.perf_counter() - start)
+        return list(audio1)
 
     def _pyTorch_inference(self, data):
         if hasattr(self, "net_g") == False or self.net_g == None:
@@ -216,26 +261,45 @@ class MMVCv15:
         else:
             dev = torch.device("cuda", index=self.settings.gpu)
 
+        spec, spec_lengths, sid_src, sin, d = data
+        inputs = (spec, spec_lengths, sid_src, sin, tuple([x[:1] for x in d]))
+        key = (id(self), "pyTorch", str(dev), tuple(spec.shape), tuple(sin.shape), tuple([tuple(x.shape) for x in inputs[4]]))
+        return self.batcher.run(key, inputs, lambda items: self._pyTorch_batch(items, dev))
+
+    def _pyTorch_batch(self, items, dev):
         with torch.no_grad():
-            spec, spec_lengths, sid_src, sin, d = data
+            spec, spec_lengths, sid_src, sin, d = _collate(items)
             spec = spec.to(dev)
             spec_lengths = spec_lengths.to(dev)
             sid_src = sid_src.to(dev)
             sin = sin.to(dev)
-            d = tuple([d[:1].to(dev) for d in d])
-            sid_target = torch.LongTensor([self.settings.dstId]).to(dev)
+            d = tuple([x.to(dev) for x in d])
+            sid_target = torch.LongTensor([self.settings.dstId] * len(items)).to(dev)
 
-            audio1 = self.net_g.to(dev).voice_conversion(spec, spec_lengths, sin, d, sid_src, sid_target)[0, 0].data * self.hps.data.max_wav_value
+            audio1 = self.net_g.to(dev).voice_conversion(spec, spec_lengths, sin, d, sid_src, sid_target)[:, 0].data * self.hps.data.max_wav_value
             result = audio1.float().cpu().numpy()
-        return result
+        return list(result)
 
-    def inference(self, data):
+    def inference(self, data, session: VoiceChangerSession = None):
+        start = time.perf_counter()
         if self.settings.framework == "ONNX":
-            audio = self._onnx_inference(data)
+            audio = self._onnx_inference(data, session)
         else:
             audio = self._pyTorch_inference(data)
+        if session is not None:
+            self.shapeBuckets.add_latency(session.convertSize, time.perf_counter() - start)
         return audio
 
     def destroy(self):
         del self.net_g
         del self.onnx_session
+
+
+def _collate(items):
+    # セッションごとの入力(バッチサイズ1)をバッチ方向に連結する
+    spec = torch.cat([i[0] for i in items])
+    spec_lengths = torch.cat([i[1] for i in items])
+    sid_src = torch.cat([i[2] for i in items])
+    sin = torch.cat([i[3] for i in items])
+    d = tuple([torch.cat([i[4][k] for i in items]) for k in range(len(items[0][4]))])
+    return spec, spec_lengths, sid_src, sin, d
@@ -1,7 +1,6 @@
 
 
 from features import SignalGenerator, dilated_factor
-from scipy.interpolate import interp1d
 import torch
 import numpy as np
 import json
@@ -107,11 +106,8 @@ def convert_continuos_f0(f0, f0_size):
     # get non-zero frame index
     nz_frames = np.where(cf0 != 0)[0]
     # perform linear interpolation
-    f = interp1d(nz_frames, cf0[nz_frames], bounds_error=False, fill_value=0.0)
-    cf0_ = f(np.arange(0, f0_size))
-    # print(cf0.shape, cf0_.shape, f0.shape, f0_size)
-    # print(cf0_)
-    return f(np.arange(0, f0_size))
+    # 範囲外は0 (interp1d(bounds_error=False, fill_value=0.0) と同じ)
+    return np.interp(np.arange(0, f0_size), nz_frames, cf0[nz_frames], left=0.0, right=0.0)
 
 
 def spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=False):
@@ -0,0 +1,179 @@
+import os
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+from voice_changer.utils.ContentEncoderRegistry import ContentEncoderRegistry
+
+DEFAULT_MODEL_CACHE_BUDGET_MB = 0  # 既定では使用中のモデルだけを持つ(差し替えたモデルを残すと、その分だけ RAM/VRAM を使い続けるので --modelCacheBudgetMB で明示的に有効にする)
+FOOTPRINT_SEARCH_DEPTH = 3  # モデルの属性をたどる深さ(Units_Encoder.model、cluster_model[spk].cluster_centers_ など)
+
+
+def estimate_footprint(model):
+    """ モデルが保持している重みのバイト数を種類ごとに返す。
+    PyTorchのモジュールはパラメータとバッファ(同じ領域は1回だけ数える)、numpy配列(クラスタのセントロイドなど)はそのサイズ、
+    ONNXのセッションはモデルファイルのサイズで見積もる(onnxruntime はセッションが確保したメモリを返さないため)。
+    ContentEncoderRegistry で共有しているエンコーダは含めない。
+    """
+    import torch
+    registry = ContentEncoderRegistry.get_instance()
+    footprint = {"torch": 0, "numpy": 0, "onnx": 0}
+    seen = set()
+    seenTensors = set()
+
+    def visit(value, depth: int):
+        if id(value) in seen:
+            return
+        seen.add(id(value))
+        if value is getattr(type(value), "_instance", None):
+            return  # get_instance のシングルトン(ShapeBuckets など)はモデルの持ち物ではない
+        if registry.owns(value):
+            return
+        if isinstance(value, torch.nn.Module):
+            for tensor in list(value.parameters()) + list(value.buffers()):
+                if tensor.data_ptr() not in seenTensors:
+                    seenTensors.add(tensor.data_ptr())
+                    footprint["torch"] += tensor.numel() * tensor.element_size()
+        elif isinstance(value, np.ndarray):
+            footprint["numpy"] += value.nbytes
+        elif depth <= 0 or isinstance(value, (str, bytes, int, float, bool)) or value is None:
+            return
+        elif isinstance(value, dict):
+            for v in value.values():
+                visit(v, depth - 1)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                visit(v, depth - 1)
+        elif hasattr(value, "__dict__"):
+            for v in vars(value).values():
+                visit(v, depth - 1)
+
+    for key, value in vars(model).items():
+        if key == "onnx_session":
+            onnxModelFile = getattr(model.settings, "onnxModelFile", None)
+            if value is not None and onnxModelFile and os.path.exists(onnxModelFile):
+                footprint["onnx"] += os.path.getsize(onnxModelFile)
+            continue
+        visit(value, FOOTPRINT_SEARCH_DEPTH)
+    return footprint
+
+
+class CachedModel():
+    def __init__(self, entryId: str, key: tuple, model, loadTime: float, warmup: dict):
+        self.entryId = entryId
+        self.key = key
+        self.model = model
+        self.loadTime = loadTime
+        self.warmup = warmup  # VoiceChanger.warmup の結果。キャッシュから切り替えた時に ready などの状態として使う
+        self.footprint = estimate_footprint(model)
+        self.size = sum(self.footprint.values())
+        self.hits = 0
+        self.lastUsed = time.time()
+
+    def get_info(self):
+        modelType, config, pyTorchModel, onnxModel, clusterModel = self.key
+        return {
+            "modelType": modelType,
+            "configFile": os.path.basename(config) if config else "",
+            "pyTorchModelFile": os.path.basename(pyTorchModel) if pyTorchModel else "",
+            "onnxModelFile": os.path.basename(onnxModel) if onnxModel else "",
+            "clusterTorchModelFile": os.path.basename(clusterModel) if clusterModel else "",
+            "footprintMB": self.size / 1024 / 1024,
+            "footprint": self.footprint,
+            "loadTime": self.loadTime,
+            "hits": self.hits,
+            "lastUsed": self.lastUsed,
+        }
+
+
+class ModelCache():
+    """ ロード済みのモデルを (モデルタイプ, config, PyTorchの重み, ONNXの重み, クラスタ) をキーに保持する。
+    重みの合計が budgetMB を超えたら、最近使われていないものから捨てる(追加したモデルと protected のモデルは捨てない)。
+    捨てたモデルは戻り値で返すので、呼び出し側で destroy すること。
+    """
+
+    def __init__(self, budgetMB: int = DEFAULT_MODEL_CACHE_BUDGET_MB):
+        self.budgetMB = budgetMB
+        self.entries: OrderedDict[str, CachedModel] = OrderedDict()  # 古い順
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(modelType: str, config: str, pyTorchModel: str, onnxModel: str, clusterModel: str):
+        """ キーと、設定(activeModel)で指定するための短いIDを返す。
+        同じファイル名で上書きアップロードされた場合に古い重みを使わないように、IDにはファイルの更新時刻も含める。 """
+        key = (modelType, config, pyTorchModel, onnxModel, clusterModel)
+        mtimes = [os.path.getmtime(x) if x and os.path.exists(x) else 0 for x in key[1:]]
+        entryId = hashlib.sha1("\n".join([str(x) for x in list(key) + mtimes]).encode("utf-8")).hexdigest()[:8]
+        return key, entryId
+
+    def get(self, entryId: str):
+        with self.lock:
+            entry = self.entries.get(entryId)
+            if entry is None:
+                return None
+            self.entries.move_to_end(entryId)
+            entry.hits += 1
+            entry.lastUsed = time.time()
+            return entry.model
+
+    def get_warmup(self, entryId: str):
+        with self.lock:
+            entry = self.entries.get(entryId)
+            return entry.warmup if entry is not None else None
+
+    def contains(self, model):
+        with self.lock:
+            return any([entry.model is model for entry in self.entries.values()])
+
+    def find_entry_id(self, model):
+        with self.lock:
+            for entryId, entry in self.entries.items():
+                if entry.model is model:
+                    return entryId
+            return ""
+
+    def put(self, entryId: str, key: tuple, model, loadTime: float, warmup: dict, protected: list = []):
+        """ 追加したモデルと protected のモデルは捨てない。捨てたモデルのリストを返す。 """
+        entry = CachedModel(entryId, key, model, loadTime, warmup)
+        with self.lock:
+            previous = self.entries.pop(entryId, None)
+            self.entries[entryId] = entry
+            evicted = self._evict([model] + protected)
+            if previous is not None and previous.model is not model and all([previous.model is not x for x in protected]):
+                evicted.append(previous.model)
+            return evicted
+
+    def set_budget(self, budgetMB: int, protected: list = []):
+        with self.lock:
+            self.budgetMB = budgetMB
+            return self._evict(protected)
+
+    def _evict(self, protected: list):
+        # lock を保持した状態で呼ぶこと
+        evicted = []
+        for entryId in list(self.entries.keys()):
+            if self._used_bytes() <= self.budgetMB * 1024 * 1024:
+                break
+            entry = self.entries[entryId]
+            if any([entry.model is model for model in protected]):
+                continue
+            del self.entries[entryId]
+            self.evictions += 1
+            evicted.append(entry.model)
+            print(f"[ModelCache] evict {entryId} ({entry.size / 1024 / 1024:.1f}MB)")
+        return evicted
+
+    def _used_bytes(self):
+        return sum([entry.size for entry in self.entries.values()])
+
+    def get_info(self):
+        with self.lock:
+            return {
+                "budgetMB": self.budgetMB,
+                "usedMB": self._used_bytes() / 1024 / 1024,
+                "evictions": self.evictions,
+                "entries": {entryId: entry.get_info() for entryId, entry in reversed(self.entries.items())},
+            }
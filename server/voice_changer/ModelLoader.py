@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+import traceback
+import uuid
+from dataclasses import dataclass, asdict, field
+from typing import Callable
+
+MAX_JOBS = 16  # 状態を問い合わせられるように残しておくジョブの数。超えたら終わったものから捨てる
+
+LOAD_STATUS_QUEUED = "queued"
+LOAD_STATUS_LOADING = "loading"
+LOAD_STATUS_WARMUP = "warmup"
+LOAD_STATUS_SWAPPING = "swapping"
+LOAD_STATUS_DONE = "done"
+LOAD_STATUS_FAILED = "failed"
+
+
+@dataclass
+class LoadJob():
+    jobId: str
+    status: str = LOAD_STATUS_QUEUED
+    progress: float = 0.0  # 0.0 - 1.0
+    createdAt: float = 0.0  # time.time()
+    queueTime: float = 0.0  # sec. 前のジョブの終了を待った時間
+    loadTime: float = 0.0  # sec. 重みの読み込みとモデルの生成
+    warmupTime: float = 0.0
+    swapTime: float = 0.0  # sec. 差し替えと古いモデルの解放
+    totalTime: float = 0.0
+    error: str = ""
+    info: dict = field(default_factory=dict)  # 終わった時のモデルの情報
+
+    def set_progress(self, status: str, progress: float):
+        self.status = status
+        self.progress = max(self.progress, min(progress, 1.0))
+
+
+class ModelLoader():
+    """ モデルのロードを専用のスレッドで1件ずつ実行する。
+    load には LoadJob を渡すので、進み具合(status, progress)と段階ごとの時間は load の中で job に書き込むこと。
+    load の戻り値(モデルの情報)は job.info に入る。
+    """
+
+    def __init__(self, load: Callable[[LoadJob, tuple], dict]):
+        self.load = load
+        self.queue: queue.Queue = queue.Queue()
+        self.jobs: dict[str, LoadJob] = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="model-loader", daemon=True)
+        self.thread.start()
+
+    def submit(self, *args):
+        job = LoadJob(jobId=uuid.uuid4().hex, createdAt=time.time())
+        with self.lock:
+            self._evict_finished_jobs()
+            self.jobs[job.jobId] = job
+        self.queue.put((job, args, time.perf_counter()))
+        print(f"[ModelLoader] submit job: {job.jobId} (queued:{self.queue.qsize()})")
+        return job
+
+    def get_job(self, jobId: str):
+        with self.lock:
+            job = self.jobs.get(jobId)
+            return asdict(job) if job is not None else None
+
+    def is_loading(self):
+        with self.lock:
+            return any([job.status not in [LOAD_STATUS_DONE, LOAD_STATUS_FAILED] for job in self.jobs.values()])
+
+    def get_info(self):
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "jobs": {jobId: {"status": job.status, "progress": job.progress, "totalTime": job.totalTime} for jobId, job in self.jobs.items()},
+            }
+
+    def _evict_finished_jobs(self):
+        # lock を保持した状態で呼ぶこと
+        finished = [jobId for jobId, job in self.jobs.items() if job.status in [LOAD_STATUS_DONE, LOAD_STATUS_FAILED]]
+        while len(self.jobs) >= MAX_JOBS and len(finished) > 0:
+            del self.jobs[finished.pop(0)]
+
+    def _run(self):
+        while True:
+            job, args, enqueued = self.queue.get()
+            start = time.perf_counter()
+            job.queueTime = start - enqueued
+            try:
+                job.info = self.load(job, *args)
+                job.set_progress(LOAD_STATUS_DONE, 1.0)
+            except Exception as e:
+                print(f"[ModelLoader] EXCEPTION job:{job.jobId}", e)
+                print(traceback.format_exc())
+                job.error = str(e)
+                job.status = LOAD_STATUS_FAILED
+            job.totalTime = time.perf_counter() - start
+            print(f"[ModelLoader] job {job.jobId} {job.status}: load:{job.loadTime:.2f}sec warmup:{job.warmupTime:.2f}sec "
+                  f"swap:{job.swapTime:.2f}sec total:{job.totalTime:.2f}sec")
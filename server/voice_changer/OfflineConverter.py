@@ -0,0 +1,270 @@
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, field
+
+import numpy as np
+
+from voice_changer.VoiceChanger import VoiceChanger, crossfade_strength
+from voice_changer.VoiceChangerSession import VoiceChangerSession
+from voice_changer.utils.StreamResampler import StreamResampler
+
+MAX_JOBS = 16  # 状態を問い合わせられるように残しておくジョブの数。超えたら終わったものから捨てる
+RESAMPLE_BLOCK = 65536  # 一度にリサンプルする入力のサンプル数(ファイル全体を一度に渡すと作業領域が大きくなりすぎる)
+FRAME_MS = 10  # 無音検出のフレーム長
+
+CONVERT_STATUS_QUEUED = "queued"
+CONVERT_STATUS_CONVERTING = "converting"
+CONVERT_STATUS_DONE = "done"
+CONVERT_STATUS_FAILED = "failed"
+
+
+@dataclass
+class OfflineConvertSettings():
+    workers: int = 2  # セグメントを並列に変換するスレッドの数
+    silenceThresholdDb: float = -40.0  # フレームの RMS の最大値からの相対値。これより小さいフレームを無音とみなす
+    minSilenceMs: int = 300  # 区切りの候補にする無音の長さ
+    maxSegmentSec: float = 15.0  # これより長いセグメントは作らない(無音がなければ一番静かなフレームで区切る)
+    minSegmentSec: float = 2.0
+    marginMs: int = 500  # セグメントの前に付けて変換する文脈(出力からは捨てる)
+
+
+@dataclass
+class ConvertJob():
+    jobId: str
+    inputFile: str
+    outputFile: str
+    status: str = CONVERT_STATUS_QUEUED
+    progress: float = 0.0  # 0.0 - 1.0
+    createdAt: float = 0.0  # time.time()
+    audioSeconds: float = 0.0
+    segments: int = 0
+    queueTime: float = 0.0  # sec. 前のジョブの終了を待った時間
+    segmentTime: float = 0.0  # sec. セグメントの変換時間の合計(並列に実行した分は wall time より大きくなる)
+    totalTime: float = 0.0  # sec. ファイルの読み込みから書き込みまで
+    throughput: float = 0.0  # 変換した音声の秒数 / totalTime
+    error: str = ""
+    settings: dict = field(default_factory=dict)
+
+
+class OfflineConverter():
+    """ 録音済みのファイルを変換する。ファイルを無音の位置でセグメントに区切り、セグメントをスレッドで並列に変換して、
+    VoiceChanger と同じクロスフェードでつなぐ。各セグメントは使い捨てのセッションで一度に推論するので、
+    f0 と HuBERT などの特徴量はセグメント全体(大きな窓)で計算される。
+    ジョブは専用のスレッドで1件ずつ実行する(submit)。convert_file を直接呼ぶと呼び出したスレッドで実行する(CLI)。
+    """
+
+    def __init__(self, voiceChanger: VoiceChanger):
+        self.voiceChanger = voiceChanger
+        self.queue: queue.Queue = queue.Queue()
+        self.jobs: dict[str, ConvertJob] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, inputFile: str, outputFile: str, settings: OfflineConvertSettings):
+        job = ConvertJob(jobId=uuid.uuid4().hex, inputFile=inputFile, outputFile=outputFile, createdAt=time.time(), settings=asdict(settings))
+        with self.lock:
+            self._evict_finished_jobs()
+            self.jobs[job.jobId] = job
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="offline-converter", daemon=True)
+                self.thread.start()
+        self.queue.put((job, settings, time.perf_counter()))
+        print(f"[OfflineConverter] submit job: {job.jobId} {inputFile} (queued:{self.queue.qsize()})")
+        return job
+
+    def get_job(self, jobId: str):
+        with self.lock:
+            job = self.jobs.get(jobId)
+            return asdict(job) if job is not None else None
+
+    def get_info(self):
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "jobs": {jobId: {"status": job.status, "progress": job.progress, "throughput": job.throughput} for jobId, job in self.jobs.items()},
+            }
+
+    def _evict_finished_jobs(self):
+        # lock を保持した状態で呼ぶこと
+        finished = [jobId for jobId, job in self.jobs.items() if job.status in [CONVERT_STATUS_DONE, CONVERT_STATUS_FAILED]]
+        while len(self.jobs) >= MAX_JOBS and len(finished) > 0:
+            del self.jobs[finished.pop(0)]
+
+    def _run(self):
+        while True:
+            job, settings, enqueued = self.queue.get()
+            job.queueTime = time.perf_counter() - enqueued
+            try:
+                self.convert_file(job.inputFile, job.outputFile, settings, job)
+            except Exception as e:
+                print(f"[OfflineConverter] EXCEPTION job:{job.jobId}", e)
+                print(traceback.format_exc())
+                job.error = str(e)
+                job.status = CONVERT_STATUS_FAILED
+
+    def convert_file(self, inputFile: str, outputFile: str, settings: OfflineConvertSettings, job: ConvertJob = None):
+        """ inputFile(16bit PCM の wav)を変換して outputFile に同じサンプリングレートで書き出す。進み具合と時間は job に書き込んで返す。 """
+        job = job if job is not None else ConvertJob(jobId="", inputFile=inputFile, outputFile=outputFile, settings=asdict(settings))
+        job.status = CONVERT_STATUS_CONVERTING
+        start = time.perf_counter()
+
+        audio, sampleRate = read_wav(inputFile)
+        job.audioSeconds = len(audio) / sampleRate
+        quality = self.voiceChanger.settings.resampleQuality
+
+        active = self.voiceChanger._acquire_model()
+        try:
+            generation = active.generation
+            processingRate = active.model.get_processing_sampling_rate()
+        finally:
+            self.voiceChanger._release_model(active)
+
+        data = resample_offline(audio, sampleRate, processingRate, quality)
+        boundaries = split_at_silences(data, processingRate, settings)
+        job.segments = len(boundaries) - 1
+        crossfadeSize = self.voiceChanger.settings.crossFadeOverlapSize
+        margin = processingRate * settings.marginMs // 1000
+
+        done = [0]
+        doneLock = threading.Lock()
+
+        def convert(index: int):
+            segmentStart = time.perf_counter()
+            segStart, segEnd = boundaries[index], boundaries[index + 1]
+            inputStart = max(segStart - margin, 0)
+            inputEnd = min(segEnd + crossfadeSize, len(data))  # 次のセグメントとのクロスフェードの分を余分に変換する
+            out = self._convert_segment(data[inputStart:inputEnd], crossfadeSize, generation, f"offline-{job.jobId}-{index}")
+            with doneLock:
+                done[0] += 1
+                job.segmentTime += time.perf_counter() - segmentStart
+                job.progress = done[0] / job.segments
+            return out[segStart - inputStart:]
+
+        with ThreadPoolExecutor(max_workers=max(settings.workers, 1), thread_name_prefix="offline-segment") as pool:
+            outputs = list(pool.map(convert, range(job.segments)))
+
+        result = stitch(outputs, boundaries, self.voiceChanger.settings.crossFadeOffsetRate, self.voiceChanger.settings.crossFadeEndRate)
+        result = resample_offline(result, processingRate, sampleRate, quality)
+        write_wav(outputFile, np.clip(result, -32768, 32767).astype(np.int16), sampleRate)
+
+        job.totalTime = time.perf_counter() - start
+        job.throughput = job.audioSeconds / job.totalTime if job.totalTime > 0 else 0.0
+        job.status = CONVERT_STATUS_DONE
+        job.progress = 1.0
+        print(f"[OfflineConverter] {inputFile} -> {outputFile}: {job.audioSeconds:.1f}sec audio, {job.segments} segments, "
+              f"segment:{job.segmentTime:.2f}sec total:{job.totalTime:.2f}sec ({job.throughput:.2f} audio-sec/sec)")
+        return job
+
+    def _convert_segment(self, data: np.ndarray, crossfadeSize: int, generation: int, sessionId: str):
+        # セグメントごとに新しいセッションを使うので、バッファや f0, コンテンツのキャッシュは前のセグメントを引き継がない
+        session = VoiceChangerSession(sessionId)
+        session.resampleQuality = self.voiceChanger.settings.resampleQuality
+        active = self.voiceChanger._acquire_model()
+        try:
+            if active.generation != generation:
+                raise RuntimeError("model was switched while converting the file")
+            model = active.model
+            inputs = model.generate_input(data, data.shape[0], min(crossfadeSize, data.shape[0]), session)
+            audio = model.inference(inputs, session)
+        finally:
+            self.voiceChanger._release_model(active)
+        if audio.shape[0] < data.shape[0]:
+            raise RuntimeError(f"model output is shorter than the input ({audio.shape[0]} < {data.shape[0]})")
+        return np.array(audio[-data.shape[0]:], dtype=np.float64)  # 出力は窓の末尾にそろっている
+
+
+def split_at_silences(audio: np.ndarray, sampleRate: int, settings: OfflineConvertSettings):
+    """ セグメントの境界(先頭 0 と末尾 len(audio) を含む)。maxSegmentSec を超えないよう、
+    [minSegmentSec, maxSegmentSec] の範囲にある一番後ろの無音の中央で区切る。範囲に無音がなければ一番静かなフレームで区切る。
+    """
+    frame = max(sampleRate * FRAME_MS // 1000, 1)
+    frameNum = len(audio) // frame
+    maxLen = int(settings.maxSegmentSec * sampleRate)
+    minLen = min(int(settings.minSegmentSec * sampleRate), maxLen)
+    if len(audio) <= maxLen or frameNum == 0:
+        return [0, len(audio)]
+
+    rms = np.sqrt(np.mean(np.square(audio[:frameNum * frame].reshape(frameNum, frame)), axis=1))
+    db = 20 * np.log10(rms / max(rms.max(), 1e-9) + 1e-12)
+    silent = db < settings.silenceThresholdDb
+
+    # 無音が minSilenceMs 以上続く区間の中央を区切りの候補にする
+    candidates = []
+    minSilenceFrames = max(settings.minSilenceMs // FRAME_MS, 1)
+    runStart = None
+    for i, s in enumerate(list(silent) + [False]):
+        if s and runStart is None:
+            runStart = i
+        elif not s and runStart is not None:
+            if i - runStart >= minSilenceFrames:
+                candidates.append((runStart + i) // 2 * frame)
+            runStart = None
+
+    boundaries = [0]
+    while len(audio) - boundaries[-1] > maxLen:
+        pos = boundaries[-1]
+        inRange = [c for c in candidates if pos + minLen <= c <= pos + maxLen]
+        if len(inRange) > 0:
+            cut = inRange[-1]
+        else:
+            lo = (pos + minLen) // frame
+            hi = max(min((pos + maxLen) // frame, frameNum), lo + 1)
+            cut = (lo + int(np.argmin(rms[lo:hi]))) * frame
+        boundaries.append(max(cut, pos + 1))
+    boundaries.append(len(audio))
+    return boundaries
+
+
+def stitch(outputs: list, boundaries: list, offsetRate: float, endRate: float):
+    """ outputs[i] は boundaries[i] から始まり、次のセグメントの先頭と重なる分だけ長い。重なりを VoiceChanger と同じ重みでクロスフェードしてつなぐ。 """
+    result = [outputs[0][:boundaries[1] - boundaries[0]]]
+    tail = outputs[0][boundaries[1] - boundaries[0]:]
+    for i in range(1, len(outputs)):
+        out = outputs[i]
+        overlap = min(len(tail), len(out))
+        if overlap > 0:
+            prevStrength, curStrength = crossfade_strength(overlap, offsetRate, endRate)
+            out = np.concatenate([tail[:overlap] * prevStrength + out[:overlap] * curStrength, out[overlap:]])
+        length = boundaries[i + 1] - boundaries[i]
+        result.append(out[:length])
+        tail = out[length:]
+    return np.concatenate(result)
+
+
+def resample_offline(audio: np.ndarray, srcRate: int, dstRate: int, quality: str):
+    """ ファイル全体のリサンプル。StreamResampler の固定遅延の分を末尾に無音を足して押し出し、先頭から取り除く。 """
+    if srcRate == dstRate:
+        return audio.astype(np.float64)
+    resampler = StreamResampler(srcRate, dstRate, quality)
+    padded = np.concatenate([audio.astype(np.float64), np.zeros(resampler.filter.delay * 2)])
+    out = np.concatenate([resampler.resample(padded[i:i + RESAMPLE_BLOCK]) for i in range(0, len(padded), RESAMPLE_BLOCK)])
+    delay = int(round(resampler.filter.delay * dstRate / srcRate))
+    length = int(round(len(audio) * dstRate / srcRate))
+    return out[delay:delay + length]
+
+
+def read_wav(filename: str):
+    """ 16bit PCM の wav を読み込んで(ステレオはモノラルにまとめて) int16 のスケールの float64 とサンプリングレートを返す。 """
+    with wave.open(filename, "rb") as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f"only 16bit PCM wav is supported: {filename} ({f.getsampwidth() * 8}bit)")
+        channels = f.getnchannels()
+        sampleRate = f.getframerate()
+        frames = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+    audio = frames.reshape(-1, channels).mean(axis=1)
+    return audio, sampleRate
+
+
+def write_wav(filename: str, audio: np.ndarray, sampleRate: int):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with wave.open(filename, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sampleRate)
+        f.writeframes(audio.astype(np.int16).tobytes())
@@ -11,18 +11,27 @@ else:
     sys.path.append("so-vits-svc-40v2")
 
 import io
+import time
 from dataclasses import dataclass, asdict, field
 from functools import reduce
 import numpy as np
 import torch
-import onnxruntime
 import pyworld as pw
 
 from models import SynthesizerTrn
 import cluster
 import utils
-from fairseq import checkpoint_utils
-import librosa
+from voice_changer.VoiceChangerSession import VoiceChangerSession
+from voice_changer.utils.RingBuffer import RingBuffer
+from voice_changer.utils.SilenceGate import SilenceGateStats
+from voice_changer.utils.ContentUnitCache import ContentUnitCacheStats
+from voice_changer.utils.InferenceBatcher import InferenceBatcher, onnx_batch_supported
+from voice_changer.utils.OnnxSessionFactory import OnnxSessionFactory
+from voice_changer.utils.MappedWeights import MappedWeights
+from voice_changer.utils.ShapeBucketing import ShapeBuckets
+from voice_changer.utils.OnnxIOBinding import OnnxIOBindingStats
+from voice_changer.utils.ContentEncoderRegistry import DeviceEncoder, load_fairseq_hubert
+from voice_changer.utils.LatencyMetrics import LatencyMetrics, STAGE_F0, STAGE_UNITS
 providers = ['OpenVINOExecutionProvider', "CUDAExecutionProvider", "DmlExecutionProvider", "CPUExecutionProvider"]
 
 
@@ -36,6 +45,8 @@ class SoVitsSvc40v2Settings():
     noiceScale: float = 0.3
     predictF0: int = 0  # 0:False, 1:True
     silentThreshold: float = 0.00001
+    silentHangoverMs: int = 200  # 音量が閾値を下回ってからも変換を続ける時間
+    unitMarginMs: int = 200  # content unitを差分でエンコードするときに前後に余分にエンコードする時間
     extraConvertSize: int = 1024 * 32
     clusterInferRatio: float = 0.1
 
@@ -49,7 +60,7 @@ class SoVitsSvc40v2Settings():
     )
 
     # ↓mutableな物だけ列挙
-    intData = ["gpu", "dstId", "tran", "predictF0", "extraConvertSize"]
+    intData = ["gpu", "dstId", "tran", "predictF0", "extraConvertSize", "silentHangoverMs", "unitMarginMs"]
     floatData = ["noiceScale", "silentThreshold", "clusterInferRatio"]
     strData = ["framework", "f0Detector"]
 
@@ -59,10 +70,18 @@ class SoVitsSvc40v2:
         self.settings = SoVitsSvc40v2Settings()
         self.net_g = None
         self.onnx_session = None
+        self.hubert = None
+        self.onnxSessionFactory = OnnxSessionFactory.get_instance()
+        self.shapeBuckets = ShapeBuckets.get_instance()
+        self.metrics = LatencyMetrics.get_instance()
+        self.ioBindingStats = OnnxIOBindingStats()
+        self.silenceStats = SilenceGateStats()
+        self.contentCacheStats = ContentUnitCacheStats()
+        self.onnxBatchable = False
+        self.batcher = InferenceBatcher.get_instance()
 
         self.raw_path = io.BytesIO()
         self.gpu_num = torch.cuda.device_count()
-        self.prevVol = 0
         self.params = params
         print("so-vits-svc 40v2 initialization:", params)
 
@@ -72,21 +91,14 @@ class SoVitsSvc40v2:
         self.hps = utils.get_hparams_from_file(config)
         self.settings.speakers = self.hps.spk
 
-        # hubert model
+        # hubert model(プロセスで共有する)
         try:
             # if sys.platform.startswith('darwin'):
             #     vec_path = os.path.join(sys._MEIPASS, "hubert/checkpoint_best_legacy_500.pt")
             # else:
             #     vec_path = "hubert/checkpoint_best_legacy_500.pt"
             vec_path = self.params["hubert"]
-
-            models, saved_cfg, task = checkpoint_utils.load_model_ensemble_and_task(
-                [vec_path],
-                suffix="",
-            )
-            model = models[0]
-            model.eval()
-            self.hubert_model = model.cpu()
+            self.hubert = DeviceEncoder("hubert", vec_path, lambda: load_fairseq_hubert(vec_path))
         except Exception as e:
             print("EXCEPTION during loading hubert/contentvec model", e)
 
@@ -110,16 +122,12 @@ class SoVitsSvc40v2:
                 self.hps
             )
             self.net_g.eval()
-            utils.load_checkpoint(pyTorch_model_file, self.net_g, None)
+            MappedWeights.get_instance().load(pyTorch_model_file, self.net_g, utils.load_checkpoint)
 
         # ONNXモデル生成
         if onnx_model_file != None:
-            ort_options = onnxruntime.SessionOptions()
-            ort_options.intra_op_num_threads = 8
-            self.onnx_session = onnxruntime.InferenceSession(
-                onnx_model_file,
-                providers=providers
-            )
+            self.onnx_session = self.onnxSessionFactory.create(onnx_model_file, providers)
+            self.onnxBatchable = onnx_batch_supported(self.onnx_session)
             input_info = self.onnx_session.get_inputs()
         return self.get_info()
 
@@ -132,6 +140,12 @@ class SoVitsSvc40v2:
                 self.onnx_session.set_providers(providers=[val], provider_options=provider_options)
             else:
                 self.onnx_session.set_providers(providers=[val])
+        elif key in self.onnxSessionFactory.settings.intData or key in self.onnxSessionFactory.settings.strData:
+            # SessionOptions はセッション生成時にしか反映されないので作り直す
+            if self.onnxSessionFactory.update_setteings(key, val) == False:
+                return False
+            if self.onnx_session != None and self.onnxSessionFactory.is_session_option(key):
+                self.onnx_session = self.onnxSessionFactory.recreate(self.onnx_session, self.settings.onnxModelFile)
         elif key in self.settings.intData:
             setattr(self.settings, key, int(val))
             if key == "gpu" and val >= 0 and val < self.gpu_num and self.onnx_session != None:
@@ -153,6 +167,8 @@ class SoVitsSvc40v2:
         data = asdict(self.settings)
 
         data["onnxExecutionProviders"] = self.onnx_session.get_providers() if self.onnx_session != None else []
+        data.update(self.onnxSessionFactory.get_info(self.onnx_session))
+        data["ioBinding"] = self.ioBindingStats.get_info()
         files = ["configFile", "pyTorchModelFile", "onnxModelFile"]
         for f in files:
             if data[f] != None and os.path.exists(data[f]):
@@ -160,19 +176,49 @@ class SoVitsSvc40v2:
             else:
                 data[f] = ""
 
+        data["silenceGate"] = self.silenceStats.get_info()
+        data["contentCache"] = self.contentCacheStats.get_info()
         return data
 
     def get_processing_sampling_rate(self):
         return self.hps.data.sampling_rate
 
-    def get_unit_f0(self, audio_buffer, tran):
+    def compute_f0(self, session: VoiceChangerSession, convertSize: int):
+        # バッファ全体ではなく、前回からの差分だけをf0解析する(IncrementalF0Tracker)
+        sampling_rate = self.hps.data.sampling_rate
+        hop_length = self.hps.data.hop_length
+        if self.settings.f0Detector == "dio":
+            framePeriod = 1000 * hop_length / sampling_rate
+            def analyze(wav): return compute_f0_dio_frames(wav, sampling_rate=sampling_rate, hop_length=hop_length)
+        else:
+            framePeriod = 5.5
+            def analyze(wav): return compute_f0_harvest_frames(wav, sampling_rate=sampling_rate)
+        tracker = session.get_f0_tracker(self.settings.f0Detector, (sampling_rate, hop_length), analyze, sampling_rate, framePeriod)
+        f0 = tracker.update(session.audio_buffer, convertSize)
+        return resize_f0(f0, convertSize // hop_length)
+
+    def get_content(self, session: VoiceChangerSession, convertSize16k: int, dev: torch.device):
+        # hubertはバッファ全体ではなく、前回からの差分だけをエンコードする(ContentUnitCache)。戻り値は (256, フレーム数)
+        hubert = self.hubert.get(dev)  # デバイスが変わった時もディスクからは読み直さない
+
+        def encode(wav):
+            c = utils.get_hubert_content(hubert, wav_16k_tensor=torch.from_numpy(wav).to(dev))
+            return c.squeeze(0).transpose(0, 1).cpu().numpy()
+
+        def frameCount(size):
+            return max((size - 400) // 320 + 1, 1)
+        cache = session.get_content_cache("hubert", (id(hubert), str(dev), self.settings.unitMarginMs),
+                                          encode, 320, 16000, self.settings.unitMarginMs, frameCount, self.contentCacheStats)
+        units = cache.update(session.audio_buffer_16k, convertSize16k)
+        return torch.from_numpy(np.ascontiguousarray(units.T)).to(dev)
+
+    def get_unit_f0(self, audio_buffer, wav16k, tran, session: VoiceChangerSession):
         wav_44k = audio_buffer
         # f0 = utils.compute_f0_parselmouth(wav, sampling_rate=self.target_sample, hop_length=self.hop_size)
         # f0 = utils.compute_f0_dio(wav_44k, sampling_rate=self.hps.data.sampling_rate, hop_length=self.hps.data.hop_length)
-        if self.settings.f0Detector == "dio":
-            f0 = compute_f0_dio(wav_44k, sampling_rate=self.hps.data.sampling_rate, hop_length=self.hps.data.hop_length)
-        else:
-            f0 = compute_f0_harvest(wav_44k, sampling_rate=self.hps.data.sampling_rate, hop_length=self.hps.data.hop_length)
+
+        with self.metrics.stage(STAGE_F0):
+            f0 = self.compute_f0(session, wav_44k.shape[0])
 
         if wav_44k.shape[0] % self.hps.data.hop_length != 0:
             print(f" !!! !!! !!! wav size not multiple of hopsize: {wav_44k.shape[0] / self.hps.data.hop_length}")
@@ -184,22 +230,17 @@ class SoVitsSvc40v2:
         f0 = f0.unsqueeze(0)
         uv = uv.unsqueeze(0)
 
-        # wav16k = librosa.resample(audio_buffer, orig_sr=24000, target_sr=16000)
-        wav16k = librosa.resample(audio_buffer, orig_sr=self.hps.data.sampling_rate, target_sr=16000)
-        wav16k = torch.from_numpy(wav16k)
-
         if (self.settings.gpu < 0 or self.gpu_num == 0) or self.settings.framework == "ONNX":
             dev = torch.device("cpu")
         else:
             dev = torch.device("cuda", index=self.settings.gpu)
 
-        self.hubert_model = self.hubert_model.to(dev)
-        wav16k = wav16k.to(dev)
         uv = uv.to(dev)
         f0 = f0.to(dev)
 
-        c = utils.get_hubert_content(self.hubert_model, wav_16k_tensor=wav16k)
-        c = utils.repeat_expand_2d(c.squeeze(0), f0.shape[1])
+        with self.metrics.stage(STAGE_UNITS):
+            c = self.get_content(session, wav16k.shape[0], dev)
+        c = utils.repeat_expand_2d(c, f0.shape[1])
 
         if self.settings.clusterInferRatio != 0 and hasattr(self, "cluster_model") and self.cluster_model != None:
             speaker = [key for key, value in self.settings.speakers.items() if value == self.settings.dstId]
@@ -215,31 +256,50 @@ class SoVitsSvc40v2:
         c = c.unsqueeze(0)
         return c, f0, uv
 
-    def generate_input(self, newData: any, inputSize: int, crossfadeSize: int):
-        newData = newData.astype(np.float32) / self.hps.data.max_wav_value
-
-        if hasattr(self, "audio_buffer"):
-            self.audio_buffer = np.concatenate([self.audio_buffer, newData], 0)  # 過去のデータに連結
-        else:
-            self.audio_buffer = newData
-
+    def generate_input(self, newData: any, inputSize: int, crossfadeSize: int, session: VoiceChangerSession):
         convertSize = inputSize + crossfadeSize + self.settings.extraConvertSize
 
         if convertSize % self.hps.data.hop_length != 0:  # モデルの出力のホップサイズで切り捨てが発生するので補う。
             convertSize = convertSize + (self.hps.data.hop_length - (convertSize % self.hps.data.hop_length))
-
-        self.audio_buffer = self.audio_buffer[-1 * convertSize:]  # 変換対象の部分だけ抽出
-
-        crop = self.audio_buffer[-1 * (inputSize + crossfadeSize):-1 * (crossfadeSize)]
+        convertSize = self.shapeBuckets.bucket(convertSize, self.hps.data.hop_length)  # 推論の入力の形の種類をバケットの数に抑える
+        session.convertSize = convertSize
+
+        if session.audio_buffer is None:
+            session.audio_buffer = RingBuffer(convertSize)
+            session.audio_buffer.append(np.zeros(convertSize))  # 起動直後から窓の長さ(形)が一定になるよう、無音を受け取ったことにしておく
+        session.audio_buffer.ensure_capacity(convertSize)
+        session.audio_buffer.append(newData, 1.0 / self.hps.data.max_wav_value)  # 過去のデータに連結
+        audio_buffer = session.audio_buffer.latest(convertSize)  # 変換対象の部分だけ抽出
+
+        # hubert用の16kHzの音声は、新しいチャンクだけをストリーミングでリサンプルして別のバッファに持つ。
+        convertSize16k = -(-convertSize * 16000 // self.hps.data.sampling_rate)
+        if session.audio_buffer_16k is None:
+            session.audio_buffer_16k = RingBuffer(convertSize16k)
+            session.audio_buffer_16k.append(np.zeros(convertSize16k))
+        session.audio_buffer_16k.ensure_capacity(convertSize16k)
+        newData16k = session.get_resampler("16k", self.hps.data.sampling_rate, 16000).resample(newData)
+        session.audio_buffer_16k.append(newData16k, 1.0 / self.hps.data.max_wav_value)
+        wav16k = session.audio_buffer_16k.latest(convertSize16k)
+
+        crop = audio_buffer[-1 * (inputSize + crossfadeSize):-1 * (crossfadeSize)]
 
         rms = np.sqrt(np.square(crop).mean(axis=0))
-        vol = max(rms, self.prevVol * 0.0)
-        self.prevVol = vol
-
-        c, f0, uv = self.get_unit_f0(self.audio_buffer, self.settings.tran)
+        vol = max(rms, session.prevVol * 0.0)
+        session.prevVol = vol
+
+        # 無音ならf0, hubert, クラスタの計算も推論もしない。
+        hangoverSamples = self.settings.silentHangoverMs * self.hps.data.sampling_rate // 1000
+        if session.silenceGate.is_silent(vol, self.settings.silentThreshold, hangoverSamples, inputSize):
+            self.silenceStats.add_skipped()
+            return (None, None, None, convertSize, vol)
+
+        start = time.perf_counter()
+        c, f0, uv = self.get_unit_f0(audio_buffer, wav16k, self.settings.tran, session)
+        self.silenceStats.add_processed()
+        self.silenceStats.add_process_time(time.perf_counter() - start)
         return (c, f0, uv, convertSize, vol)
 
-    def _onnx_inference(self, data):
+    def _onnx_inference(self, data, session: VoiceChangerSession = None):
         if hasattr(self, "onnx_session") == False or self.onnx_session == None:
             print("[Voice Changer] No onnx session.")
             return np.zeros(1).astype(np.int16)
@@ -248,22 +308,19 @@ class SoVitsSvc40v2:
         vol = data[4]
         data = (data[0], data[1], data[2],)
 
-        if vol < self.settings.silentThreshold:
+        if data[0] is None:  # generate_input で無音と判定済み
             return np.zeros(convertSize).astype(np.int16)
 
-        c, f0, uv = [x.numpy() for x in data]
-        audio1 = self.onnx_session.run(
-            ["audio"],
-            {
-                "c": c,
-                "f0": f0,
-                "g": np.array([self.settings.dstId]).astype(np.int64),
-                "uv": np.array([self.settings.dstId]).astype(np.int64),
-                "predict_f0": np.array([self.settings.dstId]).astype(np.int64),
-                "noice_scale": np.array([self.settings.dstId]).astype(np.int64),
+        if self._use_io_binding(session):
+            # 出力バッファ上で max_wav_value と音量をまとめて掛ける
+            runner = session.get_onnx_runner(self.onnx_session, "audio", self.ioBindingStats)
+            return runner.run(self._onnx_feed([data]), self.hps.data.max_wav_value * vol)[0, 0]
 
-
-            })[0][0, 0] * self.hps.data.max_wav_value
+        if self.onnxBatchable == False:
+            audio1 = self._onnx_batch([data])[0]
+        else:
+            key = (id(self), "ONNX", tuple(data[0].shape), tuple(data[1].shape))
+            audio1 = self.batcher.run(key, data, self._onnx_batch)
 
         audio1 = audio1 * vol
 
@@ -271,7 +328,28 @@ class SoVitsSvc40v2:
 
         return result
 
-        pass
+    def _use_io_binding(self, session: VoiceChangerSession):
+        # IOBinding のバッファはセッションごとなので、別セッションとまとめて実行する時は通常の run を使う
+        return session is not None and self.onnxSessionFactory.settings.onnxIOBinding == 1 and \
+            (self.onnxBatchable == False or self.batcher.windowMs <= 0 or self.batcher.maxBatchSize <= 1)
+
+    def _onnx_feed(self, items):
+        c, f0, _uv = [torch.cat(x).numpy() for x in zip(*items)]
+        return {
+            "c": c,
+            "f0": f0,
+            "g": np.array([self.settings.dstId] * len(items)).astype(np.int64),
+            "uv": np.array([self.settings.dstId] * len(items)).astype(np.int64),
+            "predict_f0": np.array([self.settings.dstId]).astype(np.int64),
+            "noice_scale": np.array([self.settings.dstId]).astype(np.int64),
+        }
+
+    def _onnx_batch(self, items):
+        feed = self._onnx_feed(items)
+        start = time.perf_counter()
+        audio1 = self.onnx_session.run(["audio"], feed)[0][:, 0] * self.hps.data.max_wav_value
+        self.ioBindingStats.add_plain(time.perf_counter() - start)
+        return list(audio1)
 
     def _pyTorch_inference(self, data):
         if hasattr(self, "net_g") == False or self.net_g == None:
@@ -287,36 +365,50 @@ class SoVitsSvc40v2:
         vol = data[4]
         data = (data[0], data[1], data[2],)
 
-        if vol < self.settings.silentThreshold:
+        if data[0] is None:  # generate_input で無音と判定済み
             return np.zeros(convertSize).astype(np.int16)
 
+        # 音量によるスケーリングと無音判定はリクエストごと。モデルの実行だけを別セッションとまとめる。
+        key = (id(self), "pyTorch", str(dev), tuple(data[0].shape), tuple(data[1].shape))
+        audio1 = self.batcher.run(key, data, lambda items: self._pyTorch_batch(items, dev))
+
+        audio1 = audio1 * vol
+
+        result = audio1.float().cpu().numpy()
+
+        # result = infer_tool.pad_array(result, length)
+        return result
+
+    def _pyTorch_batch(self, items, dev):
         with torch.no_grad():
-            c, f0, uv = [x.to(dev)for x in data]
-            sid_target = torch.LongTensor([self.settings.dstId]).to(dev)
+            c, f0, uv = [torch.cat(x).to(dev) for x in zip(*items)]
+            sid_target = torch.LongTensor([self.settings.dstId] * len(items)).to(dev)
             self.net_g.to(dev)
             # audio1 = self.net_g.infer(c, f0=f0, g=sid_target, uv=uv, predict_f0=True, noice_scale=0.1)[0][0, 0].data.float()
             predict_f0_flag = True if self.settings.predictF0 == 1 else False
             audio1 = self.net_g.infer(c, f0=f0, g=sid_target, uv=uv, predict_f0=predict_f0_flag,
-                                      noice_scale=self.settings.noiceScale)[0][0, 0].data.float()
+                                      noice_scale=self.settings.noiceScale)[0][:, 0].data.float()
             audio1 = audio1 * self.hps.data.max_wav_value
+        return list(audio1)
 
-            audio1 = audio1 * vol
-
-            result = audio1.float().cpu().numpy()
-
-            # result = infer_tool.pad_array(result, length)
-        return result
-
-    def inference(self, data):
+    def inference(self, data, session: VoiceChangerSession = None):
+        start = time.perf_counter()
         if self.settings.framework == "ONNX":
-            audio = self._onnx_inference(data)
+            audio = self._onnx_inference(data, session)
         else:
             audio = self._pyTorch_inference(data)
+        if data[0] is not None:
+            self.silenceStats.add_process_time(time.perf_counter() - start)
+            if session is not None:
+                self.shapeBuckets.add_latency(session.convertSize, time.perf_counter() - start)
         return audio
 
     def destroy(self):
         del self.net_g
         del self.onnx_session
+        if self.hubert is not None:
+            self.hubert.release()
+            self.hubert = None
 
 
 def resize_f0(x, target_len):
@@ -327,9 +419,7 @@ def resize_f0(x, target_len):
     return res
 
 
-def compute_f0_dio(wav_numpy, p_len=None, sampling_rate=44100, hop_length=512):
-    if p_len is None:
-        p_len = wav_numpy.shape[0] // hop_length
+def compute_f0_dio_frames(wav_numpy, sampling_rate=44100, hop_length=512):
     f0, t = pw.dio(
         wav_numpy.astype(np.double),
         fs=sampling_rate,
@@ -337,16 +427,23 @@ def compute_f0_dio(wav_numpy, p_len=None, sampling_rate=44100, hop_length=512):
         frame_period=1000 * hop_length / sampling_rate,
     )
     f0 = pw.stonemask(wav_numpy.astype(np.double), f0, t, sampling_rate)
-    for index, pitch in enumerate(f0):
-        f0[index] = round(pitch, 1)
-    return resize_f0(f0, p_len)
+    return np.round(f0, 1)
 
 
-def compute_f0_harvest(wav_numpy, p_len=None, sampling_rate=44100, hop_length=512):
+def compute_f0_dio(wav_numpy, p_len=None, sampling_rate=44100, hop_length=512):
     if p_len is None:
         p_len = wav_numpy.shape[0] // hop_length
+    f0 = compute_f0_dio_frames(wav_numpy, sampling_rate=sampling_rate, hop_length=hop_length)
+    return resize_f0(f0, p_len)
+
+
+def compute_f0_harvest_frames(wav_numpy, sampling_rate=44100):
     f0, t = pw.harvest(wav_numpy.astype(np.double), fs=sampling_rate, frame_period=5.5, f0_floor=71.0, f0_ceil=1000.0)
+    return np.round(f0, 1)
+
 
-    for index, pitch in enumerate(f0):
-        f0[index] = round(pitch, 1)
+def compute_f0_harvest(wav_numpy, p_len=None, sampling_rate=44100, hop_length=512):
+    if p_len is None:
+        p_len = wav_numpy.shape[0] // hop_length
+    f0 = compute_f0_harvest_frames(wav_numpy, sampling_rate=sampling_rate)
     return resize_f0(f0, p_len)
@@ -1,19 +1,32 @@
 from const import TMP_DIR, getModelType
-import torch
 import os
+import gc
+import copy
 import traceback
 import numpy as np
 from dataclasses import dataclass, asdict
-import resampy
+import threading
 
 
 from voice_changer.IORecorder import IORecorder
+from voice_changer.VoiceChangerSession import VoiceChangerSession, DEFAULT_SESSION_ID
+from voice_changer.utils.StreamResampler import RESAMPLE_QUALITIES, DEFAULT_RESAMPLE_QUALITY
+from voice_changer.utils.InferenceBatcher import InferenceBatcher
+from voice_changer.utils.OnnxSessionFactory import OnnxSessionFactory
+from voice_changer.utils.ShapeBucketing import ShapeBuckets, DEFAULT_CONVERT_BUCKETS
+from voice_changer.ModelLoader import LoadJob, LOAD_STATUS_LOADING, LOAD_STATUS_WARMUP, LOAD_STATUS_SWAPPING
+from voice_changer.ModelCache import ModelCache, DEFAULT_MODEL_CACHE_BUDGET_MB
+from voice_changer.utils.ContentEncoderRegistry import ContentEncoderRegistry
+from voice_changer.utils.MappedWeights import MappedWeights
+from voice_changer.utils.LatencyMetrics import LatencyMetrics, STAGE_RESAMPLE_IN, STAGE_INFERENCE, STAGE_CROSSFADE, STAGE_RESAMPLE_OUT, STAGE_TOTAL
 # from voice_changer.IOAnalyzer import IOAnalyzer
 
 
 import time
 providers = ['OpenVINOExecutionProvider', "CUDAExecutionProvider", "DmlExecutionProvider", "CPUExecutionProvider"]
 
+WARMUP_SESSION_ID = "__warmup__"
+RELEASE_TIMEOUT = 5.0  # sec. 差し替え前のモデルで処理中のチャンクが終わるのを待つ時間
 STREAM_INPUT_FILE = os.path.join(TMP_DIR, "in.wav")
 STREAM_OUTPUT_FILE = os.path.join(TMP_DIR, "out.wav")
 STREAM_ANALYZE_FILE_DIO = os.path.join(TMP_DIR, "analyze-dio.png")
@@ -29,11 +42,20 @@ class VocieChangerSettings():
     crossFadeOverlapSize: int = 4096
 
     recordIO: int = 0  # 0:off, 1:on
+    sessionTimeout: int = 60  # sec. これ以上リクエストのないセッションは破棄する
+    resampleQuality: str = DEFAULT_RESAMPLE_QUALITY  # fast, kaiser_fast, kaiser_best
+    batchWindowMs: float = 0.0  # 別セッションの推論をまとめるための待ち時間。0:バッチ化しない
+    maxBatchSize: int = 8
+    convertBuckets: str = DEFAULT_CONVERT_BUCKETS  # 変換窓の長さの候補(カンマ区切り)。空文字なら切り上げない
+    warmupChunkSizes: str = "6144,12288,16384"  # モデルのロード時に試すチャンクサイズ(inputSampleRateのサンプル数, カンマ区切り)
+    warmupIterations: int = 2
+    modelCacheBudgetMB: int = DEFAULT_MODEL_CACHE_BUDGET_MB  # 差し替えたモデルを切り替え用に保持しておく重みの合計。0(既定):使用中のモデルだけ
+    activeModel: str = ""  # 使用中のモデル(modelCache のID)。キャッシュにある別のIDを指定するとそのモデルに切り替える
 
     # ↓mutableな物だけ列挙
-    intData = ["inputSampleRate", "crossFadeOverlapSize", "recordIO"]
-    floatData = ["crossFadeOffsetRate", "crossFadeEndRate"]
-    strData = []
+    intData = ["inputSampleRate", "crossFadeOverlapSize", "recordIO", "sessionTimeout", "maxBatchSize", "warmupIterations", "modelCacheBudgetMB"]
+    floatData = ["crossFadeOffsetRate", "crossFadeEndRate", "batchWindowMs"]
+    strData = ["resampleQuality", "convertBuckets", "warmupChunkSizes", "activeModel"]
 
 
 class VoiceChanger():
@@ -42,57 +64,332 @@ class VoiceChanger():
         # 初期化
         self.settings = VocieChangerSettings()
         self.onnx_session = None
-        self.currentCrossFadeOffsetRate = 0
-        self.currentCrossFadeEndRate = 0
-        self.currentCrossFadeOverlapSize = 0  # setting
-        self.crossfadeSize = 0  # calculated
+        self.sessions: dict[str, VoiceChangerSession] = {}
+        self.sessionsLock = threading.Lock()
+        self.batcher = InferenceBatcher.get_instance()
+        self.batcher.windowMs = self.settings.batchWindowMs
+        self.batcher.maxBatchSize = self.settings.maxBatchSize
+        OnnxSessionFactory.get_instance().configure(params)
+        self.mappedWeights = MappedWeights.get_instance()
+        self.mappedWeights.configure(params)
+        self.metrics = LatencyMetrics.get_instance()
+        self.shapeBuckets = ShapeBuckets.get_instance()
+        self.shapeBuckets.set_sizes(self.settings.convertBuckets)
+        # 推論に使っているモデルの状態。_swap でだけ更新する(ロード中の候補のモデルの warmup では変えない)
+        self.ready = False  # warmup に成功したモデルに差し替えるまで False(以降のロード中は今のモデルで変換を続ける)
+        self.warmupTime = 0.0
+        self.warmedBuckets = []
+        self.loadError = ""  # 直近のロード(warmup を含む)の失敗。失敗したモデルには差し替えない
 
         self.modelType = getModelType()
         print("[VoiceChanger] activate model type:", self.modelType)
+        self.params = params
+        self.active: ActiveModel = None  # 最初に使う時に作る(起動時にモデルのモジュールや torch を読み込まないため)
+        self.activeCond = threading.Condition()
+        self.loadLock = threading.Lock()  # ロードは1件ずつ
+        self.modelSettingsLock = threading.Lock()
+        self.pendingModelSettings = None  # ロード中に変更されたモデルの設定。差し替え時に新しいモデルにも反映する
+        if params.get("modelCacheBudgetMB") is not None:
+            self.settings.modelCacheBudgetMB = params["modelCacheBudgetMB"]
+        self.modelCache = ModelCache(self.settings.modelCacheBudgetMB)
+        self.switchTime = 0.0
+        self.prev_audio = np.zeros(4096)
+
+        print("VoiceChanger Initialized")
+
+    @property
+    def voiceChanger(self):
+        return self._get_active().model
+
+    def _get_active(self):
+        with self.activeCond:
+            if self.active is None:
+                self.active = ActiveModel(self._create_model(), 0)
+                import torch
+                gpu_num = torch.cuda.device_count()
+                mps_enabled = getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available()
+                print(f"[VoiceChanger] model initialized (GPU_NUM:{gpu_num}, mps_enabled:{mps_enabled})")
+            return self.active
+
+    def _create_model(self):
         if self.modelType == "MMVCv15":
             from voice_changer.MMVCv15.MMVCv15 import MMVCv15
-            self.voiceChanger = MMVCv15()
+            return MMVCv15()
         elif self.modelType == "MMVCv13":
             from voice_changer.MMVCv13.MMVCv13 import MMVCv13
-            self.voiceChanger = MMVCv13()
+            return MMVCv13()
         elif self.modelType == "so-vits-svc-40v2" or self.modelType == "so-vits-svc-40v2_c":
             from voice_changer.SoVitsSvc40v2.SoVitsSvc40v2 import SoVitsSvc40v2
-            self.voiceChanger = SoVitsSvc40v2(params)
+            return SoVitsSvc40v2(self.params)
         elif self.modelType == "so-vits-svc-40":
             from voice_changer.SoVitsSvc40.SoVitsSvc40 import SoVitsSvc40
-            self.voiceChanger = SoVitsSvc40(params)
+            return SoVitsSvc40(self.params)
         elif self.modelType == "DDSP-SVC":
             from voice_changer.DDSP_SVC.DDSP_SVC import DDSP_SVC
-            self.voiceChanger = DDSP_SVC(params)
+            return DDSP_SVC(self.params)
 
         else:
             from voice_changer.MMVCv13.MMVCv13 import MMVCv13
-            self.voiceChanger = MMVCv13()
-
-        self.gpu_num = torch.cuda.device_count()
-        self.prev_audio = np.zeros(4096)
-        self.mps_enabled = getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available()
-
-        print(f"VoiceChanger Initialized (GPU_NUM:{self.gpu_num}, mps_enabled:{self.mps_enabled})")
+            return MMVCv13()
+
+    def loadModel(self, config: str, pyTorch_model_file: str = None, onnx_model_file: str = None, clusterTorchModel: str = None, job: LoadJob = None):
+        """ 新しいモデルのインスタンスを作ってロードと warmup を済ませてから、推論に使うモデルをチャンクの間で差し替える。
+        ロード中も今のモデルで変換を続ける。job を渡すと進み具合と段階ごとの時間を書き込む(ModelLoader から呼ぶ場合)。
+        """
+        job = job if job is not None else LoadJob(jobId="")
+        key, entryId = ModelCache.make_key(self.modelType, config, pyTorch_model_file, onnx_model_file, clusterTorchModel)
+        with self.loadLock:
+            start = time.perf_counter()
+            job.set_progress(LOAD_STATUS_LOADING, 0.0)
+            current = self.voiceChanger
+            cached = self.modelCache.get(entryId)
+            if cached is not None:
+                # ロードと warmup は済んでいるので差し替えるだけ
+                print(f"[VoiceChanger] model cache hit: {entryId}")
+                job.set_progress(LOAD_STATUS_SWAPPING, 0.9)
+                if cached is not current:
+                    self._swap(cached, self.modelCache.get_warmup(entryId))
+                job.swapTime = time.perf_counter() - start
+                self.settings.activeModel = entryId
+                return self._load_info(cached, job)
+
+            with self.modelSettingsLock:
+                self.pendingModelSettings = []
+
+            model = None
+            try:
+                # 今のモデルの設定(話者、framework、f0の設定など)を引き継ぐ。ファイルは loadModel で上書きされる
+                model = self._create_model()
+                model.settings = copy.deepcopy(current.settings)
+                if self.modelType == "MMVCv15" or self.modelType == "MMVCv13":
+                    model.loadModel(config, pyTorch_model_file, onnx_model_file)
+                else:
+                    model.loadModel(config, pyTorch_model_file, onnx_model_file, clusterTorchModel)
+                self._inherit_providers(current, model)
+                job.loadTime = time.perf_counter() - start
 
-    def loadModel(self, config: str, pyTorch_model_file: str = None, onnx_model_file: str = None, clusterTorchModel: str = None):
-        if self.modelType == "MMVCv15" or self.modelType == "MMVCv13":
-            return self.voiceChanger.loadModel(config, pyTorch_model_file, onnx_model_file)
-        elif self.modelType == "so-vits-svc-40" or self.modelType == "so-vits-svc-40v2" or self.modelType == "so-vits-svc-40v2_c":
-            return self.voiceChanger.loadModel(config, pyTorch_model_file, onnx_model_file, clusterTorchModel)
+                job.set_progress(LOAD_STATUS_WARMUP, 0.5)
+                warmup = self.warmup(model, lambda ratio: job.set_progress(LOAD_STATUS_WARMUP, 0.5 + 0.4 * ratio))
+                job.warmupTime = warmup["warmupTime"]
+            except Exception as e:
+                # ロードか warmup に失敗したモデルには差し替えず、今のモデルで変換を続ける(job は failed になる)
+                with self.modelSettingsLock:
+                    self.pendingModelSettings = None
+                if model is not None:
+                    self._destroy_model(model)  # 借りたエンコーダなどを返す
+                self.loadError = f"{type(e).__name__}: {e}"
+                raise
+
+            job.set_progress(LOAD_STATUS_SWAPPING, 0.9)
+            swapStart = time.perf_counter()
+            # 今のモデルが予算から溢れた場合は、処理中のチャンクを待ってから _swap で解放する
+            evicted = self.modelCache.put(entryId, key, model, job.loadTime, warmup)
+            self._swap(model, warmup)
+            self.settings.activeModel = entryId
+            for evictedModel in evicted:
+                if evictedModel is not current:
+                    self._destroy_model(evictedModel)
+            job.swapTime = time.perf_counter() - swapStart
+
+        return self._load_info(model, job)
+
+    def _load_info(self, model, job: LoadJob):
+        info = model.get_info()
+        info["ready"] = self.ready
+        info["activeModel"] = self.settings.activeModel
+        info["loadTime"] = job.loadTime
+        info["warmupTime"] = job.warmupTime
+        info["swapTime"] = job.swapTime
+        return info
+
+    def switchModel(self, entryId: str):
+        """ キャッシュにあるモデルに切り替える。 """
+        with self.loadLock:
+            model = self.modelCache.get(entryId)
+            if model is None:
+                print(f"[VoiceChanger] model {entryId} is not cached. available: {list(self.modelCache.entries.keys())}")
+                return False
+            start = time.perf_counter()
+            if model is not self.voiceChanger:
+                self._swap(model, self.modelCache.get_warmup(entryId))
+            self.switchTime = time.perf_counter() - start
+        print(f"[VoiceChanger] switch model: {entryId} {self.switchTime * 1000:.1f}ms")
+        return True
+
+    def _inherit_providers(self, current, model):
+        """ 今のモデルで選ばれている onnxruntime のプロバイダを新しいモデルでも使う。 """
+        currentSession = getattr(current, "onnx_session", None)
+        newSession = getattr(model, "onnx_session", None)
+        if currentSession is None or newSession is None:
+            return
+        provider = currentSession.get_providers()[0]
+        if provider != newSession.get_providers()[0]:
+            model.update_setteings("onnxExecutionProvider", provider)
+
+    def _swap(self, model, warmup: dict):
+        """ 推論に使うモデルを(warmup に成功したモデルに)差し替えて、古いモデルを(キャッシュに残すもの以外は)解放する。
+        ready などの状態もここで差し替えたモデルの warmup の結果にする。
+        チャンクの処理は開始時に ActiveModel を取得するので、処理中のチャンクは最後まで古いモデルで変換される。
+        各セッションの状態は、差し替え後の最初のチャンクで世代番号の違いから破棄する(_on_request)。
+        """
+        with self.modelSettingsLock:
+            for key, val in self.pendingModelSettings or []:
+                model.update_setteings(key, val)
+            self.pendingModelSettings = None
+            with self.activeCond:
+                old = self._get_active()
+                self.active = ActiveModel(model, old.generation + 1)
+                self.ready = True
+                self.warmupTime = warmup["warmupTime"]
+                self.warmedBuckets = warmup["warmedBuckets"]
+                self.loadError = ""
+        print(f"[VoiceChanger] swap model: generation {old.generation} -> {old.generation + 1}")
+        if self.modelCache.contains(old.model):
+            return  # キャッシュに残すモデルは解放しない
+
+        with self.activeCond:
+            idle = self.activeCond.wait_for(lambda: old.users == 0, timeout=RELEASE_TIMEOUT)
+        if idle:
+            self._destroy_model(old.model)
         else:
-            return self.voiceChanger.loadModel(config, pyTorch_model_file, onnx_model_file, clusterTorchModel)
+            print(f"[VoiceChanger] previous model is still in use ({old.users} chunks). leave it to GC")
+            del old
+            gc.collect()
+
+    def _destroy_model(self, model):
+        import torch
+        model.destroy()
+        del model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _acquire_model(self):
+        with self.activeCond:
+            active = self._get_active()
+            active.users += 1
+            return active
+
+    def _release_model(self, active: "ActiveModel"):
+        with self.activeCond:
+            active.users -= 1
+            self.activeCond.notify_all()
+
+    def warmup(self, model=None, progress=None):
+        """ ロード直後の最初のチャンクで発生する初期化(アロケータの拡張、ONNXのグラフの初期化、HuBERTの初回呼び出し、f0推定の初回呼び出しなど)を、
+        合成した入力で on_request と同じ処理を一通り流して先に済ませておく。
+        warmupChunkSizes のチャンクサイズと、convertBuckets の各バケットの変換窓になるチャンクサイズごとに warmupIterations 回実行する。
+        実際のセッションとは別の使い捨てのセッションを使うので、接続中のセッションの状態には影響しない。
+        model を渡すと(差し替え前の)そのモデルで実行する。progress には終わった割合(0.0 - 1.0)を渡す。
+        {"warmupTime", "warmedBuckets"} を返す。失敗したら例外を送出する(ready などの状態は変えない。_swap で更新する)。
+        """
+        model = model if model is not None else self.voiceChanger
+        chunkSizes = self._warmup_chunk_sizes(model)
+        session = VoiceChangerSession(WARMUP_SESSION_ID)
+        session.resampleQuality = self.settings.resampleQuality
+        active = ActiveModel(model, session.modelGeneration)
+        rng = np.random.default_rng(0)
+        buckets = set()
+        total = max(len(chunkSizes) * self.settings.warmupIterations, 1)
+        done = 0
+        start = time.perf_counter()
+        try:
+            for chunkSize in chunkSizes:
+                for _ in range(self.settings.warmupIterations):
+                    # 無音だと SilenceGate で推論が省かれるので、ノイズを入力する
+                    data = (rng.standard_normal(chunkSize) * 3000).astype(np.int16)
+                    with session.lock:
+                        self._on_request(data, session, active, recordIO=False)
+                    if session.np_prev_audio1 is None:
+                        # 推論の例外は _on_request の中でログに出して握りつぶされ、クロスフェード用の前の出力が捨てられる
+                        raise RuntimeError("inference failed during warmup")
+                    buckets.add(session.convertSize)
+                    done += 1
+                    if progress is not None:
+                        progress(done / total)
+        except Exception as e:
+            print("[VoiceChanger] warmup failed", e)
+            print(traceback.format_exc())
+            raise
+        warmupTime = time.perf_counter() - start
+        warmedBuckets = sorted(buckets)
+        print(f"[VoiceChanger] warmup done: {warmupTime:.2f}sec chunks:{chunkSizes} buckets:{warmedBuckets}")
+        return {"warmupTime": warmupTime, "warmedBuckets": warmedBuckets}
+
+    def _warmup_chunk_sizes(self, model):
+        """ warmupChunkSizes に、convertBuckets の各バケットがちょうど変換窓になる入力の長さ(inputSampleRate でのサンプル数)を加える。 """
+        chunkSizes = [int(x) for x in self.settings.warmupChunkSizes.split(",") if x.strip().isdigit() and int(x) > 0]
+        crossfadeSize = self.settings.crossFadeOverlapSize
+        extraConvertSize = getattr(model.settings, "extraConvertSize", 0)
+        ratio = self.settings.inputSampleRate / model.get_processing_sampling_rate()
+        for size in self.shapeBuckets.sizes:
+            # リサンプルで長さが1サンプル程度ずれても次のバケットに溢れないよう、少し短くする
+            inputSize = size - crossfadeSize - extraConvertSize - 2
+            if inputSize > 0:
+                chunkSizes.append(int(inputSize * ratio))
+        return sorted(set(chunkSizes))
+
+    def get_health(self):
+        return {
+            "ready": self.ready,
+            "modelType": self.modelType,
+            "warmupTime": self.warmupTime,
+            "loadError": self.loadError,
+            "sessionNum": len(self.sessions),
+            "loading": self.loadLock.locked(),
+            "modelGeneration": self.active.generation if self.active is not None else 0,
+        }
 
     def get_info(self):
         data = asdict(self.settings)
         data.update(self.voiceChanger.get_info())
+        data["sessionNum"] = len(self.sessions)
+        data["batch"] = self.batcher.get_info()
+        data["convertBucketStats"] = self.shapeBuckets.get_info()
+        data["ready"] = self.ready
+        data["warmupTime"] = self.warmupTime
+        data["loadError"] = self.loadError
+        data["warmedBuckets"] = self.warmedBuckets
+        data["modelGeneration"] = self._get_active().generation
+        data["modelCache"] = self.modelCache.get_info()
+        data["modelSwitchTime"] = self.switchTime
+        data["contentEncoders"] = ContentEncoderRegistry.get_instance().get_info()
+        data.update(self.mappedWeights.get_info())
+        data["latency"] = self.metrics.get_info()
         return data
 
+    def get_session(self, sessionId: str):
+        with self.sessionsLock:
+            self._evict_idle_sessions()
+            session = self.sessions.get(sessionId)
+            if session is None:
+                session = VoiceChangerSession(sessionId)
+                self.sessions[sessionId] = session
+                print(f"[VoiceChanger] new session: {sessionId} (sessions:{len(self.sessions)})")
+            session.touch()
+            return session
+
+    def release_session(self, sessionId: str):
+        with self.sessionsLock:
+            if sessionId in self.sessions:
+                del self.sessions[sessionId]
+                self.metrics.release_session(sessionId)
+                print(f"[VoiceChanger] release session: {sessionId} (sessions:{len(self.sessions)})")
+
+    def _evict_idle_sessions(self):
+        # sessionsLock を保持した状態で呼ぶこと
+        idleSessionIds = [sessionId for sessionId, session in self.sessions.items() if session.is_idle(self.settings.sessionTimeout)]
+        for sessionId in idleSessionIds:
+            del self.sessions[sessionId]
+            self.metrics.release_session(sessionId)
+            print(f"[VoiceChanger] evict idle session: {sessionId}")
+
     def update_setteings(self, key: str, val: any):
         if key in self.settings.intData:
             setattr(self.settings, key, int(val))
             if key == "crossFadeOffsetRate" or key == "crossFadeEndRate":
-                self.crossfadeSize = 0
+                for session in list(self.sessions.values()):
+                    session.crossfadeSize = 0
             if key == "recordIO" and val == 1:
                 if hasattr(self, "ioRecorder"):
                     self.ioRecorder.close()
@@ -113,59 +410,89 @@ class VoiceChanger():
 
                 # except Exception as e:
                 #     print("recordIO exception", e)
+            if key == "maxBatchSize":
+                self.batcher.maxBatchSize = self.settings.maxBatchSize
+            if key == "modelCacheBudgetMB":
+                for evictedModel in self.modelCache.set_budget(self.settings.modelCacheBudgetMB, [self.voiceChanger]):
+                    self._destroy_model(evictedModel)
         elif key in self.settings.floatData:
             setattr(self.settings, key, float(val))
+            if key == "batchWindowMs":
+                self.batcher.windowMs = self.settings.batchWindowMs
         elif key in self.settings.strData:
+            if key == "resampleQuality" and val not in RESAMPLE_QUALITIES:
+                print(f"unknown resample quality: {val}. available: {list(RESAMPLE_QUALITIES.keys())}")
+                return self.get_info()
+            if key == "convertBuckets" and self.shapeBuckets.set_sizes(str(val)) == False:
+                return self.get_info()
+            if key == "activeModel" and self.switchModel(str(val)) == False:
+                return self.get_info()
             setattr(self.settings, key, str(val))
+        elif key in self.mappedWeights.settings.intData:
+            self.mappedWeights.update_setteings(key, val)
         else:
-            ret = self.voiceChanger.update_setteings(key, val)
+            with self.modelSettingsLock:
+                ret = self.voiceChanger.update_setteings(key, val)
+                if ret != False and self.pendingModelSettings is not None:
+                    self.pendingModelSettings.append((key, val))
             if ret == False:
                 print(f"{key} is not mutable variable or unknown variable!")
 
         return self.get_info()
 
-    def _generate_strength(self, crossfadeSize: int):
-
-        if self.crossfadeSize != crossfadeSize or \
-                self.currentCrossFadeOffsetRate != self.settings.crossFadeOffsetRate or \
-                self.currentCrossFadeEndRate != self.settings.crossFadeEndRate or \
-                self.currentCrossFadeOverlapSize != self.settings.crossFadeOverlapSize:
+    def _generate_strength(self, crossfadeSize: int, session: VoiceChangerSession):
 
-            self.crossfadeSize = crossfadeSize
-            self.currentCrossFadeOffsetRate = self.settings.crossFadeOffsetRate
-            self.currentCrossFadeEndRate = self.settings.crossFadeEndRate
-            self.currentCrossFadeOverlapSize = self.settings.crossFadeOverlapSize
+        if session.crossfadeSize != crossfadeSize or \
+                session.currentCrossFadeOffsetRate != self.settings.crossFadeOffsetRate or \
+                session.currentCrossFadeEndRate != self.settings.crossFadeEndRate or \
+                session.currentCrossFadeOverlapSize != self.settings.crossFadeOverlapSize:
 
-            cf_offset = int(crossfadeSize * self.settings.crossFadeOffsetRate)
-            cf_end = int(crossfadeSize * self.settings.crossFadeEndRate)
-            cf_range = cf_end - cf_offset
-            percent = np.arange(cf_range) / cf_range
+            session.crossfadeSize = crossfadeSize
+            session.currentCrossFadeOffsetRate = self.settings.crossFadeOffsetRate
+            session.currentCrossFadeEndRate = self.settings.crossFadeEndRate
+            session.currentCrossFadeOverlapSize = self.settings.crossFadeOverlapSize
 
-            np_prev_strength = np.cos(percent * 0.5 * np.pi) ** 2
-            np_cur_strength = np.cos((1 - percent) * 0.5 * np.pi) ** 2
+            session.np_prev_strength, session.np_cur_strength = crossfade_strength(
+                crossfadeSize, self.settings.crossFadeOffsetRate, self.settings.crossFadeEndRate)
 
-            self.np_prev_strength = np.concatenate([np.ones(cf_offset), np_prev_strength,
-                                                   np.zeros(crossfadeSize - cf_offset - len(np_prev_strength))])
-            self.np_cur_strength = np.concatenate([np.zeros(cf_offset), np_cur_strength, np.ones(crossfadeSize - cf_offset - len(np_cur_strength))])
-
-            print(f"Generated Strengths: for prev:{self.np_prev_strength.shape}, for cur:{self.np_cur_strength.shape}")
+            print(f"Generated Strengths: for prev:{session.np_prev_strength.shape}, for cur:{session.np_cur_strength.shape}")
 
             # ひとつ前の結果とサイズが変わるため、記録は消去する。
-            if hasattr(self, 'np_prev_audio1') == True:
-                delattr(self, "np_prev_audio1")
+            session.np_prev_audio1 = None
 
     #  receivedData: tuple of short
-    def on_request(self, receivedData: any):
-        processing_sampling_rate = self.voiceChanger.get_processing_sampling_rate()
+    def on_request(self, receivedData: any, sessionId: str = DEFAULT_SESSION_ID):
+        start = time.perf_counter()
+        session = self.get_session(sessionId)
+        active = self._acquire_model()
+        try:
+            with session.lock, self.metrics.track(sessionId):
+                result = self._on_request(receivedData, session, active)
+        finally:
+            self._release_model(active)
+        session.touch()
+        elapsed = time.perf_counter() - start
+        self.metrics.observe(STAGE_TOTAL, elapsed, sessionId)
+        self.metrics.observe_rtf(elapsed, receivedData.shape[0] / self.settings.inputSampleRate, sessionId)
+        return result
+
+    def _on_request(self, receivedData: any, session: VoiceChangerSession, active: "ActiveModel", recordIO: bool = True):
+        if session.modelGeneration != active.generation:
+            # モデルが変わるとバッファのサンプリングレートやサイズが変わるので、このセッションの状態を破棄する。
+            session.reset()
+            session.modelGeneration = active.generation
+        model = active.model
+        processing_sampling_rate = model.get_processing_sampling_rate()
+        session.resampleQuality = self.settings.resampleQuality
 
         print_convert_processing(f"------------ Convert processing.... ------------")
         # 前処理
         with Timer("pre-process") as t:
 
-            with Timer("pre-process") as t1:
+            with Timer("pre-process") as t1, self.metrics.stage(STAGE_RESAMPLE_IN):
 
                 if self.settings.inputSampleRate != processing_sampling_rate:
-                    newData = resampy.resample(receivedData, self.settings.inputSampleRate, processing_sampling_rate)
+                    newData = session.get_resampler("input", self.settings.inputSampleRate, processing_sampling_rate).resample(receivedData)
                 else:
                     newData = receivedData
             # print("t1::::", t1.secs)
@@ -180,9 +507,9 @@ class VoiceChanger():
             print_convert_processing(f" Convert data size of {inputSize + crossfadeSize} (+ extra size)")
             print_convert_processing(f"         will be cropped:{-1 * (inputSize + crossfadeSize)}, {-1 * (crossfadeSize)}")
 
-            self._generate_strength(crossfadeSize)
+            self._generate_strength(crossfadeSize, session)
             with Timer("pre-process") as t2:
-                data = self.voiceChanger.generate_input(newData, inputSize, crossfadeSize)
+                data = model.generate_input(newData, inputSize, crossfadeSize, session)
             # print("t2::::", t2.secs)
         preprocess_time = t.secs
 
@@ -190,56 +517,59 @@ class VoiceChanger():
         with Timer("main-process") as t:
             try:
                 # Inference
-                audio = self.voiceChanger.inference(data)
-
-                if hasattr(self, 'np_prev_audio1') == True:
-                    np.set_printoptions(threshold=10000)
-                    prev_overlap_start = -1 * crossfadeSize
-                    prev_overlap = self.np_prev_audio1[prev_overlap_start:]
-                    cur_overlap_start = -1 * (inputSize + crossfadeSize)
-                    cur_overlap_end = -1 * inputSize
-                    cur_overlap = audio[cur_overlap_start:cur_overlap_end]
-                    print_convert_processing(
-                        f" audio:{audio.shape}, prev_overlap:{prev_overlap.shape}, self.np_prev_strength:{self.np_prev_strength.shape}")
-                    powered_prev = prev_overlap * self.np_prev_strength
-                    print_convert_processing(
-                        f" audio:{audio.shape}, cur_overlap:{cur_overlap.shape}, self.np_cur_strength:{self.np_cur_strength.shape}")
-                    print_convert_processing(f" cur_overlap_strt:{cur_overlap_start}, cur_overlap_end{cur_overlap_end}")
-                    powered_cur = cur_overlap * self.np_cur_strength
-                    powered_result = powered_prev + powered_cur
-
-                    cur = audio[-1 * inputSize:-1 * crossfadeSize]
-                    result = np.concatenate([powered_result, cur], axis=0)
-                    print_convert_processing(
-                        f" overlap:{crossfadeSize}, current:{cur.shape[0]}, result:{result.shape[0]}... result should be same as input")
-                    if cur.shape[0] != result.shape[0]:
-                        print_convert_processing(f" current and result should be same as input")
-
-                else:
-                    result = np.zeros(4096).astype(np.int16)
-                self.np_prev_audio1 = audio
+                with self.metrics.stage(STAGE_INFERENCE):
+                    audio = model.inference(data, session)
+
+                with self.metrics.stage(STAGE_CROSSFADE):
+                    if session.np_prev_audio1 is not None:
+                        np.set_printoptions(threshold=10000)
+                        prev_overlap_start = -1 * crossfadeSize
+                        prev_overlap = session.np_prev_audio1[prev_overlap_start:]
+                        cur_overlap_start = -1 * (inputSize + crossfadeSize)
+                        cur_overlap_end = -1 * inputSize
+                        cur_overlap = audio[cur_overlap_start:cur_overlap_end]
+                        print_convert_processing(
+                            f" audio:{audio.shape}, prev_overlap:{prev_overlap.shape}, session.np_prev_strength:{session.np_prev_strength.shape}")
+                        powered_prev = prev_overlap * session.np_prev_strength
+                        print_convert_processing(
+                            f" audio:{audio.shape}, cur_overlap:{cur_overlap.shape}, session.np_cur_strength:{session.np_cur_strength.shape}")
+                        print_convert_processing(f" cur_overlap_strt:{cur_overlap_start}, cur_overlap_end{cur_overlap_end}")
+                        powered_cur = cur_overlap * session.np_cur_strength
+                        powered_result = powered_prev + powered_cur
+
+                        cur = audio[-1 * inputSize:-1 * crossfadeSize]
+                        result = np.concatenate([powered_result, cur], axis=0)
+                        print_convert_processing(
+                            f" overlap:{crossfadeSize}, current:{cur.shape[0]}, result:{result.shape[0]}... result should be same as input")
+                        if cur.shape[0] != result.shape[0]:
+                            print_convert_processing(f" current and result should be same as input")
+
+                    else:
+                        result = np.zeros(4096).astype(np.int16)
+                    # audio は推論側のバッファ(IOBinding の出力など)を指すことがあり次のチャンクで上書きされるので、クロスフェードに使う末尾だけをコピーして残す
+                    session.np_prev_audio1 = audio[-crossfadeSize:].copy()
 
             except Exception as e:
                 print("VC PROCESSING!!!! EXCEPTION!!!", e)
                 print(traceback.format_exc())
-                if hasattr(self, "np_prev_audio1"):
-                    del self.np_prev_audio1
+                session.np_prev_audio1 = None
                 return np.zeros(1).astype(np.int16), [0, 0, 0]
         mainprocess_time = t.secs
 
         # 後処理
         with Timer("post-process") as t:
-            result = result.astype(np.int16)
-            if self.settings.inputSampleRate != processing_sampling_rate:
-                outputData = resampy.resample(result, processing_sampling_rate, self.settings.inputSampleRate).astype(np.int16)
-            else:
-                outputData = result
+            with self.metrics.stage(STAGE_RESAMPLE_OUT):
+                result = result.astype(np.int16)
+                if self.settings.inputSampleRate != processing_sampling_rate:
+                    outputData = session.get_resampler("output", processing_sampling_rate, self.settings.inputSampleRate).resample(result).astype(np.int16)
+                else:
+                    outputData = result
             # outputData = result
 
             print_convert_processing(
                 f" Output data size of {result.shape[0]}/{processing_sampling_rate}hz {outputData.shape[0]}/{self.settings.inputSampleRate}hz")
 
-            if self.settings.recordIO == 1:
+            if self.settings.recordIO == 1 and recordIO:
                 self.ioRecorder.writeInput(receivedData)
                 self.ioRecorder.writeOutput(outputData.tobytes())
 
@@ -255,6 +585,15 @@ class VoiceChanger():
         return outputData, perf
 
 
+class ActiveModel():
+    """ 推論に使うモデルと世代番号(差し替えのたびに増える)の組。users は処理中のチャンクの数。 """
+
+    def __init__(self, model, generation: int):
+        self.model = model
+        self.generation = generation
+        self.users = 0
+
+
 ##############
 PRINT_CONVERT_PROCESSING = False
 # PRINT_CONVERT_PROCESSING = True
@@ -265,6 +604,21 @@ def print_convert_processing(mess: str):
         print(mess)
 
 
+def crossfade_strength(crossfadeSize: int, offsetRate: float, endRate: float):
+    """ クロスフェードの前の音声と今の音声の重み。offsetRate までは前の音声だけ、endRate 以降は今の音声だけで、間は cos^2 でつなぐ。 """
+    cf_offset = int(crossfadeSize * offsetRate)
+    cf_end = int(crossfadeSize * endRate)
+    cf_range = cf_end - cf_offset
+    percent = np.arange(cf_range) / cf_range
+
+    np_prev_strength = np.cos(percent * 0.5 * np.pi) ** 2
+    np_cur_strength = np.cos((1 - percent) * 0.5 * np.pi) ** 2
+
+    np_prev_strength = np.concatenate([np.ones(cf_offset), np_prev_strength, np.zeros(crossfadeSize - cf_offset - len(np_prev_strength))])
+    np_cur_strength = np.concatenate([np.zeros(cf_offset), np_cur_strength, np.ones(crossfadeSize - cf_offset - len(np_cur_strength))])
+    return np_prev_strength, np_cur_strength
+
+
 def pad_array(arr, target_length):
     current_length = arr.shape[0]
     if current_length >= target_length:
@@ -282,10 +636,10 @@ class Timer(object):
         self.title = title
 
     def __enter__(self):
-        self.start = time.time()
+        self.start = time.perf_counter()
         return self
 
     def __exit__(self, *args):
-        self.end = time.time()
+        self.end = time.perf_counter()
         self.secs = self.end - self.start
         self.msecs = self.secs * 1000  # millisecs
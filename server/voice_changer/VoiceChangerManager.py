@@ -1,5 +1,10 @@
 import numpy as np
 from voice_changer.VoiceChanger import VoiceChanger
+from voice_changer.VoiceChangerSession import DEFAULT_SESSION_ID
+from voice_changer.InferenceDispatcher import InferenceDispatcher, QUEUE_POLICY_DROP_OLDEST
+from voice_changer.ModelLoader import ModelLoader, LoadJob
+from voice_changer.OfflineConverter import OfflineConverter, OfflineConvertSettings
+from voice_changer.utils.LatencyMetrics import LatencyMetrics
 
 
 class VoiceChangerManager():
@@ -8,6 +13,14 @@ class VoiceChangerManager():
         if not hasattr(cls, "_instance"):
             cls._instance = cls()
             cls._instance.voiceChanger = VoiceChanger(params)
+            cls._instance.dispatcher = InferenceDispatcher(
+                cls._instance.changeVoice,
+                maxWorkers=params.get("inferenceWorkers", 2),
+                queueSize=params.get("queueSize", 4),
+                policy=params.get("queuePolicy", QUEUE_POLICY_DROP_OLDEST),
+                releaseSession=cls._instance.voiceChanger.release_session)
+            cls._instance.modelLoader = ModelLoader(cls._instance._load)
+            cls._instance.offlineConverter = OfflineConverter(cls._instance.voiceChanger)
         return cls._instance
 
     def loadModel(self, config, model, onnx_model, clusterTorchModel):
@@ -15,14 +28,56 @@ class VoiceChangerManager():
         info["status"] = "OK"
         return info
 
+    def loadModelAsync(self, config, model, onnx_model, clusterTorchModel):
+        """ ロードをバックグラウンドで実行する。ロードが終わるまでは今のモデルの情報に jobId を付けて返す。
+        進み具合と終わった時の時間は get_load_job で問い合わせる。 """
+        job = self.modelLoader.submit(config, model, onnx_model, clusterTorchModel)
+        info = self.get_info()
+        info["jobId"] = job.jobId
+        info["loadJob"] = self.modelLoader.get_job(job.jobId)
+        return info
+
+    def get_load_job(self, jobId: str):
+        job = self.modelLoader.get_job(jobId)
+        if job is None:
+            return {"status": "ERROR", "msg": f"unknown job: {jobId}"}
+        return {"status": "OK", "loadJob": job}
+
+    def _load(self, job: LoadJob, config, model, onnx_model, clusterTorchModel):
+        return self.voiceChanger.loadModel(config, model, onnx_model, clusterTorchModel, job)
+
+    def convertFileAsync(self, inputFile: str, outputFile: str, settings: OfflineConvertSettings):
+        """ 録音済みのファイルの変換をバックグラウンドで実行する。進み具合と終わった時のスループットは get_convert_job で問い合わせる。 """
+        job = self.offlineConverter.submit(inputFile, outputFile, settings)
+        return {"status": "OK", "jobId": job.jobId, "convertJob": self.offlineConverter.get_job(job.jobId)}
+
+    def get_convert_job(self, jobId: str):
+        job = self.offlineConverter.get_job(jobId)
+        if job is None:
+            return {"status": "ERROR", "msg": f"unknown job: {jobId}"}
+        return {"status": "OK", "convertJob": job}
+
     def get_info(self):
         if hasattr(self, 'voiceChanger'):
             info = self.voiceChanger.get_info()
+            info["inferenceQueue"] = self.dispatcher.get_info()
+            info["modelLoader"] = self.modelLoader.get_info()
+            info["offlineConverter"] = self.offlineConverter.get_info()
             info["status"] = "OK"
             return info
         else:
             return {"status": "ERROR", "msg": "no model loaded"}
 
+    def get_metrics(self):
+        """ 段階ごとの処理時間, RTF, 推論キューの状態(Prometheus のテキスト形式)。 """
+        return LatencyMetrics.get_instance().render(self.dispatcher.get_info() if hasattr(self, 'dispatcher') else None)
+
+    def get_health(self):
+        if hasattr(self, 'voiceChanger'):
+            return self.voiceChanger.get_health()
+        else:
+            return {"ready": False, "msg": "no model loaded"}
+
     def update_setteings(self, key: str, val: any):
         if hasattr(self, 'voiceChanger'):
             info = self.voiceChanger.update_setteings(key, val)
@@ -31,9 +86,14 @@ class VoiceChangerManager():
         else:
             return {"status": "ERROR", "msg": "no model loaded"}
 
-    def changeVoice(self, receivedData: any):
+    def changeVoice(self, receivedData: any, sessionId: str = DEFAULT_SESSION_ID):
         if hasattr(self, 'voiceChanger') == True:
-            return self.voiceChanger.on_request(receivedData)
+            return self.voiceChanger.on_request(receivedData, sessionId)
         else:
             print("Voice Change is not loaded. Did you load a correct model?")
             return np.zeros(1).astype(np.int16), []
+
+    def release_session(self, sessionId: str):
+        self.dispatcher.release(sessionId)
+        if hasattr(self, 'voiceChanger') == True:
+            self.voiceChanger.release_session(sessionId)
@@ -0,0 +1,86 @@
+import time
+import threading
+
+from voice_changer.utils.StreamResampler import StreamResampler, DEFAULT_RESAMPLE_QUALITY
+from voice_changer.utils.SilenceGate import SilenceGate
+from voice_changer.utils.ContentUnitCache import ContentUnitCache, ContentUnitCacheStats
+from voice_changer.utils.OnnxIOBinding import OnnxIOBindingRunner, OnnxIOBindingStats
+from voice_changer.utils.IncrementalF0 import IncrementalF0Tracker, F0_ANALYSIS_MARGIN_MS, DEFAULT_F0_ANALYSIS_MARGIN_MS
+
+DEFAULT_SESSION_ID = "default"
+
+
+class VoiceChangerSession():
+    """ 接続(Socket.IOのsid, RESTのsessionId)ごとのストリーミング状態。
+    モデルの重みは VoiceChanger 側で共有し、ここにはバッファとクロスフェードの状態だけを持つ。
+    """
+
+    def __init__(self, sessionId: str):
+        self.sessionId = sessionId
+        self.lock = threading.Lock()
+        self.lastAccess = time.monotonic()
+        self.resampleQuality = DEFAULT_RESAMPLE_QUALITY
+        self.modelGeneration = 0  # 状態を作ったモデルの世代(VoiceChanger.active.generation)。違ったら reset する
+        self.reset()
+
+    def reset(self):
+        # クロスフェード
+        self.crossfadeSize = 0
+        self.currentCrossFadeOffsetRate = 0
+        self.currentCrossFadeEndRate = 0
+        self.currentCrossFadeOverlapSize = 0
+        self.np_prev_strength = None
+        self.np_cur_strength = None
+        self.np_prev_audio1 = None
+
+        # リサンプラ(フィルタ状態をチャンク間で引き継ぐ)
+        self.resamplers: dict[str, StreamResampler] = {}
+
+        # モデル側のストリーミング状態
+        self.audio_buffer = None
+        self.convertSize = 0  # 直近の変換窓の長さ(ShapeBuckets で切り上げた後)
+        self.audio_buffer_16k = None
+        self.prevVol = 0
+        self.silenceGate = SilenceGate()
+        self.f0Trackers: dict[str, IncrementalF0Tracker] = {}
+        self.contentCaches: dict[str, ContentUnitCache] = {}
+        self.spectrogram = None  # StreamingSpectrogram (MMVC)
+        self.sinePhase = None  # ExcitationBuilder (MMVCv15)
+        self.sinePhaseStart = 0
+        self.onnxRunner = None  # OnnxIOBindingRunner
+
+    def get_resampler(self, name: str, srcRate: int, dstRate: int):
+        resampler = self.resamplers.get(name)
+        if resampler is None or resampler.matches(srcRate, dstRate, self.resampleQuality) == False:
+            resampler = StreamResampler(srcRate, dstRate, self.resampleQuality)
+            self.resamplers[name] = resampler
+        return resampler
+
+    def get_f0_tracker(self, detector: str, config: tuple, analyze, sampleRate: int, framePeriodMs: float):
+        """ config が変わったら(検出器やホップサイズの変更)作り直す。analyze は毎回渡すが、作り直したときだけ使われる。 """
+        tracker = self.f0Trackers.get(detector)
+        if tracker is None or tracker.matches(config) == False:
+            marginMs = F0_ANALYSIS_MARGIN_MS.get(detector, DEFAULT_F0_ANALYSIS_MARGIN_MS)
+            tracker = IncrementalF0Tracker(config, analyze, sampleRate, framePeriodMs, marginMs)
+            self.f0Trackers[detector] = tracker
+        return tracker
+
+    def get_content_cache(self, name: str, config: tuple, encode, hop: int, sampleRate: int, marginMs: float, frameCount, stats: ContentUnitCacheStats):
+        """ config が変わったら(エンコーダ、デバイス、マージンの変更)作り直す。 """
+        cache = self.contentCaches.get(name)
+        if cache is None or cache.matches(config) == False:
+            cache = ContentUnitCache(config, encode, hop, sampleRate, marginMs, frameCount, stats)
+            self.contentCaches[name] = cache
+        return cache
+
+    def get_onnx_runner(self, onnxSession, outputName: str, stats: OnnxIOBindingStats):
+        """ onnxのセッションが変わったら(モデルの再読み込み、設定変更による作り直し)、bind したバッファごと作り直す。 """
+        if self.onnxRunner is None or self.onnxRunner.session is not onnxSession:
+            self.onnxRunner = OnnxIOBindingRunner(onnxSession, outputName, stats)
+        return self.onnxRunner
+
+    def touch(self):
+        self.lastAccess = time.monotonic()
+
+    def is_idle(self, timeout: float):
+        return time.monotonic() - self.lastAccess > timeout
@@ -0,0 +1,70 @@
+import struct
+from dataclasses import dataclass
+import numpy as np
+
+# 音声チャンクのバイナリ表現。
+# ペイロードはリトルエンディアンのPCMで、np.frombuffer / ndarray.tobytes で変換する(Pythonのタプルを経由しない)。
+# 必要なら先頭に固定長ヘッダを付けられる。ヘッダなしのパケットは従来どおり int16 PCM として扱う。
+# float32 のサンプルは [-1.0, 1.0] に正規化した値(Web Audio と同じ)。デコードで int16 のスケール(x32768)にしてモデルに渡し、
+# エンコードで [-1.0, 1.0] に戻す。
+#
+#   magic(4s) version(B) dtype(B) reserved(H) sampleRate(I) seq(I)  = 16 bytes
+FRAME_MAGIC = b"MMVC"
+FRAME_VERSION = 1
+FRAME_HEADER_FORMAT = "<4sBBHII"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+
+DTYPE_INT16 = 0
+DTYPE_FLOAT32 = 1
+FRAME_DTYPES = {
+    DTYPE_INT16: np.dtype("<i2"),
+    DTYPE_FLOAT32: np.dtype("<f4"),
+}
+FLOAT_SCALE = 32768.0  # float32 の 1.0 に対応する int16 のスケールの値
+
+
+@dataclass
+class AudioFrameHeader():
+    sampleRate: int = 0
+    seq: int = 0
+    dtype: int = DTYPE_INT16
+
+
+def decode_pcm(data: bytes, dtype: int = DTYPE_INT16):
+    """ PCMバイト列を int16 のスケールの ndarray にする。端数のバイトは捨てる。
+    int16 はコピーせずに見るだけ(読み取り専用)。float32 は [-1.0, 1.0] を int16 のスケールに直した新しい配列。
+    """
+    npDtype = FRAME_DTYPES[dtype]
+    usable = len(data) - len(data) % npDtype.itemsize
+    audio = np.frombuffer(data, dtype=npDtype, count=usable // npDtype.itemsize)
+    if dtype == DTYPE_FLOAT32:
+        return audio * np.float32(FLOAT_SCALE)
+    return audio
+
+
+def encode_pcm(audio: np.ndarray, dtype: int = DTYPE_INT16):
+    """ int16 のスケールの audio を PCMバイト列にする。float32 は [-1.0, 1.0] に正規化する。 """
+    if dtype == DTYPE_FLOAT32:
+        return (np.asarray(audio, dtype=np.float32) / np.float32(FLOAT_SCALE)).astype(FRAME_DTYPES[dtype], copy=False).tobytes()
+    return np.ascontiguousarray(audio, dtype=FRAME_DTYPES[dtype]).tobytes()
+
+
+def has_header(data: bytes):
+    if len(data) < FRAME_HEADER_SIZE or bytes(data[:4]) != FRAME_MAGIC:
+        return False
+    _magic, version, dtype, reserved, _sampleRate, _seq = struct.unpack_from(FRAME_HEADER_FORMAT, data)
+    return version == FRAME_VERSION and dtype in FRAME_DTYPES and reserved == 0
+
+
+def pack_frame(audio: np.ndarray, header: AudioFrameHeader):
+    head = struct.pack(FRAME_HEADER_FORMAT, FRAME_MAGIC, FRAME_VERSION, header.dtype, 0, header.sampleRate, header.seq)
+    return head + encode_pcm(audio, header.dtype)
+
+
+def unpack_frame(data: bytes):
+    """ ヘッダ付きならヘッダとPCM、ヘッダなしなら (None, int16 PCM) を返す。 """
+    if has_header(data) == False:
+        return None, decode_pcm(data)
+    _magic, _version, dtype, _reserved, sampleRate, seq = struct.unpack_from(FRAME_HEADER_FORMAT, data)
+    header = AudioFrameHeader(sampleRate=sampleRate, seq=seq, dtype=dtype)
+    return header, decode_pcm(memoryview(data)[FRAME_HEADER_SIZE:], dtype)
@@ -0,0 +1,169 @@
+import copy
+import gc
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from voice_changer.utils.ProcessMemory import get_rss
+
+
+class SharedEncoder():
+    def __init__(self, key: tuple, encoder: Any, loadTime: float, rssDelta: int):
+        self.key = key
+        self.encoder = encoder
+        self.refs = 0
+        self.borrows = 0
+        self.loadTime = loadTime
+        self.rssDelta = rssDelta
+
+    def get_info(self):
+        kind, path, device = self.key[:3]
+        return {
+            "kind": kind,
+            "file": os.path.basename(path) if path else "",
+            "device": device,
+            "options": [str(x) for x in self.key[3:]],
+            "refs": self.refs,
+            "borrows": self.borrows,
+            "loadTime": self.loadTime,
+            "rssDeltaMB": self.rssDelta / 1024 / 1024,
+        }
+
+
+class ContentEncoderRegistry():
+    """ HuBERT/ContentVec などのコンテンツエンコーダを、(種類, ファイル, デバイス, その他の生成オプション) ごとにプロセスで1つだけ読み込んで共有する。
+    モデルは borrow で借りて、不要になったら(destroy や別のデバイスに借り直す時に) release で返す。
+    参照がなくなったエンコーダは解放する。共有されるので、借りたエンコーダを .to() などで書き換えないこと(別のデバイスで使う場合は DeviceEncoder)。
+    """
+
+    @classmethod
+    def get_instance(cls):
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.encoders: dict[tuple, SharedEncoder] = {}
+        self.loadLocks: dict[tuple, threading.Lock] = {}  # 読み込み中のキーごとのロック
+
+    def borrow(self, kind: str, path: str, device: str, load: Callable[[], Any], *options):
+        """ 読み込み済みならそれを、なければ load() で読み込んで返す。 """
+        key = (kind, path, str(device)) + tuple(options)
+        shared = self._acquire(key)
+        if shared is None:
+            # 読み込みは推論のスレッドからも呼ばれる(DeviceEncoder)ので、self.lock は持たずにキーごとのロックで同じキーの読み込みだけを待たせる
+            with self.lock:
+                loadLock = self.loadLocks.setdefault(key, threading.Lock())
+            with loadLock:
+                shared = self._acquire(key)  # 待っている間に別のスレッドが読み込んだ
+                if shared is None:
+                    rss = get_rss()
+                    start = time.perf_counter()
+                    encoder = load()
+                    shared = SharedEncoder(key, encoder, time.perf_counter() - start, get_rss() - rss)
+                    with self.lock:
+                        shared.refs += 1
+                        shared.borrows += 1
+                        self.encoders[key] = shared
+                        self.loadLocks.pop(key, None)
+                    print(f"[ContentEncoderRegistry] load {kind} {path} ({device}): {shared.loadTime:.2f}sec, rss +{shared.rssDelta / 1024 / 1024:.1f}MB")
+                    return shared.encoder
+        print(f"[ContentEncoderRegistry] reuse {kind} {path} ({device}), refs:{shared.refs}")
+        return shared.encoder
+
+    def _acquire(self, key: tuple):
+        with self.lock:
+            shared = self.encoders.get(key)
+            if shared is not None:
+                shared.refs += 1
+                shared.borrows += 1
+            return shared
+
+    def release(self, encoder: Any):
+        if encoder is None:
+            return
+        with self.lock:
+            for key, shared in self.encoders.items():
+                if shared.encoder is encoder:
+                    shared.refs -= 1
+                    if shared.refs <= 0:
+                        del self.encoders[key]
+                        print(f"[ContentEncoderRegistry] release {key[0]} {key[1]} ({key[2]})")
+                        released = True
+                    else:
+                        released = False
+                    break
+            else:
+                return
+        if released:
+            import torch
+            del shared, encoder
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def owns(self, value: Any):
+        with self.lock:
+            return any([shared.encoder is value for shared in self.encoders.values()])
+
+    def get_info(self):
+        with self.lock:
+            return {
+                "rssMB": get_rss() / 1024 / 1024,
+                "encoders": [shared.get_info() for shared in self.encoders.values()],
+            }
+
+
+class DeviceEncoder():
+    """ ContentEncoderRegistry から CPU のエンコーダを借りて、推論のデバイスに合わせたものを返す。
+    ファイルから読み込むのはロード時(生成時)の1回だけで、CPU 以外のデバイスでは CPU のエンコーダのコピーを移したものを
+    デバイスごとにレジストリで共有する(デバイスが変わっても、ディスクから読み直したり共有のエンコーダを .to() で書き換えたりしない)。
+    """
+
+    def __init__(self, kind: str, path: str, load: Callable[[], Any], *options):
+        self.registry = ContentEncoderRegistry.get_instance()
+        self.kind = kind
+        self.path = path
+        self.options = options
+        self.lock = threading.Lock()
+        self.base = self.registry.borrow(kind, path, "cpu", load, *options)  # load は CPU に読み込むこと
+        self.encoder = self.base
+        self.device = "cpu"
+
+    def get(self, device):
+        """ device のエンコーダを返す。前のデバイスのコピーは返す。 """
+        device = str(device)
+        with self.lock:
+            if self.device != device:
+                if device == "cpu":
+                    encoder = self.base
+                else:
+                    base = self.base
+                    encoder = self.registry.borrow(self.kind, self.path, device, lambda: copy.deepcopy(base).to(device), *self.options)
+                if self.encoder is not self.base:
+                    self.registry.release(self.encoder)
+                self.encoder = encoder
+                self.device = device
+            return self.encoder
+
+    def release(self):
+        with self.lock:
+            if self.encoder is not self.base:
+                self.registry.release(self.encoder)
+            self.registry.release(self.base)
+            self.encoder = None
+            self.base = None
+
+
+def load_fairseq_hubert(path: str):
+    """ so-vits-svc の hubert(fairseq のチェックポイント)を CPU に読み込む。 """
+    from fairseq import checkpoint_utils  # fairseq は重いので hubert を読み込む時だけ
+    models, saved_cfg, task = checkpoint_utils.load_model_ensemble_and_task(
+        [path],
+        suffix="",
+    )
+    model = models[0]
+    model.eval()
+    return model.cpu()
@@ -0,0 +1,100 @@
+import threading
+from typing import Callable
+import numpy as np
+
+from voice_changer.utils.RingBuffer import RingBuffer
+
+
+class ContentUnitCacheStats():
+    """ モデル単位で集計するキャッシュの統計。hit:前回までの結果を使い回したフレーム数, miss:新たにエンコードしたフレーム数 """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.encodedSamples = 0
+        self.requestedSamples = 0
+
+    def add(self, hits: int, misses: int, encodedSamples: int, requestedSamples: int):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.encodedSamples += encodedSamples
+            self.requestedSamples += requestedSamples
+
+    def get_info(self):
+        with self.lock:
+            frames = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / frames if frames > 0 else 0,
+                "encodedSampleRate": self.encodedSamples / self.requestedSamples if self.requestedSamples > 0 else 0,
+            }
+
+
+class ContentUnitCache():
+    """ セッションごとのcontent unit(HuBERT/ContentVec)のキャッシュ。
+    unitを絶対フレーム番号(これまでの累計サンプル数 / hop)で保持し、チャンクごとには新しいサンプル + 前後のマージン分だけをエンコードする。
+    右端のマージン内のフレームは右側の文脈が足りないので暫定扱いにし、次のチャンクでエンコードし直す。
+    結果は窓の先頭から hop 間隔の格子に最も近いフレームを並べて返す。
+    """
+
+    def __init__(self, config: tuple, encode: Callable[[np.ndarray], np.ndarray], hop: int, sampleRate: int, marginMs: float,
+                 frameCount: Callable[[int], int], stats: ContentUnitCacheStats):
+        self.config = config
+        self.encode = encode  # 波形 -> (フレーム数, 次元) のunit。フレーム j は波形の先頭から j * hop の位置
+        self.hop = hop
+        self.marginSamples = int(sampleRate * marginMs / 1000)
+        self.frameCount = frameCount  # 窓全体を一度にエンコードしたときのフレーム数
+        self.stats = stats
+        self.reset()
+
+    def reset(self):
+        self.indices = np.zeros(0, dtype=np.int64)  # 絶対フレーム番号(連続)
+        self.units = None
+        self.confirmedUntil = 0  # これより前(サンプル)のフレームは確定
+        self.lastTotal = 0
+
+    def matches(self, config: tuple):
+        return self.config == config
+
+    def update(self, ring: RingBuffer, windowSize: int):
+        total = ring.total
+        windowSize = min(windowSize, ring.length)
+        windowStart = total - windowSize
+        oldest = total - ring.length
+        firstUsable = -(-oldest // self.hop) * self.hop
+
+        restart = total < self.lastTotal or self.confirmedUntil < windowStart or \
+            self.indices.shape[0] == 0 or self.indices[0] * self.hop > windowStart + self.hop
+        if restart:
+            self.confirmedUntil = windowStart
+            start = max(windowStart // self.hop * self.hop, firstUsable)
+        else:
+            start = max((self.confirmedUntil - self.marginSamples) // self.hop * self.hop, firstUsable)
+
+        segment = ring.latest(total - start)
+        units = self.encode(segment)
+        indices = start // self.hop + np.arange(units.shape[0])
+
+        if restart:
+            hits = 0
+            misses = units.shape[0]
+            self.indices = indices
+            self.units = units
+        else:
+            confirmedIndex = -(-self.confirmedUntil // self.hop)
+            keep = (self.indices < confirmedIndex) & (self.indices >= windowStart // self.hop - 1)
+            new = indices >= confirmedIndex
+            hits = int(np.sum(keep))
+            misses = int(np.sum(new))
+            self.indices = np.concatenate([self.indices[keep], indices[new]])
+            self.units = np.concatenate([self.units[keep], units[new]])
+        self.confirmedUntil = max(self.confirmedUntil, total - self.marginSamples)
+        self.lastTotal = total
+        self.stats.add(hits, misses, segment.shape[0], windowSize)
+
+        queryIndices = np.rint((windowStart + np.arange(self.frameCount(windowSize)) * self.hop) / self.hop).astype(np.int64)
+        lookup = np.clip(queryIndices - self.indices[0], 0, self.indices.shape[0] - 1)
+        return self.units[lookup]
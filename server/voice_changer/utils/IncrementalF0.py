@@ -0,0 +1,94 @@
+from typing import Callable
+import numpy as np
+
+from voice_changer.utils.RingBuffer import RingBuffer
+
+# 解析区間の端ではf0が不安定になるので、前後にこれだけ余分に解析する(ms)。
+F0_ANALYSIS_MARGIN_MS = {
+    "dio": 100,
+    "harvest": 200,
+}
+DEFAULT_F0_ANALYSIS_MARGIN_MS = 200
+
+
+class IncrementalF0Tracker():
+    """ セッションごとのf0の逐次計算。
+    解析済みのフレームを絶対時刻(これまでの累計サンプル数)付きで保持し、チャンクごとには
+    新しく来たサンプル + 前後のマージン分だけを解析する。
+    右端のマージン内のフレームは右側の文脈が足りないので暫定扱いにし、次のチャンクで解析し直す。
+    結果はバッファ全体を解析したときと同じフレーム格子(窓の先頭から framePeriod 間隔)に補間して返す。
+    """
+
+    def __init__(self, config: tuple, analyze: Callable[[np.ndarray], np.ndarray], sampleRate: int, framePeriodMs: float, marginMs: float):
+        self.config = config
+        self.analyze = analyze  # 波形 -> framePeriod間隔のf0(先頭フレームが波形の先頭, 無声は0)
+        self.sampleRate = sampleRate
+        self.framePeriodMs = framePeriodMs
+        self.periodSamples = sampleRate * framePeriodMs / 1000
+        self.marginSamples = int(sampleRate * marginMs / 1000)
+        self.reset()
+
+    def reset(self):
+        self.times = np.zeros(0)  # フレームの絶対時刻(サンプル)
+        self.f0 = np.zeros(0)
+        self.confirmedUntil = 0  # これより前のフレームは確定
+        self.lastTotal = 0
+        self.analyzedSamples = 0
+        self.requestedSamples = 0
+
+    def matches(self, config: tuple):
+        return self.config == config
+
+    def update(self, ring: RingBuffer, windowSize: int):
+        """ ring の直近 windowSize サンプルに対するf0(pyworldと同じフレーム数)を返す。 """
+        total = ring.total
+        windowSize = min(windowSize, ring.length)
+        windowStart = total - windowSize
+        oldest = total - ring.length
+
+        restart = total < self.lastTotal or self.confirmedUntil < windowStart or \
+            self.times.shape[0] == 0 or self.times[0] > windowStart + self.periodSamples
+        if restart:
+            self.times = np.zeros(0)
+            self.f0 = np.zeros(0)
+            self.confirmedUntil = windowStart
+            start = windowStart
+        else:
+            # 左側の文脈としてマージン分さかのぼる。フレームが格子に乗るように揃える。
+            start = int(np.floor((self.confirmedUntil - self.marginSamples) / self.periodSamples) * self.periodSamples)
+            start = max(start, oldest)
+
+        segment = ring.latest(total - start)
+        f0 = np.asarray(self.analyze(segment), dtype=np.float64)
+        times = start + np.arange(f0.shape[0]) * self.periodSamples
+        self.analyzedSamples += segment.shape[0]
+        self.requestedSamples += windowSize
+
+        keep = (self.times < self.confirmedUntil) & (self.times >= windowStart - self.periodSamples)
+        new = times >= self.confirmedUntil
+        self.times = np.concatenate([self.times[keep], times[new]])
+        self.f0 = np.concatenate([self.f0[keep], f0[new]])
+        self.confirmedUntil = max(self.confirmedUntil, total - self.marginSamples)
+        self.lastTotal = total
+
+        frameNum = int(1000.0 * windowSize / self.sampleRate / self.framePeriodMs) + 1
+        return self._resample(windowStart + np.arange(frameNum) * self.periodSamples)
+
+    def _resample(self, queryTimes: np.ndarray):
+        # 両側が有声なら線形補間、どちらかが無声なら近い方のフレームの値(有声/無声の境界をぼかさない)
+        if self.times.shape[0] < 2:
+            return np.full(queryTimes.shape[0], self.f0[0] if self.f0.shape[0] > 0 else 0.0)
+        a = np.clip(np.searchsorted(self.times, queryTimes, side="right") - 1, 0, self.times.shape[0] - 2)
+        b = a + 1
+        fa = self.f0[a]
+        fb = self.f0[b]
+        w = np.clip((queryTimes - self.times[a]) / (self.times[b] - self.times[a]), 0, 1)
+        linear = fa + (fb - fa) * w
+        nearest = np.where(w < 0.5, fa, fb)
+        return np.where((fa > 0) & (fb > 0), linear, nearest)
+
+    def get_info(self):
+        return {
+            "analyzedSamples": self.analyzedSamples,
+            "requestedSamples": self.requestedSamples,
+        }
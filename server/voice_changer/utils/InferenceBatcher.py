@@ -0,0 +1,121 @@
+import threading
+import time
+from typing import Any, Callable, Hashable
+
+
+class BatchRequest():
+    def __init__(self, inputs: Any):
+        self.inputs = inputs
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.promoted = False  # 前のバッチに入りきらず、次のバッチのリーダーになった
+
+
+class InferenceBatcher():
+    """ 別セッションからの同じ形の推論リクエストを待ち時間(windowMs)の間だけ集めて、1回のバッチ推論で実行する。
+    最初に来たリクエストのスレッドがリーダーになってバッチを実行し、結果を各リクエストに配る。
+    バッチは maxBatchSize 件までで、入りきらなかったリクエストは残った中の先頭が次のリーダーになって実行する。
+    windowMs が0ならバッチ化せずにそのまま実行する。
+    """
+
+    @classmethod
+    def get_instance(cls):
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, windowMs: float = 0.0, maxBatchSize: int = 8):
+        self.windowMs = windowMs
+        self.maxBatchSize = maxBatchSize
+        self.cond = threading.Condition()
+        self.pending: dict[Hashable, list[BatchRequest]] = {}
+
+        self.batchSizeHistogram: dict[int, int] = {}
+        self.requests = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def run(self, key: Hashable, inputs: Any, batchFn: Callable[[list], list]):
+        """ batchFn は inputs のリストを受け取り、同じ順序で結果のリストを返すこと。 """
+        if self.windowMs <= 0 or self.maxBatchSize <= 1:
+            return batchFn([inputs])[0]
+
+        request = BatchRequest(inputs)
+        with self.cond:
+            group = self.pending.setdefault(key, [])
+            group.append(request)
+            isLeader = len(group) == 1
+            if len(group) >= self.maxBatchSize:
+                self.cond.notify_all()
+
+        if isLeader == False:
+            request.done.wait()
+            if request.promoted == False:
+                if request.error is not None:
+                    raise request.error
+                return request.result
+        return self._lead(key, request, batchFn)
+
+    def _lead(self, key: Hashable, request: BatchRequest, batchFn: Callable[[list], list]):
+        deadline = request.enqueued + self.windowMs / 1000
+        with self.cond:
+            while len(self.pending[key]) < self.maxBatchSize:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            # notify_all の後にリーダーが起きるまでに来たリクエストで maxBatchSize を超えることがあるので、超えた分は次のバッチにする
+            group = self.pending.pop(key)
+            batch = group[:self.maxBatchSize]
+            rest = group[self.maxBatchSize:]
+            if len(rest) > 0:
+                self.pending[key] = rest
+                rest[0].promoted = True
+                rest[0].done.set()
+
+        start = time.perf_counter()
+        try:
+            results = batchFn([r.inputs for r in batch])
+            for r, result in zip(batch, results):
+                r.result = result
+        except Exception as e:
+            for r in batch:
+                r.error = e
+        self._record(batch, start)
+        for r in batch[1:]:
+            r.done.set()
+
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _record(self, batch: list[BatchRequest], start: float):
+        with self.cond:
+            size = len(batch)
+            self.batchSizeHistogram[size] = self.batchSizeHistogram.get(size, 0) + 1
+            for r in batch:
+                wait = start - r.enqueued
+                self.requests += 1
+                self.totalWait += wait
+                self.maxWait = max(self.maxWait, wait)
+
+    def get_info(self):
+        with self.cond:
+            return {
+                "windowMs": self.windowMs,
+                "maxBatchSize": self.maxBatchSize,
+                "batchSizeHistogram": dict(sorted(self.batchSizeHistogram.items())),
+                "requests": self.requests,
+                "meanAddedWaitMs": self.totalWait / self.requests * 1000 if self.requests > 0 else 0,
+                "maxAddedWaitMs": self.maxWait * 1000,
+            }
+
+
+def onnx_batch_supported(onnx_session):
+    """ ONNXモデルの全入力の先頭次元が可変(バッチ可能)かどうか """
+    for i in onnx_session.get_inputs():
+        if len(i.shape) == 0 or isinstance(i.shape[0], int):
+            return False
+    return True
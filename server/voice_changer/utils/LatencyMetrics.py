@@ -0,0 +1,224 @@
+import bisect
+import threading
+import time
+from typing import Callable
+
+from const import getModelType
+
+# 計測する処理の段階
+STAGE_QUEUE_WAIT = "queue_wait"      # InferenceDispatcher のキューで待った時間
+STAGE_RESAMPLE_IN = "resample_in"
+STAGE_F0 = "f0"
+STAGE_SPECTROGRAM = "spectrogram"
+STAGE_UNITS = "units"                # HuBERT/ContentVec などのコンテンツエンコーダ
+STAGE_INFERENCE = "inference"
+STAGE_CROSSFADE = "crossfade"
+STAGE_RESAMPLE_OUT = "resample_out"
+STAGE_ENCODE = "encode"              # 返送用のバイト列への変換(socket.io / REST)
+STAGE_TOTAL = "total"                # on_request 全体
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)  # sec
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 1.0, 1.5, 2.0)
+MAX_SESSIONS = 256  # これを超えたセッションはセッション別の系列を作らない(モデル別には集計する)
+
+
+class Histogram():
+    """ Prometheus の histogram と同じ形(上限ごとの件数, 合計, 件数)の集計。 """
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        """ バケットの中を線形補間した分位点(Prometheus の histogram_quantile と同じ考え方)。 """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def get_info(self):
+        return {
+            "count": self.count,
+            "meanMs": self.sum / self.count * 1000 if self.count > 0 else 0.0,
+            "p50Ms": self.quantile(0.5) * 1000,
+            "p99Ms": self.quantile(0.99) * 1000,
+        }
+
+
+class StageTimer():
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics: "LatencyMetrics", stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        sessionId = getattr(self.metrics.context, "sessionId", None)
+        if sessionId is not None:
+            self.metrics.observe(self.stage, time.perf_counter() - self.start, sessionId)
+
+
+class LatencyMetrics():
+    """ 変換の段階ごとの処理時間と実時間比(RTF)を、モデルの種類別とセッション別のヒストグラムで集計する。
+    on_request の中では track(sessionId) でセッションをスレッドに結び付けておき、各段階を stage(name) で囲む。
+    track の外(warmup など)の stage は計測しない。render で Prometheus のテキスト形式に出力する。
+    """
+
+    @classmethod
+    def get_instance(cls):
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.context = threading.local()
+        self.byModel: dict[tuple, Histogram] = {}    # (modelType, stage)
+        self.bySession: dict[tuple, Histogram] = {}  # (sessionId, stage)
+        self.rtfByModel: dict[str, Histogram] = {}
+        self.rtfBySession: dict[str, Histogram] = {}
+        self.sessionIds: set[str] = set()
+        self.listeners = []  # 集計と別に生の値を受け取る関数 (stage, secs, sessionId)。ベンチマーク用
+
+    def track(self, sessionId: str):
+        return _TrackContext(self, sessionId)
+
+    def stage(self, stage: str):
+        return StageTimer(self, stage)
+
+    def observe(self, stage: str, secs: float, sessionId: str):
+        modelType = getModelType()
+        with self.lock:
+            self._get(self.byModel, (modelType, stage), LATENCY_BUCKETS).observe(secs)
+            if self._track_session(sessionId):
+                self._get(self.bySession, (sessionId, stage), LATENCY_BUCKETS).observe(secs)
+        for listener in self.listeners:
+            listener(stage, secs, sessionId)
+
+    def add_listener(self, listener: Callable[[str, float, str], None]):
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener: Callable[[str, float, str], None]):
+        self.listeners = [x for x in self.listeners if x is not listener]
+
+    def observe_rtf(self, secs: float, audioSecs: float, sessionId: str):
+        if audioSecs <= 0:
+            return
+        modelType = getModelType()
+        with self.lock:
+            self._get(self.rtfByModel, modelType, RTF_BUCKETS).observe(secs / audioSecs)
+            if self._track_session(sessionId):
+                self._get(self.rtfBySession, sessionId, RTF_BUCKETS).observe(secs / audioSecs)
+
+    def _get(self, histograms: dict, key, buckets: tuple):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = Histogram(buckets)
+            histograms[key] = histogram
+        return histogram
+
+    def _track_session(self, sessionId: str):
+        # lock を保持した状態で呼ぶこと
+        if sessionId in self.sessionIds:
+            return True
+        if len(self.sessionIds) >= MAX_SESSIONS:
+            return False
+        self.sessionIds.add(sessionId)
+        return True
+
+    def release_session(self, sessionId: str):
+        with self.lock:
+            self.sessionIds.discard(sessionId)
+            self.bySession = {key: h for key, h in self.bySession.items() if key[0] != sessionId}
+            self.rtfBySession.pop(sessionId, None)
+
+    def get_info(self):
+        """ モデルの種類別の段階ごとの件数, 平均, p50, p99 (ms)。 """
+        with self.lock:
+            info = {}
+            for (modelType, stage), histogram in self.byModel.items():
+                info.setdefault(modelType, {})[stage] = histogram.get_info()
+            for modelType, histogram in self.rtfByModel.items():
+                rtf = histogram.get_info()
+                info.setdefault(modelType, {})["rtf"] = {"count": rtf["count"], "mean": rtf["meanMs"] / 1000,
+                                                         "p50": rtf["p50Ms"] / 1000, "p99": rtf["p99Ms"] / 1000}
+            return info
+
+    def render(self, queueInfo: dict = None):
+        """ Prometheus のテキスト形式(version 0.0.4)。queueInfo には InferenceDispatcher.get_info() を渡す。 """
+        lines = []
+        with self.lock:
+            _render_histograms(lines, "mmvc_stage_latency_seconds", "Processing time of each conversion stage per model type.",
+                               [({"model": m, "stage": s}, h) for (m, s), h in self.byModel.items()])
+            _render_histograms(lines, "mmvc_session_stage_latency_seconds", "Processing time of each conversion stage per session.",
+                               [({"session": sid, "stage": s}, h) for (sid, s), h in self.bySession.items()])
+            _render_histograms(lines, "mmvc_realtime_factor", "Processing time divided by the duration of the chunk per model type.",
+                               [({"model": m}, h) for m, h in self.rtfByModel.items()])
+            _render_histograms(lines, "mmvc_session_realtime_factor", "Processing time divided by the duration of the chunk per session.",
+                               [({"session": sid}, h) for sid, h in self.rtfBySession.items()])
+        if queueInfo is not None:
+            sessions = queueInfo.get("sessions", {})
+            for name, key, kind, help in [("mmvc_inference_queue_depth", "depth", "gauge", "Chunks waiting in the inference queue."),
+                                          ("mmvc_inference_processed_total", "processed", "counter", "Chunks converted."),
+                                          ("mmvc_inference_dropped_total", "dropped", "counter", "Chunks dropped because the queue was full."),
+                                          ("mmvc_inference_coalesced_total", "coalesced", "counter", "Chunks merged because the queue was full.")]:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for sessionId, q in sessions.items():
+                    lines.append(f"{name}{_labels({'session': sessionId})} {q[key]}")
+            lines.append("# HELP mmvc_inference_queue_size Capacity of each session queue.")
+            lines.append("# TYPE mmvc_inference_queue_size gauge")
+            lines.append(f"mmvc_inference_queue_size {queueInfo.get('queueSize', 0)}")
+        return "\n".join(lines) + "\n"
+
+
+class _TrackContext():
+    __slots__ = ("metrics", "sessionId", "prev")
+
+    def __init__(self, metrics: LatencyMetrics, sessionId: str):
+        self.metrics = metrics
+        self.sessionId = sessionId
+
+    def __enter__(self):
+        self.prev = getattr(self.metrics.context, "sessionId", None)
+        self.metrics.context.sessionId = self.sessionId
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.context.sessionId = self.prev
+
+
+def _labels(labels: dict):
+    escaped = [k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for k, v in labels.items()]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _render_histograms(lines: list, name: str, help: str, series: list):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in series:
+        cumulative = 0
+        for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': str(bound)})} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
@@ -0,0 +1,210 @@
+import os
+import json
+import hashlib
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Callable
+import numpy as np
+
+from const import MAPPED_WEIGHTS_DIR
+
+MAPPED_WEIGHTS_SUFFIX = ".mmw"
+MAGIC = b"MMVCMW01"
+ALIGNMENT = 64  # 各テンソルの先頭のアライメント(バイト)
+
+
+@dataclass
+class MappedWeightsSettings():
+    mappedWeights: int = 1  # 0:off, 1:on 変換済みの重みファイルがあれば memmap で読み込み、なければ初回のロード時に作る
+    mappedWeightsDir: str = MAPPED_WEIGHTS_DIR  # 変換した重みファイルの置き場所(チェックポイントのフォルダには書き込まない)。起動オプションでだけ変える
+
+    # ↓mutableな物だけ列挙
+    intData = ["mappedWeights"]
+    floatData = []
+    strData = []
+
+
+def _named_tensors(model):
+    """ state_dict と同じ順序の (名前, モジュール, 属性名, テンソル, 種類) 。 """
+    for moduleName, module in model.named_modules():
+        prefix = moduleName + "." if moduleName != "" else ""
+        for name, param in module._parameters.items():
+            if param is not None:
+                yield prefix + name, module, name, param, "param"
+        for name, buffer in module._buffers.items():
+            if buffer is not None and name not in module._non_persistent_buffers_set:
+                yield prefix + name, module, name, buffer, "buffer"
+
+
+def structure_hash(model):
+    """ パラメータとバッファの名前、形、型から作るモデルの構造のハッシュ。configが変わってモデルの形が変わったら一致しなくなる。 """
+    lines = [f"{name}:{tuple(tensor.shape)}:{tensor.dtype}" for name, _, _, tensor, _ in _named_tensors(model)]
+    return hashlib.sha1("\n".join(lines).encode("utf-8")).hexdigest()
+
+
+def _source_stamp(sourcePath: str):
+    return {"file": os.path.basename(sourcePath), "size": os.path.getsize(sourcePath), "mtime": os.path.getmtime(sourcePath)}
+
+
+def save_mapped(model, path: str, sourcePath: str):
+    """ モデルの重み(推論に使うものだけ)を memmap できる形式で書き出す。
+    形式: MAGIC(8バイト) + ヘッダの長さ(8バイト, little endian) + JSONのヘッダ + 各テンソルの生データ(ALIGNMENTごとに整列)。
+    """
+    entries = []
+    arrays = []
+    offset = 0
+    for name, _, _, tensor, kind in _named_tensors(model):
+        array = tensor.detach().cpu().contiguous().numpy()
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        entries.append({"name": name, "kind": kind, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        arrays.append((offset, array))
+        offset += array.nbytes
+    dataSize = offset
+    header = json.dumps({
+        "structureHash": structure_hash(model),
+        "source": _source_stamp(sourcePath),
+        "tensors": entries,
+    }).encode("utf-8")
+    dataStart = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    tmpPath = path + ".tmp"
+    try:
+        with open(tmpPath, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for offset, array in arrays:
+                f.seek(dataStart + offset)
+                f.write(array.tobytes())
+            f.truncate(dataStart + dataSize)
+        os.replace(tmpPath, path)
+    except Exception:
+        # 容量不足などで書ききれなかったファイルは残さない
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+
+def load_mapped(model, path: str, sourcePath: str):
+    """ save_mapped で書き出したファイルを memmap して、コピーせずにモデルのパラメータとバッファに割り当てる。
+    copy-on-write(mode 'c')で開くので、推論側で書き換えてもファイルには反映されない。
+    モデルの構造や元の重みファイルが変わっていたら何もせずに False を返す。
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return False
+        headerLength = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(headerLength).decode("utf-8"))
+    if header["structureHash"] != structure_hash(model) or header["source"] != _source_stamp(sourcePath):
+        return False
+    dataStart = -(-(len(MAGIC) + 8 + headerLength) // ALIGNMENT) * ALIGNMENT
+
+    import torch
+    data = np.memmap(path, dtype=np.uint8, mode="c")
+    targets = {name: (module, attr, kind) for name, module, attr, _, kind in _named_tensors(model)}
+    for entry in header["tensors"]:
+        dtype = np.dtype(entry["dtype"])
+        start = dataStart + entry["offset"]
+        count = int(np.prod(entry["shape"]))
+        array = data[start:start + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+        module, attr, kind = targets[entry["name"]]
+        if kind == "param":
+            module._parameters[attr].data = torch.from_numpy(array)
+        else:
+            module._buffers[attr] = torch.from_numpy(array)
+    return True
+
+
+class MappedWeights():
+    """ PyTorchの学習用チェックポイント(torch.load してから state_dict をキーごとにコピーする)の代わりに、
+    推論用の重みだけを memmap できる形式(.mmw)に変換しておき、2回目以降はそれを直接割り当てる。
+    変換したファイルは mappedWeightsDir に置く(チェックポイントのフォルダは読み込み専用やユーザが管理している場所のことがあるので)。
+    書き込めない場合は変換せずに、毎回チェックポイントから読み込む。
+    """
+
+    @classmethod
+    def get_instance(cls):
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.settings = MappedWeightsSettings()
+        self.lock = threading.Lock()
+        self.mappedLoads = 0
+        self.conversions = 0
+        self.fallbacks = 0
+        self.lastLoadTime = 0.0
+        self.lastLoadMode = ""
+
+    def configure(self, params: dict):
+        """ 起動オプションからの設定。Noneの項目は既定値のまま。 """
+        if params.get("mappedWeights") is not None:
+            self.update_setteings("mappedWeights", params["mappedWeights"])
+        if params.get("mappedWeightsDir") is not None:
+            self.settings.mappedWeightsDir = str(params["mappedWeightsDir"])
+
+    def update_setteings(self, key: str, val: any):
+        if key in self.settings.intData:
+            setattr(self.settings, key, int(val))
+            return True
+        return False
+
+    def mapped_path(self, checkpointPath: str):
+        """ 変換したファイルのパス。別のフォルダの同じ名前のチェックポイントと区別するため、元のパスのハッシュを付ける。 """
+        digest = hashlib.sha1(os.path.abspath(checkpointPath).encode("utf-8")).hexdigest()[:8]
+        name = os.path.basename(checkpointPath)
+        return os.path.join(self.settings.mappedWeightsDir, f"{name}.{digest}{MAPPED_WEIGHTS_SUFFIX}")
+
+    def load(self, checkpointPath: str, model, loadCheckpoint: Callable):
+        """ 変換済みのファイルが使えればそれを、使えなければ loadCheckpoint(checkpointPath, model, None) で読み込んで変換しておく。 """
+        start = time.perf_counter()
+        mappedPath = self.mapped_path(checkpointPath)
+        if self.settings.mappedWeights == 0:
+            loadCheckpoint(checkpointPath, model, None)
+            self._record(start, "checkpoint")
+            return
+
+        if os.path.exists(mappedPath):
+            try:
+                if load_mapped(model, mappedPath, checkpointPath):
+                    with self.lock:
+                        self.mappedLoads += 1
+                    self._record(start, "mapped")
+                    return
+                print(f"[MappedWeights] {mappedPath} does not match the model or the checkpoint. convert again")
+            except Exception as e:
+                print(f"[MappedWeights] failed to map {mappedPath}", e)
+            with self.lock:
+                self.fallbacks += 1
+
+        loadCheckpoint(checkpointPath, model, None)
+        self._record(start, "checkpoint")
+        try:
+            os.makedirs(os.path.dirname(mappedPath) or ".", exist_ok=True)
+            save_mapped(model, mappedPath, checkpointPath)
+            with self.lock:
+                self.conversions += 1
+            print(f"[MappedWeights] convert {checkpointPath} -> {mappedPath}")
+        except Exception as e:
+            # 読み込みは済んでいるので、変換できなくてもそのまま使う(次回もチェックポイントから読み込む)
+            print(f"[MappedWeights] failed to convert {checkpointPath} (load from the checkpoint)", e)
+
+    def _record(self, start: float, mode: str):
+        with self.lock:
+            self.lastLoadTime = time.perf_counter() - start
+            self.lastLoadMode = mode
+        print(f"[MappedWeights] load weights ({mode}): {self.lastLoadTime:.3f}sec")
+
+    def get_info(self):
+        with self.lock:
+            data = asdict(self.settings)
+            data["mappedWeightsStats"] = {
+                "mappedLoads": self.mappedLoads,
+                "conversions": self.conversions,
+                "fallbacks": self.fallbacks,
+                "lastLoadTime": self.lastLoadTime,
+                "lastLoadMode": self.lastLoadMode,
+            }
+            return data
@@ -0,0 +1,120 @@
+import threading
+from dataclasses import dataclass, asdict
+
+# onnxruntime はセッションを作る時に読み込む(起動時間を短くするため)ので、列挙値は名前で持つ
+EXECUTION_MODES = {
+    "sequential": "ORT_SEQUENTIAL",
+    "parallel": "ORT_PARALLEL",
+}
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+@dataclass
+class OnnxSessionSettings():
+    onnxIntraOpThreads: int = 0  # 0: onnxruntimeの既定(物理コア数)
+    onnxInterOpThreads: int = 0  # parallel の時だけ使われる
+    onnxExecutionMode: str = "sequential"  # sequential or parallel
+    onnxGraphOptimization: str = "all"  # disable, basic, extended, all
+    onnxCpuMemArena: int = 1  # 0:off, 1:on
+    onnxMemPattern: int = 1  # 0:off, 1:on
+    onnxIOBinding: int = 1  # 0:off, 1:on バッチ化しない時に IOBinding で推論する(SessionOptions ではない)
+
+    # ↓mutableな物だけ列挙
+    intData = ["onnxIntraOpThreads", "onnxInterOpThreads", "onnxCpuMemArena", "onnxMemPattern", "onnxIOBinding"]
+    floatData = []
+    strData = ["onnxExecutionMode", "onnxGraphOptimization"]
+
+
+class OnnxSessionFactory():
+    """ 各モデルが使う onnxruntime.InferenceSession の生成。スレッド数や最適化レベルなどの SessionOptions をここで一元管理する。
+    SessionOptions はセッションの生成時にしか反映されないので、設定を変えたら recreate でセッションを作り直すこと。
+    """
+
+    @classmethod
+    def get_instance(cls):
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.settings = OnnxSessionSettings()
+        self.lock = threading.Lock()
+
+    def configure(self, params: dict):
+        """ 起動オプションからの設定。Noneの項目は既定値のまま。 """
+        for key in self.settings.intData + self.settings.strData:
+            if params.get(key) is not None:
+                self.update_setteings(key, params[key])
+
+    def update_setteings(self, key: str, val: any):
+        with self.lock:
+            if key in self.settings.intData:
+                setattr(self.settings, key, int(val))
+            elif key == "onnxExecutionMode" and val in EXECUTION_MODES:
+                self.settings.onnxExecutionMode = str(val)
+            elif key == "onnxGraphOptimization" and val in GRAPH_OPTIMIZATION_LEVELS:
+                self.settings.onnxGraphOptimization = str(val)
+            elif key in self.settings.strData:
+                print(f"[OnnxSessionFactory] unknown value for {key}: {val}")
+                return False
+            else:
+                return False
+        return True
+
+    def is_session_option(self, key: str):
+        """ 変更したらセッションを作り直す必要がある設定か """
+        return key != "onnxIOBinding"
+
+    def create_options(self):
+        import onnxruntime
+        with self.lock:
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = self.settings.onnxIntraOpThreads
+            options.inter_op_num_threads = self.settings.onnxInterOpThreads
+            options.execution_mode = getattr(onnxruntime.ExecutionMode, EXECUTION_MODES[self.settings.onnxExecutionMode])
+            options.graph_optimization_level = getattr(onnxruntime.GraphOptimizationLevel, GRAPH_OPTIMIZATION_LEVELS[self.settings.onnxGraphOptimization])
+            options.enable_cpu_mem_arena = self.settings.onnxCpuMemArena == 1
+            options.enable_mem_pattern = self.settings.onnxMemPattern == 1
+            return options
+
+    def create(self, modelFile: str, providers: list, providerOptions: list = None):
+        import onnxruntime
+        available = onnxruntime.get_available_providers()
+        if providerOptions is None:
+            providers = [p for p in providers if p in available]
+        else:
+            pairs = [(p, o) for p, o in zip(providers, providerOptions) if p in available]
+            providers = [p for p, _ in pairs]
+            providerOptions = [o for _, o in pairs]
+        session = onnxruntime.InferenceSession(modelFile, sess_options=self.create_options(), providers=providers, provider_options=providerOptions)
+        print(f"[OnnxSessionFactory] create session: {modelFile} {self.get_effective_options(session)}")
+        return session
+
+    def recreate(self, session, modelFile: str):
+        """ 同じプロバイダ構成のまま、現在の設定でセッションを作り直す。 """
+        providers = session.get_providers()
+        providerOptions = session.get_provider_options()
+        return self.create(modelFile, providers, [providerOptions.get(p, {}) for p in providers])
+
+    def get_effective_options(self, session):
+        options = session.get_session_options()
+        return {
+            "intraOpThreads": options.intra_op_num_threads,
+            "interOpThreads": options.inter_op_num_threads,
+            "executionMode": str(options.execution_mode).split(".")[-1],
+            "graphOptimization": str(options.graph_optimization_level).split(".")[-1],
+            "cpuMemArena": options.enable_cpu_mem_arena,
+            "memPattern": options.enable_mem_pattern,
+            "providers": session.get_providers(),
+        }
+
+    def get_info(self, session=None):
+        with self.lock:
+            data = asdict(self.settings)
+        data["onnxSessionOptions"] = self.get_effective_options(session) if session is not None else {}
+        return data
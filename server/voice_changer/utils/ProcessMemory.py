@@ -0,0 +1,28 @@
+import os
+import sys
+
+
+def get_rss():
+    """ このプロセスの常駐メモリ(RSS)のバイト数。取得できない環境では 0 を返す。 """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return 0
+    return 0
+
+
+def get_peak_rss():
+    """ このプロセスの RSS の最大値のバイト数。取得できない環境では 0 を返す。 """
+    try:
+        import resource
+    except ImportError:
+        return 0  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform.startswith("darwin") else peak * 1024  # macOS はバイト、Linux は KiB
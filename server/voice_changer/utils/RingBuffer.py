@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class RingBuffer():
+    """ 固定長のリングバッファ。
+    内部配列を容量の2倍確保し、同じサンプルを前半と後半の両方に書き込む(ミラーリング)。
+    これにより、直近 capacity サンプル以内の任意の区間を連続したビューとしてコピーなしで取り出せる。
+    チャンクごとの再確保は発生しない(容量を増やしたときだけ確保し直す)。
+    """
+
+    def __init__(self, capacity: int, dtype=np.float32):
+        self.capacity = capacity
+        self.dtype = dtype
+        self.buffer = np.zeros(capacity * 2, dtype=dtype)
+        self.pos = 0     # 次に書き込む位置 [0, capacity)
+        self.length = 0  # 有効なサンプル数
+        self.total = 0   # これまでに書き込んだサンプル数の累計
+
+    def ensure_capacity(self, capacity: int):
+        if capacity <= self.capacity:
+            return
+        data = self.latest(self.length).copy()
+        total = self.total
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity * 2, dtype=self.dtype)
+        self.pos = 0
+        self.length = 0
+        self.append(data)
+        self.total = total
+
+    def append(self, data: np.ndarray, scale: float = 1.0):
+        """ data を追記する。scale を指定すると正規化を書き込みと同時に行う(一時配列を作らない)。 """
+        n = data.shape[0]
+        self.total += n
+        if n > self.capacity:
+            data = data[-self.capacity:]
+            n = self.capacity
+
+        first = min(n, self.capacity - self.pos)
+        self._write(self.pos, data[:first], scale)
+        if n > first:
+            self._write(0, data[first:], scale)
+
+        self.pos = (self.pos + n) % self.capacity
+        self.length = min(self.length + n, self.capacity)
+
+    def _write(self, start: int, data: np.ndarray, scale: float):
+        n = data.shape[0]
+        dst = self.buffer[start:start + n]
+        np.copyto(dst, data, casting="unsafe")
+        if scale != 1.0:
+            dst *= scale
+        self.buffer[start + self.capacity:start + self.capacity + n] = dst
+
+    def latest(self, size: int):
+        """ 直近 size サンプル(有効なサンプルが少なければその分だけ)の連続ビューを返す。
+        ビューは次の append で上書きされるので、保持する場合はコピーすること。
+        """
+        size = min(size, self.length)
+        end = self.pos + self.capacity
+        return self.buffer[end - size:end]
+
+    def clear(self):
+        self.pos = 0
+        self.length = 0
+        self.total = 0
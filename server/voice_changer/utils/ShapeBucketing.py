@@ -0,0 +1,95 @@
+import threading
+import numpy as np
+
+DEFAULT_CONVERT_BUCKETS = ""  # 既定ではバケット化しない(切り上げた分だけ推論の入力が長くなるので、効果を測ってから有効にする)
+EXAMPLE_CONVERT_BUCKETS = "8192,12288,16384,24576,32768,40960,49152,57344,65536"  # convertBuckets に設定する候補の例(ベンチマークの既定)
+LATENCY_RESERVOIR_SIZE = 256
+
+
+class BucketStats():
+    def __init__(self):
+        self.hits = 0
+        self.warmupMs = 0.0  # そのバケットの最初の推論の時間(実行計画やアロケータの準備を含む)
+        self.latencies = np.zeros(LATENCY_RESERVOIR_SIZE)  # 2回目以降の推論の時間(直近のもの)
+        self.count = 0
+
+    def add(self, elapsed: float):
+        self.hits += 1
+        if self.hits == 1:
+            self.warmupMs = elapsed * 1000
+            return
+        self.latencies[self.count % LATENCY_RESERVOIR_SIZE] = elapsed * 1000
+        self.count += 1
+
+    def get_info(self):
+        latencies = self.latencies[:min(self.count, LATENCY_RESERVOIR_SIZE)]
+        return {
+            "hits": self.hits,
+            "warmupMs": self.warmupMs,
+            "meanMs": float(np.mean(latencies)) if latencies.shape[0] > 0 else 0,
+            "jitterMs": float(np.std(latencies)) if latencies.shape[0] > 0 else 0,
+        }
+
+
+class ShapeBuckets():
+    """ 変換窓の長さ(convertSize)を決まった長さ(バケット)に切り上げる。
+    クライアントのチャンクサイズやクロスフェードの設定ごとに推論の入力の形が変わると、onnxruntime/PyTorch のアロケータや
+    形ごとのキャッシュが使い回せないので、形の種類をバケットの数に抑える。
+    切り上げた分は過去の音声(起動直後は無音)を文脈として使い、出力は後ろから必要な長さだけを使うので結果の長さは変わらない。
+    最大のバケットを超える場合は切り上げない(overflow)。
+    """
+
+    @classmethod
+    def get_instance(cls):
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, sizes: str = DEFAULT_CONVERT_BUCKETS):
+        self.lock = threading.Lock()
+        self.sizes = []
+        self.stats: dict[int, BucketStats] = {}
+        self.overflows = 0
+        self.set_sizes(sizes)
+
+    def set_sizes(self, sizes: str):
+        """ カンマ区切りのサンプル数。空文字ならバケット化しない。 """
+        try:
+            parsed = sorted(set([int(x) for x in sizes.split(",") if x.strip() != ""]))
+        except ValueError:
+            print(f"[ShapeBuckets] invalid bucket sizes: {sizes}")
+            return False
+        with self.lock:
+            self.sizes = parsed
+            self.stats = {}
+            self.overflows = 0
+        return True
+
+    def bucket(self, convertSize: int, hop: int):
+        """ hop の倍数に切り上げた convertSize 以上で最小のバケット(これも hop の倍数に切り上げる)を返す。 """
+        convertSize = -(-convertSize // hop) * hop
+        with self.lock:
+            for size in self.sizes:
+                size = -(-size // hop) * hop
+                if size >= convertSize:
+                    return size
+            if len(self.sizes) > 0:
+                self.overflows += 1
+        return convertSize
+
+    def add_latency(self, convertSize: int, elapsed: float):
+        with self.lock:
+            stats = self.stats.get(convertSize)
+            if stats is None:
+                stats = BucketStats()
+                self.stats[convertSize] = stats
+            stats.add(elapsed)
+
+    def get_info(self):
+        with self.lock:
+            return {
+                "sizes": self.sizes,
+                "overflows": self.overflows,
+                "shapes": len(self.stats),
+                "buckets": {str(size): stats.get_info() for size, stats in sorted(self.stats.items())},
+            }
@@ -0,0 +1,52 @@
+import threading
+
+
+class SilenceGate():
+    """ セッションごとの無音判定。
+    音量が閾値を下回っても hangover の間は無音扱いにしない(語尾が切れないように)。
+    """
+
+    def __init__(self):
+        self.hangoverRemaining = 0  # samples
+
+    def is_silent(self, vol: float, threshold: float, hangoverSamples: int, chunkSize: int):
+        if vol >= threshold:
+            self.hangoverRemaining = hangoverSamples
+            return False
+        if self.hangoverRemaining > 0:
+            self.hangoverRemaining -= chunkSize
+            return False
+        return True
+
+
+class SilenceGateStats():
+    """ 無音でスキップしたチャンク数と、それで節約できたCPU時間の見積もり。
+    節約時間は、無音でないチャンクの特徴抽出+推論にかかった平均時間 x スキップ数 で見積もる。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.skippedChunks = 0
+        self.processedChunks = 0
+        self.processTime = 0.0
+
+    def add_skipped(self):
+        with self.lock:
+            self.skippedChunks += 1
+
+    def add_processed(self):
+        with self.lock:
+            self.processedChunks += 1
+
+    def add_process_time(self, elapsed: float):
+        with self.lock:
+            self.processTime += elapsed
+
+    def get_info(self):
+        with self.lock:
+            average = self.processTime / self.processedChunks if self.processedChunks > 0 else 0
+            return {
+                "skippedChunks": self.skippedChunks,
+                "processedChunks": self.processedChunks,
+                "estimatedSavedTimeSec": average * self.skippedChunks,
+            }
@@ -0,0 +1,114 @@
+from math import gcd
+import threading
+import numpy as np
+
+# (num_zeros, rolloff, kaiser beta)。kaiser_fast / kaiser_best は resampy のフィルタと同じパラメータ。
+RESAMPLE_QUALITIES = {
+    "fast": (8, 0.8, 5.0),
+    "kaiser_fast": (16, 0.85, 8.555504641634386),
+    "kaiser_best": (64, 0.9475937167399596, 14.769656459379492),
+}
+DEFAULT_RESAMPLE_QUALITY = "kaiser_fast"  # ストリーミングではチャンクごとのコストが効くので。kaiser_best はフィルタが4倍長い
+
+_filter_cache = {}
+_filter_cache_lock = threading.Lock()
+
+
+class PolyphaseFilter():
+    """ (src, dst, quality) ごとのポリフェーズフィルタ。生成コストが高いので get_polyphase_filter でキャッシュして共有する。 """
+
+    def __init__(self, srcRate: int, dstRate: int, quality: str):
+        num_zeros, rolloff, beta = RESAMPLE_QUALITIES[quality]
+        g = gcd(srcRate, dstRate)
+        self.up = dstRate // g
+        self.down = srcRate // g
+
+        # アップサンプル後のレートで設計したローパス(窓付きsinc)
+        scale = max(self.up, self.down)
+        cutoff = 0.5 * rolloff / scale  # cycles / upsampled sample
+        self.half = int(np.ceil(num_zeros * scale / rolloff))
+        n = np.arange(-self.half, self.half + 1)
+        h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(2 * self.half + 1, beta) * self.up
+
+        # phase ごとのタップ表 taps[phase, j] = h[n0(phase) - j * up]
+        # n0(phase) は (half - up, half] の範囲で phase と合同な値
+        self.taps = int(np.ceil((2 * self.half + 1) / self.up)) + 1
+        phases = np.arange(self.up)
+        self.n0 = self.half - ((self.half - phases) % self.up)
+        idx = self.n0[:, None] - np.arange(self.taps)[None, :] * self.up
+        valid = idx >= -self.half
+        self.table = np.where(valid, h[np.clip(idx + self.half, 0, 2 * self.half)], 0.0)
+
+        # 出力 k を計算するのに必要な入力の先読み量(=遅延, 入力サンプル数)
+        self.delay = int(np.ceil(self.half / self.up))
+
+        # 出力を up 個ずつのブロックにまとめる。ブロック m の出力 m * up + r の窓の先頭は、入力 m * down + baseMin + offsets[r] になるので、
+        # 入力を down ずつずらして span 個ずつ切り出した行列と block(span, up) の1回の行列積で全ての phase をまとめて計算できる。
+        r = np.arange(self.up)
+        phase = r * self.down % self.up
+        base = (r * self.down - self.n0[phase]) // self.up
+        self.baseMin = int(base.min())
+        offsets = base - self.baseMin
+        self.span = int(offsets.max()) + self.taps
+        self.block = np.zeros((self.span, self.up), dtype=np.float64)
+        self.block[offsets[:, None] + np.arange(self.taps)[None, :], r[:, None]] = self.table[phase]
+
+
+def get_polyphase_filter(srcRate: int, dstRate: int, quality: str):
+    key = (srcRate, dstRate, quality)
+    with _filter_cache_lock:
+        if key not in _filter_cache:
+            _filter_cache[key] = PolyphaseFilter(srcRate, dstRate, quality)
+        return _filter_cache[key]
+
+
+class StreamResampler():
+    """ チャンクをまたいでフィルタ状態(入力履歴と出力位相)を引き継ぐリサンプラ。
+    チャンク単位で独立にリサンプルしないので、チャンク境界に端の歪みが出ない。
+    代わりにフィルタ長の半分(delay)の固定遅延が入る。開始時はその分の無音を詰めておくので、
+    各チャンクの出力長は概ね len(chunk) * dst / src になる。
+    """
+
+    def __init__(self, srcRate: int, dstRate: int, quality: str = DEFAULT_RESAMPLE_QUALITY):
+        self.srcRate = srcRate
+        self.dstRate = dstRate
+        self.quality = quality
+        self.filter = get_polyphase_filter(srcRate, dstRate, quality)
+        self.reset()
+
+    def reset(self):
+        # 開始位置の前は無音とみなす。入力インデックス [-delay, delay) を0で埋め、実際の入力は delay から始まる。
+        self.history = np.zeros(self.filter.delay * 2, dtype=np.float64)
+        self.historyStart = -self.filter.delay  # history[0] の入力インデックス
+        self.totalIn = self.filter.delay
+        self.nextOut = 0
+
+    def matches(self, srcRate: int, dstRate: int, quality: str):
+        return self.srcRate == srcRate and self.dstRate == dstRate and self.quality == quality
+
+    def resample(self, chunk: np.ndarray):
+        f = self.filter
+        self.totalIn += chunk.shape[0]
+
+        # 出力 k は入力 floor((k * down + half) / up) までそろっていれば計算できる
+        outStart = self.nextOut
+        outEnd = max(-(-(self.totalIn * f.up - f.half) // f.down), outStart)
+
+        # outStart を含むブロックから outEnd を含むブロックまでを計算して、範囲外の出力は捨てる。
+        blockStart = outStart // f.up
+        blocks = -(-outEnd // f.up) - blockStart
+        first = blockStart * f.down + f.baseMin - self.historyStart  # work での最初の行の先頭
+        end = self.history.shape[0] + chunk.shape[0]
+        # 末尾の行が入力の終端を越えても切り出せるように、0を足しておく(範囲外の出力にしか使われない)。
+        pad = max(first + max(blocks - 1, 0) * f.down + f.span - end, 0)
+        work = np.concatenate([self.history, chunk.astype(np.float64, copy=False), np.zeros(pad)])
+        rows = np.lib.stride_tricks.sliding_window_view(work[first:], f.span)[::f.down][:blocks]
+        offset = outStart - blockStart * f.up
+        out = (rows @ f.block).reshape(-1)[offset:offset + outEnd - outStart]
+        self.nextOut = outEnd
+
+        # 次の出力のブロックで必要になる入力以降だけ残す
+        keepFrom = (self.nextOut // f.up) * f.down + f.baseMin - self.historyStart
+        self.history = work[keepFrom:end]
+        self.historyStart += keepFrom
+        return out
@@ -0,0 +1,96 @@
+import torch
+
+from voice_changer.utils.RingBuffer import RingBuffer
+
+
+class StreamingSpectrogram():
+    """ セッションごとのスペクトログラムの逐次計算。spectrogram_torch(center=False, 両端reflectパディング)と同じ結果を返す。
+    反射パディングを含まない内側のフレームは、そのフレームが参照する音声の絶対位置(これまでの累計サンプル数)で保持して使い回し、
+    新しく来た hop 単位のフレームだけを計算する。反射パディングを含む両端のフレームは毎回計算する。
+    チャンクの長さが hop の倍数でない(フレームの位相がずれる)場合は全フレームを計算し直す。
+    """
+
+    def __init__(self, n_fft: int, hop_size: int, win_size: int):
+        self.n_fft = n_fft
+        self.hop_size = hop_size
+        self.win_size = win_size
+        self.pad = int((n_fft - hop_size) / 2)
+        self.window = torch.hann_window(win_size)
+        self.reset()
+
+    def reset(self):
+        self.frames = None  # 内側のフレーム (freq, N)
+        self.first = 0      # self.frames[:, 0] の絶対フレーム番号(参照する音声の先頭位置 // hop)
+        self.phase = None   # 参照する音声の先頭位置 % hop
+        self.lastTotal = 0
+        self.computedFrames = 0
+        self.requestedFrames = 0
+
+    def matches(self, n_fft: int, hop_size: int, win_size: int):
+        return self.n_fft == n_fft and self.hop_size == hop_size and self.win_size == win_size
+
+    def _magnitude(self, y: torch.Tensor):
+        spec = torch.stft(y.unsqueeze(0), self.n_fft, hop_length=self.hop_size, win_length=self.win_size, window=self.window,
+                          center=False, pad_mode='reflect', normalized=False, onesided=True, return_complex=True)
+        spec = torch.view_as_real(spec)
+        spec = torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
+        self.computedFrames += spec.shape[2]
+        return spec[0]
+
+    def _reflect(self, y: torch.Tensor, left: int, right: int):
+        return torch.nn.functional.pad(y.view(1, 1, -1), (left, right), mode='reflect').view(-1)
+
+    def update(self, ring: RingBuffer, windowSize: int):
+        """ ring の直近 windowSize サンプルのスペクトログラム (freq, frames) を返す。 """
+        windowSize = min(windowSize, ring.length)
+        audio = torch.from_numpy(ring.latest(windowSize))
+        total = ring.total
+        windowStart = total - windowSize
+        hop = self.hop_size
+        pad = self.pad
+
+        frameNum = (windowSize + 2 * pad - self.n_fft) // hop + 1
+        self.requestedFrames += frameNum
+        # 窓内のフレーム j は音声の [j * hop - pad, j * hop - pad + n_fft) を参照する。反射部分を含まないのは [jLo, jHi]
+        jLo = -(-pad // hop)
+        jHi = (windowSize - self.n_fft + pad) // hop
+        if jHi < jLo or total < self.lastTotal:
+            self.reset()
+            self.lastTotal = total
+            return self._magnitude(self._reflect(audio, pad, pad))
+        self.lastTotal = total
+
+        start = windowStart + jLo * hop - pad
+        phase = start % hop
+        kLo = start // hop
+        kHi = kLo + (jHi - jLo)
+        cached = self.frames.shape[1] if self.frames is not None else 0
+        if self.phase != phase or self.frames is None or kLo < self.first or kLo > self.first + cached:
+            # 使い回せるフレームがないので全体を計算し、内側だけを保持する
+            spec = self._magnitude(self._reflect(audio, pad, pad))
+            self.frames = spec[:, jLo:jHi + 1]
+            self.first = kLo
+            self.phase = phase
+            return spec
+
+        # 左端(反射部分を含む)
+        left = self._magnitude(self._reflect(audio[:(jLo - 1) * hop - pad + self.n_fft], pad, 0))[:, :jLo] if jLo > 0 else None
+
+        # 新しい内側のフレームと右端は連続しているので1回で計算する
+        have = self.first + cached  # 次に必要な絶対フレーム番号
+        jStart = jLo + (have - kLo)
+        tail = self._magnitude(self._reflect(audio[jStart * hop - pad:], 0, pad))[:, :frameNum - jStart]
+        newFrames = jHi + 1 - jStart
+        self.frames = torch.cat([self.frames[:, kLo - self.first:], tail[:, :newFrames]], dim=1)
+        self.first = kLo
+
+        specs = [self.frames, tail[:, newFrames:]]
+        if left is not None:
+            specs.insert(0, left)
+        return torch.cat(specs, dim=1)
+
+    def get_info(self):
+        return {
+            "computedFrames": self.computedFrames,
+            "requestedFrames": self.requestedFrames,
+        }